@@ -0,0 +1,396 @@
+"""
+Сквозной бенчмарк конвейера ВК → Telegram без доступа к сети.
+
+Локальный HTTP-сервер подменяет VK API (execute с вызовами wall.get),
+хостинг видео и фото и Bot API (sendVideo, sendMediaGroup). Стены групп берутся из записанного
+ответа wall.get (--wall) либо генерируются, видео — синтетические ролики
+ffmpeg (H.264 в MP4, который публикуется без перекодирования, и MPEG-4
+в AVI, который приходится перекодировать). С --album-every N каждый N-й
+синтетический пост — альбом из двух видео и фото. Скачивание идет
+настоящим yt-dlp, обработка — настоящим ffmpeg.
+
+Замеряется:
+- скорость обновления индекса (crawl_new_posts) в зависимости от числа групп
+- задержка слота publish_random_post: без подготовленных постов и после prefetch_step
+- время перекодирования на 1 МБ исходного видео
+- пиковые RSS процесса, RSS ffmpeg и место на диске во время публикации
+
+Парсер работает во временной директории, рабочие файлы проекта не затрагиваются.
+
+Запуск из корня проекта:
+    python benchmarks/bench_pipeline.py [--wall wall.json] [--groups 1,5,25,100] [--slots 5] [--album-every 3]
+
+Файл --wall — сохраненный ответ wall.get ({"response": {"items": [...]}}) или
+просто список постов; он отдается для каждой группы.
+"""
+import os
+import re
+import sys
+import json
+import time
+import asyncio
+import logging
+import argparse
+import tempfile
+import statistics
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+BOT_TOKEN = '0:bench'
+
+# Токены задаются до импорта config, чтобы значения из .env не использовались
+os.environ.update(VK_TOKEN='bench', TELEGRAM_BOT_TOKEN=BOT_TOKEN, TELEGRAM_CHANNEL_ID='@bench')
+
+import aiohttp
+from aiohttp import web
+
+from transcode import run_ffmpeg
+
+# Синтетические ролики чередуются: (расширение, кодек видео, кодек звука)
+CLIP_KINDS = (
+    ('mp4', 'libx264', 'aac'),
+    ('avi', 'mpeg4', 'libmp3lame'),
+)
+
+
+def synthetic_wall(count, album_every=0):
+    """
+    Посты в формате wall.get, от новых к старым: по одному видео, а каждый
+    album_every-й пост — два видео и фото
+    """
+    now = int(time.time())
+    wall = []
+    for i in range(count):
+        attachments = [{'type': 'video', 'video': {'owner_id': -1, 'id': 1000 - i}}]
+        if album_every and i % album_every == 0:
+            attachments += [
+                {'type': 'video', 'video': {'owner_id': -2, 'id': 1000 - i}},
+                {'type': 'photo', 'photo': {'sizes': [
+                    {'type': 'x', 'url': 'https://example.invalid/photo.jpg', 'width': 854, 'height': 480},
+                ]}},
+            ]
+        wall.append({'id': 1000 - i, 'date': now - i * 3600, 'text': f'Синтетический пост {i}',
+                     'attachments': attachments})
+    return wall
+
+
+def load_wall(path):
+    with open(path, encoding='utf-8') as f:
+        data = json.load(f)
+    if isinstance(data, dict):
+        data = data.get('response', data)
+        data = data.get('items', data) if isinstance(data, dict) else data
+    return data
+
+
+def generate_clips(directory, count):
+    """Ролики разной длительности, чтобы проверка на дубликаты не отбрасывала их"""
+    clips = []
+    for index in range(count):
+        extension, video_codec, audio_codec = CLIP_KINDS[index % len(CLIP_KINDS)]
+        duration = 3 + index
+        path = os.path.join(directory, f'clip{index}.{extension}')
+        run_ffmpeg(['-f', 'lavfi', '-i', f'testsrc2=duration={duration}:size=854x480:rate=30',
+                    '-f', 'lavfi', '-i', f'sine=frequency={200 + index * 50}:duration={duration}',
+                    '-c:v', video_codec, '-b:v', '2500k', '-c:a', audio_codec, '-shortest', path])
+        clips.append(path)
+    return clips
+
+
+def generate_photo(directory):
+    path = os.path.join(directory, 'photo.jpg')
+    run_ffmpeg(['-f', 'lavfi', '-i', 'testsrc2=size=854x480', '-frames:v', '1', path])
+    return path
+
+
+class FakeServices:
+    """Локальные VK API, хостинг видео и Bot API"""
+
+    def __init__(self, wall, clips, photo, vk_latency, upload_delay):
+        self.wall = wall
+        self.clips = clips
+        self.photo = photo
+        self.vk_latency = vk_latency
+        self.upload_delay = upload_delay
+        self.clip_by_key = {}
+        self.execute_calls = 0
+        self.uploaded_bytes = 0
+        self.messages = 0
+        self.albums = 0
+        self.base_url = None
+        self.runner = None
+
+    async def start(self):
+        app = web.Application(client_max_size=1024 ** 3)
+        app.router.add_post('/method/execute', self.execute)
+        app.router.add_get('/video/{key}', self.video)
+        app.router.add_get('/photo', self.photo_file)
+        app.router.add_post(f'/bot{BOT_TOKEN}/sendVideo', self.send_video)
+        app.router.add_post(f'/bot{BOT_TOKEN}/sendMediaGroup', self.send_media_group)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, '127.0.0.1', 0).start()
+        self.base_url = f'http://127.0.0.1:{self.runner.addresses[0][1]}'
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    async def execute(self, request):
+        data = await request.post()
+        self.execute_calls += 1
+        await asyncio.sleep(self.vk_latency)
+        response = []
+        for match in re.finditer(r'API\.wall\.get\((.*?)\)\);', data['code']):
+            params = json.loads(match.group(1))
+            offset, count = params.get('offset', 0), params.get('count', 100)
+            response.append({'count': len(self.wall), 'items': self.wall[offset:offset + count]})
+        return web.json_response({'response': response})
+
+    async def video(self, request):
+        # Каждое новое видео получает свой ролик, пока они не закончатся
+        key = request.match_info['key']
+        if key not in self.clip_by_key:
+            self.clip_by_key[key] = self.clips[len(self.clip_by_key) % len(self.clips)]
+        return web.FileResponse(self.clip_by_key[key])
+
+    async def photo_file(self, request):
+        return web.FileResponse(self.photo)
+
+    async def read_form(self, request):
+        """Поля запроса Bot API; загруженные файлы заменяются выданными им file_id"""
+        if not request.content_type.startswith('multipart/'):
+            return dict(await request.post())
+        fields = {}
+        async for part in await request.multipart():
+            if part.filename:
+                size = 0
+                while True:
+                    chunk = await part.read_chunk()
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                self.uploaded_bytes += size
+                fields[part.name] = f'file{self.messages}_{part.name}'
+            else:
+                fields[part.name] = (await part.read()).decode()
+        return fields
+
+    async def send_video(self, request):
+        fields = await self.read_form(request)
+        await asyncio.sleep(self.upload_delay)
+        self.messages += 1
+        return web.json_response({'ok': True, 'result': {
+            'message_id': self.messages,
+            'video': {'file_id': fields['video'], 'file_unique_id': fields['video'], 'file_size': 0},
+        }})
+
+    async def send_media_group(self, request):
+        fields = await self.read_form(request)
+        await asyncio.sleep(self.upload_delay)
+        self.messages += 1
+        self.albums += 1
+        result = []
+        for item in json.loads(fields['media']):
+            media = item['media']
+            file_id = fields[media[len('attach://'):]] if media.startswith('attach://') else media
+            file = {'file_id': file_id, 'file_unique_id': file_id, 'file_size': 0}
+            result.append({'message_id': self.messages, item['type']: [file] if item['type'] == 'photo' else file})
+        return web.json_response({'ok': True, 'result': result})
+
+
+class PeakSampler:
+    """Пиковые RSS процесса и объем рабочей директории за время замера"""
+
+    def __init__(self, directory, interval=0.05):
+        self.directory = directory
+        self.interval = interval
+        self.peak_rss = 0
+        self.peak_disk = 0
+        self.task = None
+
+    async def __aenter__(self):
+        self.task = asyncio.create_task(self.sample())
+        return self
+
+    async def __aexit__(self, *exc):
+        self.take()
+        self.task.cancel()
+
+    async def sample(self):
+        while True:
+            self.take()
+            await asyncio.sleep(self.interval)
+
+    def take(self):
+        self.peak_rss = max(self.peak_rss, current_rss())
+        self.peak_disk = max(self.peak_disk, directory_size(self.directory))
+
+
+def current_rss():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        # Без /proc — пик за все время работы процесса
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 if resource else 0
+
+
+def directory_size(directory):
+    total = 0
+    for root, _, files in os.walk(directory):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def mb(value):
+    return value / (1024 * 1024)
+
+
+async def bench_crawl(parser, services, group_counts):
+    lines = [f"{'групп':>6} {'запросов':>9} {'постов':>7} {'время, с':>9} {'групп/с':>8} {'постов/с':>9}"]
+    for count in group_counts:
+        groups = [f'bench{count}_{index}' for index in range(count)]
+        calls_before = services.execute_calls
+        unpublished_before = parser.candidate_store.count_unpublished()
+        started = time.perf_counter()
+        await parser.crawl_new_posts(groups)
+        elapsed = time.perf_counter() - started
+        posts = parser.candidate_store.count_unpublished() - unpublished_before
+        lines.append(f"{count:6} {services.execute_calls - calls_before:9} {posts:7} {elapsed:9.2f} "
+                     f"{count / elapsed:8.1f} {posts / elapsed:9.1f}")
+    return lines
+
+
+async def bench_slots(parser, workdir, slots, prefetched):
+    latencies = []
+    async with PeakSampler(workdir) as sampler:
+        for _ in range(slots):
+            if prefetched:
+                # Запас готовят задачи prepare из общей очереди, как в обычной работе
+                await parser.prefetch_step()
+                while parser.job_queue.pending('prepare'):
+                    await asyncio.sleep(0.1)
+            published_before = len(parser.published_store)
+            started = time.perf_counter()
+            await parser.publish_random_post()
+            latencies.append(time.perf_counter() - started)
+            if len(parser.published_store) == published_before:
+                print("  пост не опубликован, см. parser.log во временной директории")
+    return latencies, sampler
+
+
+async def run(args, workdir):
+    wall = load_wall(args.wall) if args.wall else synthetic_wall(args.posts, args.album_every)
+    clips_dir = os.path.join(workdir, 'clips')
+    os.makedirs(clips_dir)
+    # В альбомах по два видео: роликов нужно больше, чтобы проверка на дубликаты их не отбрасывала
+    clip_count = args.slots * (4 if args.album_every else 2) + 4
+    print(f"Генерируем {clip_count} синтетических роликов...")
+    clips = generate_clips(clips_dir, clip_count)
+
+    services = FakeServices(wall, clips, generate_photo(clips_dir), args.vk_latency, args.upload_delay)
+    await services.start()
+
+    # Модуль парсера создает базы и журналы в текущей директории при импорте
+    parser_dir = os.path.join(workdir, 'parser')
+    os.makedirs(parser_dir)
+    os.chdir(parser_dir)
+    import vk_tg_parser as parser
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+
+    parser.VK_API_URL = f'{services.base_url}/method'
+    parser.TELEGRAM_API_URL = services.base_url
+    parser.START_DATE = '2000-01-01'
+    # Замеряется конвейер, а не ограничитель частоты: лимит на канал снят
+    parser.TELEGRAM_CHANNEL_MESSAGES_PER_MINUTE = 60 * 1000
+    extract_video_posts = parser.extract_video_posts
+
+    def local_video_posts(group_id, items, start_date):
+        # Ссылки на видео и фото ВК ведут на локальный сервер
+        posts = extract_video_posts(group_id, items, start_date)
+        for post in posts:
+            post['video_urls'] = [f"{services.base_url}/video/{key}" for key in post['video_keys']]
+            for attachment in post['attachments']:
+                attachment['url'] = (f"{services.base_url}/video/{attachment['key']}"
+                                     if attachment['type'] == 'video' else f"{services.base_url}/photo")
+        return posts
+
+    parser.extract_video_posts = local_video_posts
+
+    connector = aiohttp.TCPConnector(limit=parser.HTTP_POOL_SIZE)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        parser.http_session = session
+
+        crawl_lines = await bench_crawl(parser, services, args.groups)
+        jobs = parser.spawn(parser.job_loop(), 'jobs')
+
+        # Публикация идет из небольшого набора групп, уже попавших в индекс
+        parser.VK_GROUPS[:] = [f'bench{args.groups[0]}_{index}' for index in range(args.groups[0])]
+
+        results = {}
+        for label, prefetched in (('без подготовки', False), ('после prefetch', True)):
+            latencies, sampler = await bench_slots(parser, parser_dir, args.slots, prefetched)
+            results[label] = (latencies, sampler)
+        jobs.cancel()
+
+    await services.stop()
+
+    print(f"\nОбновление индекса: {len(wall)} постов на стене, задержка VK {args.vk_latency * 1000:.0f} мс")
+    print('\n'.join(crawl_lines))
+
+    print(f"\n{'слот':16} {'мин, с':>7} {'медиана':>8} {'макс, с':>8} {'RSS, МБ':>8} {'диск, МБ':>9}")
+    for label, (latencies, sampler) in results.items():
+        print(f"{label:16} {min(latencies):7.2f} {statistics.median(latencies):8.2f} {max(latencies):8.2f} "
+              f"{mb(sampler.peak_rss):8.1f} {mb(sampler.peak_disk):9.1f}")
+    if resource:
+        print(f"Пиковый RSS ffmpeg: {resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024:.1f} МБ")
+
+    transcode = parser.metrics.durations.get('transcode')
+    transcoded_mb = mb(parser.metrics.bytes_in.get('transcode', 0))
+    if transcode and transcoded_mb:
+        print(f"Перекодирование: {transcode.sum / transcoded_mb:.2f} с на 1 МБ исходного видео "
+              f"({transcode.count} роликов, {transcoded_mb:.1f} МБ)")
+    print(f"Загружено в Bot API: {mb(services.uploaded_bytes):.1f} МБ, сообщений: {services.messages} "
+          f"(из них альбомов: {services.albums})")
+
+    print("\nЭтапы:")
+    for line in parser.metrics.summary():
+        print(f"  {line}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Офлайн-бенчмарк конвейера ВК -> Telegram')
+    parser.add_argument('--wall', help='Записанный ответ wall.get (JSON); по умолчанию — синтетические посты')
+    parser.add_argument('--posts', type=int, default=100, help='Постов на синтетической стене')
+    parser.add_argument('--groups', default='1,5,25,100',
+                        help='Количества групп для замера обновления индекса, через запятую')
+    parser.add_argument('--slots', type=int, default=5, help='Слотов публикации в каждом режиме')
+    parser.add_argument('--vk-latency', type=float, default=0.05, help='Задержка ответа VK API, с')
+    parser.add_argument('--upload-delay', type=float, default=0.0,
+                        help='Дополнительная задержка sendVideo и sendMediaGroup, с')
+    parser.add_argument('--album-every', type=int, default=0,
+                        help='Каждый N-й синтетический пост — альбом из двух видео и фото (0 — без альбомов)')
+    parser.add_argument('--verbose', action='store_true', help='Показывать лог парсера')
+    args = parser.parse_args()
+    args.groups = [int(count) for count in args.groups.split(',')]
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as workdir:
+        try:
+            asyncio.run(run(args, workdir))
+        finally:
+            os.chdir(cwd)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+"""
+Бенчмарк журнала опубликованных постов на 1 млн записей.
+
+Сравнивает PublishedStore со старой схемой (JSON-список, который целиком
+читается и перезаписывается на каждой публикации, а проверка — поиск в списке).
+
+Запуск из корня проекта:
+    python benchmarks/bench_published_store.py [--count 1000000]
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage import PublishedStore
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def bench_store(workdir, keys, lookups, appends):
+    path = os.path.join(workdir, 'published_posts.log')
+    with open(path, 'w', encoding='utf-8') as f:
+        f.writelines(f"{key}\n" for key in keys)
+
+    def load():
+        store = PublishedStore(path)
+        len(store)  # журнал читается при первом обращении
+        return store
+
+    store, load_time = timed(load)
+    _, lookup_time = timed(lambda: sum(key in store for key in lookups))
+
+    start = time.perf_counter()
+    for i in range(appends):
+        store.add(f"new_{i}")
+    append_time = time.perf_counter() - start
+    store.close()
+
+    return load_time, lookup_time, append_time
+
+
+def bench_legacy_json(workdir, keys, lookups, appends):
+    path = os.path.join(workdir, 'published_posts.json')
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(keys, f)
+
+    def load():
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    posts, load_time = timed(load)
+    _, lookup_time = timed(lambda: sum(key in posts for key in lookups))
+
+    start = time.perf_counter()
+    for i in range(appends):
+        posts = load()
+        posts.append(f"new_{i}")
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(posts, f)
+    append_time = time.perf_counter() - start
+
+    return load_time, lookup_time, append_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк журнала опубликованных постов')
+    parser.add_argument('--count', type=int, default=1_000_000, help='Количество опубликованных постов')
+    parser.add_argument('--lookups', type=int, default=1000, help='Количество проверок «уже опубликован»')
+    parser.add_argument('--appends', type=int, default=20, help='Количество публикаций')
+    args = parser.parse_args()
+
+    keys = [f"group{i % 50}_{i}" for i in range(args.count)]
+    # Половина проверок — промахи, как у свежих постов-кандидатов
+    lookups = random.sample(keys, args.lookups // 2) + [f"fresh_{i}" for i in range(args.lookups - args.lookups // 2)]
+
+    with tempfile.TemporaryDirectory() as workdir:
+        results = {
+            'PublishedStore': bench_store(workdir, keys, lookups, args.appends),
+            'JSON-список': bench_legacy_json(workdir, keys, lookups, args.appends),
+        }
+
+    print(f"Записей: {args.count}, проверок: {args.lookups}, публикаций: {args.appends}")
+    print(f"{'':16} {'загрузка, с':>12} {'проверки, с':>12} {'публикация, мс':>16}")
+    for name, (load_time, lookup_time, append_time) in results.items():
+        print(f"{name:16} {load_time:12.3f} {lookup_time:12.4f} {append_time / args.appends * 1000:16.2f}")
+
+
+if __name__ == '__main__':
+    main()
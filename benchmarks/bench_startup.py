@@ -0,0 +1,156 @@
+"""
+Бенчмарк холодного запуска: время импорта vk_tg_parser, время от запуска
+процесса до первого запроса к VK API и RSS в эти моменты.
+
+Каждый замер — отдельный процесс `python vk_tg_parser.py --test` во
+временной директории. VK API подменяет локальный сервер, который
+отвечает пустыми стенами, поэтому тестовый запуск завершается без
+скачиваний и публикаций. С --compare REF то же самое замеряется для
+ревизии REF (выгружается через git archive) — так видно, что дала
+оптимизация запуска.
+
+Нужен ffmpeg (парсер проверяет его при запуске), как и для обычной работы.
+RSS читается из /proc, поэтому на системах без него выводится «н/д».
+
+Запуск из корня проекта:
+    python benchmarks/bench_startup.py [--runs 5] [--compare HEAD~1]
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+from aiohttp import web
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Код дочернего процесса: импорт модуля с замером и обычный запуск main() в тестовом режиме
+CHILD_CODE = '''
+import sys, time, json
+started = time.perf_counter()
+sys.path.insert(0, sys.argv[1])
+import vk_tg_parser as parser
+import_seconds = time.perf_counter() - started
+try:
+    with open('/proc/self/status') as f:
+        rss_kb = next((int(line.split()[1]) for line in f if line.startswith('VmRSS:')), None)
+except OSError:
+    rss_kb = None
+print(json.dumps({'import_seconds': import_seconds, 'import_rss_kb': rss_kb}), flush=True)
+parser.VK_API_URL = sys.argv[2] + '/method'
+parser.TELEGRAM_API_URL = sys.argv[2]
+sys.argv = ['vk_tg_parser.py', '--test']
+parser.main()
+'''
+
+
+class FakeVk:
+    """VK API с пустыми стенами; запоминает момент первого запроса и RSS процесса в этот момент"""
+
+    def __init__(self):
+        self.process = None
+        self.first_request = None
+        self.first_request_rss_kb = None
+        self.base_url = None
+        self.runner = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post('/method/execute', self.execute)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, '127.0.0.1', 0).start()
+        self.base_url = f'http://127.0.0.1:{self.runner.addresses[0][1]}'
+
+    async def execute(self, request):
+        if self.first_request is None:
+            self.first_request = time.perf_counter()
+            self.first_request_rss_kb = process_rss_kb(self.process.pid)
+        data = await request.post()
+        calls = data['code'].count('API.wall.get(')
+        return web.json_response({'response': [{'count': 0, 'items': []}] * calls})
+
+
+def process_rss_kb(pid):
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            return next((int(line.split()[1]) for line in f if line.startswith('VmRSS:')), None)
+    except OSError:
+        return None
+
+
+async def measure_once(tree, fake_vk):
+    with tempfile.TemporaryDirectory() as workdir:
+        env = dict(os.environ, VK_TOKEN='bench', TELEGRAM_BOT_TOKEN='0:bench', TELEGRAM_CHANNEL_ID='@bench')
+        fake_vk.first_request = fake_vk.first_request_rss_kb = None
+        started = time.perf_counter()
+        fake_vk.process = await asyncio.create_subprocess_exec(
+            sys.executable, '-c', CHILD_CODE, tree, fake_vk.base_url,
+            cwd=workdir, env=env, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+        )
+        stdout, _ = await fake_vk.process.communicate()
+        total = time.perf_counter() - started
+
+    result = json.loads(stdout.decode().splitlines()[0])
+    result['total_seconds'] = total
+    result['first_request_seconds'] = fake_vk.first_request - started if fake_vk.first_request else None
+    result['first_request_rss_kb'] = fake_vk.first_request_rss_kb
+    return result
+
+
+def median(results, key):
+    values = [result[key] for result in results if result[key] is not None]
+    return statistics.median(values) if values else None
+
+
+def export_revision(ref, directory):
+    """Выгрузка файлов ревизии ref во временную директорию"""
+    archive = subprocess.run(['git', '-C', ROOT, 'archive', ref], capture_output=True, check=True).stdout
+    subprocess.run(['tar', '-x', '-C', directory], input=archive, check=True)
+    return directory
+
+
+async def run(args):
+    fake_vk = FakeVk()
+    await fake_vk.start()
+
+    with tempfile.TemporaryDirectory() as refdir:
+        trees = {'текущая': ROOT}
+        if args.compare:
+            trees[args.compare] = export_revision(args.compare, refdir)
+
+        rows = {}
+        for label, tree in trees.items():
+            # Первый запуск прогревает кэш байткода и файловый кэш, в замер не входит
+            await measure_once(tree, fake_vk)
+            rows[label] = [await measure_once(tree, fake_vk) for _ in range(args.runs)]
+
+    await fake_vk.runner.cleanup()
+
+    def fmt(value, scale=1, digits=2):
+        return f"{value / scale:.{digits}f}" if value is not None else 'н/д'
+
+    print(f"Медиана по {args.runs} запускам")
+    print(f"{'ревизия':12} {'импорт, с':>10} {'RSS, МБ':>8} {'до VK, с':>9} {'RSS у VK, МБ':>13} {'--test, с':>10}")
+    for label, results in rows.items():
+        print(f"{label:12} {fmt(median(results, 'import_seconds')):>10} "
+              f"{fmt(median(results, 'import_rss_kb'), 1024, 1):>8} "
+              f"{fmt(median(results, 'first_request_seconds')):>9} "
+              f"{fmt(median(results, 'first_request_rss_kb'), 1024, 1):>13} "
+              f"{fmt(median(results, 'total_seconds')):>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк холодного запуска парсера')
+    parser.add_argument('--runs', type=int, default=5, help='Запусков на каждую ревизию')
+    parser.add_argument('--compare', metavar='REF', help='Ревизия git для сравнения, например HEAD~1')
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+"""
+Бенчмарк подготовки видео: ffmpeg-движок transcode.py против прежнего
+пути через moviepy (write_videofile с preset='medium', threads=2 и
+повторным сжатием с уменьшением разрешения).
+
+Без --clips генерирует синтетические ролики ffmpeg (lavfi). Для прежнего
+пути нужен moviepy (pip install moviepy==1.0.3); без него замеряется
+только ffmpeg-движок.
+
+Запуск из корня проекта:
+    python benchmarks/bench_transcode.py [--clips DIR] [--limit-mb 45]
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from transcode import run_ffmpeg, transcode_for_telegram
+
+# Синтетические ролики: имя, длительность (с), размер кадра, битрейт видео, кодек
+SYNTHETIC_CLIPS = (
+    ('small_h264.mp4', 10, '640x360', '1500k', 'libx264'),
+    ('large_h264.mp4', 30, '1280x720', '16000k', 'libx264'),
+    ('mpeg4.avi', 15, '854x480', '3000k', 'mpeg4'),
+)
+
+
+def generate_clips(directory):
+    for name, duration, size, bitrate, codec in SYNTHETIC_CLIPS:
+        run_ffmpeg(['-f', 'lavfi', '-i', f'testsrc2=duration={duration}:size={size}:rate=30',
+                    '-f', 'lavfi', '-i', f'sine=duration={duration}',
+                    '-c:v', codec, '-b:v', bitrate, '-c:a', 'aac', '-shortest',
+                    os.path.join(directory, name)])
+
+
+def cpu_seconds():
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+def moviepy_path(src, dst, limit_mb):
+    """Прежние convert_to_mp4 + compress_video"""
+    from moviepy.editor import VideoFileClip
+
+    if not src.lower().endswith('.mp4'):
+        converted = os.path.splitext(dst)[0] + '_converted.mp4'
+        clip = VideoFileClip(src)
+        clip.write_videofile(converted, codec='libx264', audio_codec='aac', preset='medium',
+                             threads=2, logger=None)
+        clip.close()
+        src = converted
+
+    file_size = os.path.getsize(src) / (1024 * 1024)
+    if file_size < limit_mb:
+        return src
+
+    target_bitrate = '1000k' if file_size > 200 else '1500k' if file_size > 100 else '2000k'
+    clip = VideoFileClip(src)
+    clip.write_videofile(dst, codec='libx264', bitrate=target_bitrate, audio_codec='aac',
+                         audio_bitrate='128k', preset='medium', threads=2, logger=None)
+    clip.close()
+
+    if os.path.getsize(dst) / (1024 * 1024) > limit_mb:
+        clip = VideoFileClip(src)
+        clip_resized = clip.resize(0.5)
+        clip_resized.write_videofile(dst, codec='libx264', bitrate='800k', audio_codec='aac',
+                                     audio_bitrate='96k', preset='medium', threads=2, logger=None)
+        clip.close()
+        clip_resized.close()
+    return dst
+
+
+def ffmpeg_path(src, dst, limit_mb):
+    return transcode_for_telegram(src, dst, int(limit_mb * 1024 * 1024))
+
+
+def measure(func, src, dst, limit_mb):
+    wall_start, cpu_start = time.perf_counter(), cpu_seconds()
+    result = func(src, dst, limit_mb)
+    return time.perf_counter() - wall_start, cpu_seconds() - cpu_start, os.path.getsize(result)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк подготовки видео для Telegram')
+    parser.add_argument('--clips', help='Директория с роликами (по умолчанию — синтетические)')
+    parser.add_argument('--limit-mb', type=float, default=45, help='Лимит размера в МБ')
+    args = parser.parse_args()
+
+    try:
+        import moviepy.editor  # noqa: F401
+        paths = {'moviepy': moviepy_path, 'ffmpeg': ffmpeg_path}
+    except ImportError:
+        print("moviepy не установлен, замеряется только ffmpeg-движок")
+        paths = {'ffmpeg': ffmpeg_path}
+
+    with tempfile.TemporaryDirectory() as workdir:
+        clips_dir = args.clips
+        if not clips_dir:
+            clips_dir = os.path.join(workdir, 'clips')
+            os.makedirs(clips_dir)
+            generate_clips(clips_dir)
+            # Для синтетики лимит уменьшен, чтобы «большой» ролик требовал сжатия
+            args.limit_mb = min(args.limit_mb, 20)
+
+        print(f"Лимит: {args.limit_mb} МБ")
+        print(f"{'ролик':20} {'МБ':>7} {'путь':8} {'время, с':>9} {'CPU, с':>8} {'итог, МБ':>9}")
+        for name in sorted(os.listdir(clips_dir)):
+            src = os.path.join(clips_dir, name)
+            size_mb = os.path.getsize(src) / (1024 * 1024)
+            for label, func in paths.items():
+                dst = os.path.join(workdir, f'{label}_{os.path.splitext(name)[0]}.mp4')
+                try:
+                    wall, cpu, result_size = measure(func, src, dst, args.limit_mb)
+                    print(f"{name:20} {size_mb:7.1f} {label:8} {wall:9.2f} {cpu:8.2f} "
+                          f"{result_size / (1024 * 1024):9.1f}")
+                except Exception as e:
+                    print(f"{name:20} {size_mb:7.1f} {label:8} ошибка: {e}")
+
+
+if __name__ == '__main__':
+    main()
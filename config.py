@@ -9,6 +9,9 @@ VK_TOKEN = os.getenv('VK_TOKEN')
 TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 TELEGRAM_CHANNEL_ID = os.getenv('TELEGRAM_CHANNEL_ID')
 
+# Адрес Bot API (можно заменить на локальный сервер Bot API)
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL', 'https://api.telegram.org')
+
 # Список групп ВКонтакте для парсинга (указывать без '@' и 'public')
 # Например: 'group_name' или числовой ID группы
 VK_GROUPS = [
@@ -18,14 +21,130 @@ VK_GROUPS = [
     'retsepty_video', # Видео-рецепты
 ]
 
+# Каналы Телеграм для отдельных групп: {группа: [каналы]}. Посты групп, которых
+# здесь нет, публикуются в TELEGRAM_CHANNEL_ID. Видео загружается один раз,
+# в остальные каналы оно отправляется по file_id без повторной загрузки
+# Например: {'box_tea': ['@tea_channel', '@food_channel']}
+CHANNEL_ROUTES = {}
+
 # Настройки времени публикации (по МСК)
 POSTING_TIMES = ['10:00', '13:00', '16:00', '19:00']
 
 # Дата, с которой начинать поиск постов
 START_DATE = '2025-01-01'
 
+# Выбор поста для публикации: свежие и небольшие видео выбираются чаще. Вес поста
+# удваивается за каждые FRESHNESS_HALF_LIFE_DAYS дней свежести
+FRESHNESS_HALF_LIFE_DAYS = 30
+
+# Доли групп в публикациях: {группа: вес}. Группы, которых здесь нет, имеют вес 1,
+# вес 0 отключает публикацию группы. Доли выравниваются по публикациям
+# за последние GROUP_QUOTA_WINDOW_DAYS дней
+# Например: {'box_tea': 2, 'recepticys': 0.5}
+GROUP_WEIGHTS = {}
+GROUP_QUOTA_WINDOW_DAYS = 7
+
+# Пост, который не удалось скачать или сжать, откладывается на CANDIDATE_RETRY_HOURS часов
+# (вдвое дольше с каждой неудачей) и пропускается после CANDIDATE_MAX_FAILURES неудач
+CANDIDATE_RETRY_HOURS = 6
+CANDIDATE_MAX_FAILURES = 3
+
 # Директория для временного хранения видео
 TEMP_DIR = 'temp_videos'
 
-# Максимальное количество постов для кэширования
-MAX_CACHED_POSTS = 100 
\ No newline at end of file
+# Максимальное количество вызовов wall.get в одном запросе execute (лимит VK — 25)
+VK_EXECUTE_BATCH_SIZE = 25
+
+# Количество постов, запрашиваемых за один вызов wall.get (максимум VK — 100)
+VK_PAGE_SIZE = 100
+
+# Максимальное количество страниц новых постов за одно обновление
+VK_MAX_NEW_PAGES = 10
+
+# Интервал фоновой догрузки старых постов (до START_DATE) в минутах
+BACKFILL_INTERVAL_MINUTES = 15
+
+# Интервал обновления локального индекса постов (новые посты из групп) в минутах
+CRAWL_INTERVAL_MINUTES = 30
+
+# Количество постов, которые готовятся заранее (скачаны, сжаты и проверены)
+PREFETCH_COUNT = 2
+
+# Максимальный объем кэша заранее подготовленных видео на диске (в МБ): при превышении
+# удаляются давно не использованные видео
+PREFETCH_DISK_BUDGET_MB = 300
+
+# Через сколько часов подготовленное, но не опубликованное видео удаляется
+PREFETCH_MAX_AGE_HOURS = 24
+
+# Количество потоков, параллельно скачивающих и обрабатывающих видео
+DOWNLOAD_WORKERS = 3
+
+# Сколько вложений одного поста (видео и фото альбома) скачивается и обрабатывается параллельно
+ALBUM_WORKERS = 4
+
+# Максимальное количество одновременных скачиваний с одного хоста
+DOWNLOAD_PER_HOST_LIMIT = 2
+
+# Количество попыток скачивания при временных ошибках (сеть, таймауты)
+DOWNLOAD_RETRIES = 3
+
+# Задержка перед повторной попыткой скачивания в секундах (удваивается с каждой попыткой)
+DOWNLOAD_RETRY_DELAY_SECONDS = 10
+
+# Ограничение скорости скачивания одного видео в КБ/с (0 — без ограничения)
+DOWNLOAD_RATE_LIMIT_KB = 0
+
+# Путь к ffmpeg (по умолчанию ищется в PATH)
+FFMPEG_BINARY = os.getenv('FFMPEG_BINARY', 'ffmpeg')
+
+# Пресет libx264 при перекодировании: быстрее — меньше нагрузка на процессор, но больше размер
+TRANSCODE_PRESET = 'veryfast'
+
+# Передавать видео, которое уже подходит для Telegram (MP4 H.264/AAC в пределах лимита),
+# потоком из источника прямо в загрузку, без временного файла
+STREAM_UPLOADS = True
+
+# Таймаут загрузки видео в Telegram в секундах
+TELEGRAM_UPLOAD_TIMEOUT_SECONDS = 300
+
+# Версия API ВКонтакте
+VK_API_VERSION = '5.131'
+
+# Сколько видео перекодируется одновременно (ffmpeg и так использует все ядра)
+TRANSCODE_WORKERS = 1
+
+# Размер пула HTTP-соединений к VK и Bot API
+HTTP_POOL_SIZE = 20
+
+# Кэш file_id загруженных в Telegram видео: срок хранения записи в днях и максимум записей
+FILE_ID_CACHE_MAX_AGE_DAYS = 30
+FILE_ID_CACHE_MAX_ENTRIES = 10000
+
+# Лимиты частоты отправки в Telegram: сообщений в секунду на бота и в минуту на канал
+TELEGRAM_MESSAGES_PER_SECOND = 25
+TELEGRAM_CHANNEL_MESSAGES_PER_MINUTE = 20
+
+# Очередь отправки: максимум постов в очереди, число попыток и начальная задержка повтора в секундах
+OUTBOX_MAX_SIZE = 10
+OUTBOX_MAX_ATTEMPTS = 8
+OUTBOX_RETRY_DELAY_SECONDS = 30
+
+# Пакетный режим (--backfill N, --drain): размер очередей между стадиями и интервал отчета в секундах
+BATCH_QUEUE_SIZE = 4
+BATCH_PROGRESS_INTERVAL_SECONDS = 10
+
+# Локальный HTTP-сервер замеров: /metrics (формат Prometheus) и /health (проверка работы).
+# На Render укажите METRICS_HOST=0.0.0.0 и METRICS_PORT равным PORT сервиса; 0 — сервер отключен
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9108'))
+
+# Несколько процессов парсера (на одной машине или на нескольких с общей рабочей директорией)
+# делят задачи через общую очередь jobs.db. WORKER_ID — имя процесса в очереди, по умолчанию
+# имя хоста и PID; у одновременно работающих процессов оно должно различаться
+WORKER_ID = os.getenv('WORKER_ID', '')
+
+# Процесс берет задачу в аренду на WORKER_LEASE_SECONDS секунд и продлевает ее, пока работает.
+# Задачу остановившегося процесса берет другой, всего не больше JOB_MAX_ATTEMPTS раз
+WORKER_LEASE_SECONDS = 120
+JOB_MAX_ATTEMPTS = 3
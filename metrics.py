@@ -0,0 +1,152 @@
+import time
+import threading
+from contextlib import contextmanager
+
+# Границы гистограммы длительности этапов (в секундах)
+DURATION_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+# Границы гистограммы отношения размера после сжатия к исходному
+RATIO_BUCKETS = (0.1, 0.25, 0.5, 0.75, 0.9, 1.0, 1.5)
+
+
+class Histogram:
+    """Накопительная гистограмма в формате Prometheus: счетчики по границам, сумма и количество"""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+
+class StageMetrics:
+    """
+    Замеры этапов конвейера: длительность, байты на входе и выходе,
+    степень сжатия видео и ошибки по классам.
+
+    Этап оборачивается в `with metrics.stage('download') as record:`;
+    внутри можно заполнить record['bytes_in'] и record['bytes_out'].
+    Исключение внутри блока учитывается как ошибка этапа и пробрасывается
+    дальше. Замеры пишутся из потоков пулов и из event loop, поэтому все
+    изменения выполняются под блокировкой.
+    """
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.durations = {}
+        self.bytes_in = {}
+        self.bytes_out = {}
+        self.errors = {}
+        self.transcode_ratio = Histogram(RATIO_BUCKETS)
+        self.counters = {}
+        self.gauges = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name):
+        record = {'bytes_in': 0, 'bytes_out': 0}
+        started = time.perf_counter()
+        try:
+            yield record
+        except BaseException as e:
+            self.observe(name, time.perf_counter() - started, record['bytes_in'], record['bytes_out'],
+                         error=type(e).__name__)
+            raise
+        self.observe(name, time.perf_counter() - started, record['bytes_in'], record['bytes_out'],
+                     error=record.get('error'))
+
+    def observe(self, name, seconds, bytes_in=0, bytes_out=0, error=None):
+        """Учет одного выполнения этапа (error — класс ошибки, если этап не удался)"""
+        with self.lock:
+            self.durations.setdefault(name, Histogram(DURATION_BUCKETS)).observe(seconds)
+            self.bytes_in[name] = self.bytes_in.get(name, 0) + bytes_in
+            self.bytes_out[name] = self.bytes_out.get(name, 0) + bytes_out
+            if error:
+                key = (name, error)
+                self.errors[key] = self.errors.get(key, 0) + 1
+
+    def observe_ratio(self, ratio):
+        """Отношение размера видео после обработки к исходному"""
+        with self.lock:
+            self.transcode_ratio.observe(ratio)
+
+    def inc(self, name, value=1):
+        """Увеличение произвольного счетчика"""
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def gauge(self, name, func, help_text):
+        """Показатель, значение которого вычисляется func в момент запроса /metrics"""
+        self.gauges[name] = (func, help_text)
+
+    def summary(self):
+        """Краткие итоги по этапам для лога: количество, средняя длительность, объем и ошибки"""
+        lines = []
+        with self.lock:
+            for name, histogram in sorted(self.durations.items()):
+                errors = sum(value for (stage, _), value in self.errors.items() if stage == name)
+                lines.append(
+                    f"{name}: {histogram.count} раз, в среднем {histogram.sum / histogram.count:.2f} с, "
+                    f"вход {self.bytes_in[name] / (1024 * 1024):.1f} МБ, "
+                    f"выход {self.bytes_out[name] / (1024 * 1024):.1f} МБ, ошибок {errors}"
+                )
+        return lines
+
+    def render(self):
+        """Все замеры в текстовом формате Prometheus"""
+        p = self.prefix
+        lines = []
+        with self.lock:
+            lines += [f'# HELP {p}_stage_duration_seconds Длительность этапа конвейера',
+                      f'# TYPE {p}_stage_duration_seconds histogram']
+            for name, histogram in sorted(self.durations.items()):
+                lines += render_histogram(f'{p}_stage_duration_seconds', histogram, f'stage="{name}"')
+
+            for metric, values, help_text in (
+                ('stage_bytes_in_total', self.bytes_in, 'Байт на входе этапа'),
+                ('stage_bytes_out_total', self.bytes_out, 'Байт на выходе этапа'),
+            ):
+                lines += [f'# HELP {p}_{metric} {help_text}', f'# TYPE {p}_{metric} counter']
+                lines += [f'{p}_{metric}{{stage="{name}"}} {value}' for name, value in sorted(values.items())]
+
+            lines += [f'# HELP {p}_stage_errors_total Ошибки этапа по классам',
+                      f'# TYPE {p}_stage_errors_total counter']
+            lines += [f'{p}_stage_errors_total{{stage="{name}",error="{error}"}} {value}'
+                      for (name, error), value in sorted(self.errors.items())]
+
+            lines += [f'# HELP {p}_transcode_ratio Отношение размера видео после обработки к исходному',
+                      f'# TYPE {p}_transcode_ratio histogram']
+            lines += render_histogram(f'{p}_transcode_ratio', self.transcode_ratio)
+
+            for name, value in sorted(self.counters.items()):
+                lines += [f'# TYPE {p}_{name} counter', f'{p}_{name} {value}']
+
+        for name, (func, help_text) in sorted(self.gauges.items()):
+            try:
+                value = func()
+            except Exception:
+                continue
+            if value is None:
+                continue
+            lines += [f'# HELP {p}_{name} {help_text}', f'# TYPE {p}_{name} gauge', f'{p}_{name} {value}']
+
+        return '\n'.join(lines) + '\n'
+
+
+def render_histogram(name, histogram, labels=''):
+    """Строки гистограммы: накопительные счетчики по границам, +Inf, сумма и количество"""
+    separator = ',' if labels else ''
+    lines = [f'{name}_bucket{{{labels}{separator}le="{bound}"}} {count}'
+             for bound, count in zip(histogram.buckets, histogram.counts)]
+    lines.append(f'{name}_bucket{{{labels}{separator}le="+Inf"}} {histogram.count}')
+    suffix = f'{{{labels}}}' if labels else ''
+    lines.append(f'{name}_sum{suffix} {histogram.sum:.6f}')
+    lines.append(f'{name}_count{suffix} {histogram.count}')
+    return lines
@@ -0,0 +1,854 @@
+import os
+import json
+import time
+import logging
+import sqlite3
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+def group_key(group_id):
+    """Ключ группы в базе (короткое имя или числовой ID в виде строки)"""
+    return str(group_id)
+
+
+def group_from_key(key):
+    """Обратное преобразование ключа группы: числовые ID возвращаются как int"""
+    return int(key) if key.isdigit() else key
+
+
+class CandidateStore:
+    """
+    Локальный индекс найденных постов с видео и состояния обхода стен групп.
+
+    Краулер заполняет таблицу posts, а публикация выбирает из нее
+    неопубликованный пост без обращений к VK. У каждого поста есть
+    приоритет score (свежесть и стоимость подготовки), поэтому лучшие
+    кандидаты группы — это чтение начала индекса (group_id, published, score).
+    """
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS posts (
+            id TEXT PRIMARY KEY,
+            group_id TEXT NOT NULL,
+            date INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            video_urls TEXT NOT NULL,
+            video_keys TEXT NOT NULL DEFAULT '[]',
+            published INTEGER NOT NULL DEFAULT 0,
+            added_at INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_posts_group_date ON posts (group_id, date);
+
+        CREATE TABLE IF NOT EXISTS crawl_state (
+            group_id TEXT PRIMARY KEY,
+            last_id INTEGER NOT NULL,
+            last_date INTEGER NOT NULL,
+            total INTEGER NOT NULL,
+            backfill_offset INTEGER NOT NULL,
+            backfill_done INTEGER NOT NULL,
+            backfill_until INTEGER NOT NULL
+        );
+    '''
+
+    # Колонки, добавленные после появления базы, и их определения
+    MIGRATIONS = {
+        'video_keys': "TEXT NOT NULL DEFAULT '[]'",
+        'prepared_path': 'TEXT',
+        'prepared_at': 'INTEGER',
+        'prepared_size': 'INTEGER',
+        'media_keys': "TEXT NOT NULL DEFAULT '[]'",
+        'duration': 'INTEGER',
+        'est_size': 'INTEGER',
+        'score': 'REAL',
+        'failures': 'INTEGER NOT NULL DEFAULT 0',
+        'retry_at': 'INTEGER',
+        'published_at': 'INTEGER',
+        'attachments': "TEXT NOT NULL DEFAULT '[]'",
+        'prepared_media': "TEXT NOT NULL DEFAULT '[]'",
+    }
+
+    # Значения поля published
+    PENDING = 0
+    PUBLISHED = 1
+    SKIPPED = 2
+
+    CRAWL_FIELDS = ('last_id', 'last_date', 'total', 'backfill_offset', 'backfill_done', 'backfill_until')
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript(self.SCHEMA)
+        # Старая колонка pick_key, которую SQLite ниже 3.35 не умеет удалять (NOT NULL без значения по умолчанию)
+        self.legacy_pick_key = False
+        self._migrate()
+
+    def _migrate(self):
+        # Процессы парсера могут запускаться одновременно: проверка и добавление колонок — одна транзакция
+        self.db.execute('BEGIN IMMEDIATE')
+        with self.db:
+            columns = {row['name'] for row in self.db.execute('PRAGMA table_info(posts)')}
+            for column, definition in self.MIGRATIONS.items():
+                if column not in columns:
+                    self.db.execute(f'ALTER TABLE posts ADD COLUMN {column} {definition}')
+            self.db.execute('CREATE INDEX IF NOT EXISTS idx_posts_prepared '
+                            'ON posts (prepared_at) WHERE prepared_path IS NOT NULL')
+            # Случайный выбор по pick_key заменен выбором по score
+            self.db.execute('DROP INDEX IF EXISTS idx_posts_pick')
+            if 'pick_key' in columns:
+                try:
+                    self.db.execute('ALTER TABLE posts DROP COLUMN pick_key')
+                except sqlite3.OperationalError:
+                    self.legacy_pick_key = True
+            self.db.execute('CREATE INDEX IF NOT EXISTS idx_posts_score ON posts (group_id, published, score)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS idx_posts_published_at '
+                            'ON posts (published_at) WHERE published_at IS NOT NULL')
+
+    def load_crawl_state(self):
+        """Состояние обхода всех групп в виде словаря {ключ группы: состояние}"""
+        with self.lock:
+            rows = self.db.execute('SELECT * FROM crawl_state').fetchall()
+        groups = {}
+        for row in rows:
+            group_state = {field: row[field] for field in self.CRAWL_FIELDS}
+            group_state['backfill_done'] = bool(group_state['backfill_done'])
+            groups[row['group_id']] = group_state
+        return groups
+
+    def save_crawl(self, groups_state, posts):
+        """
+        Сохранение состояния обхода и найденных постов одной транзакцией.
+        Возвращает количество действительно новых постов.
+        """
+        columns = ['id', 'group_id', 'date', 'text', 'video_urls', 'video_keys', 'added_at',
+                   'duration', 'est_size', 'score', 'attachments']
+        now = int(time.time())
+        rows = [(post['id'], group_key(post['group']), post['date'], post['text'],
+                 json.dumps(post['video_urls']), json.dumps(post.get('video_keys', [])),
+                 now, post.get('duration'), post.get('est_size'), post.get('score'),
+                 json.dumps(post.get('attachments', []), ensure_ascii=False))
+                for post in posts]
+        if self.legacy_pick_key:
+            columns.append('pick_key')
+            rows = [(*row, 0) for row in rows]
+        with self.lock, self.db:
+            self.db.executemany(
+                f'''INSERT OR REPLACE INTO crawl_state (group_id, {', '.join(self.CRAWL_FIELDS)})
+                    VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                [(key, *(int(state[field]) for field in self.CRAWL_FIELDS))
+                 for key, state in groups_state.items()]
+            )
+            before = self.db.total_changes
+            self.db.executemany(
+                f'''INSERT OR IGNORE INTO posts ({', '.join(columns)})
+                    VALUES ({', '.join('?' * len(columns))})''',
+                rows
+            )
+            return self.db.total_changes - before
+
+    def top_unpublished(self, group, limit, exclude=()):
+        """
+        Лучшие по score неопубликованные и не подготовленные посты группы,
+        кроме отложенных после неудачи и перечисленных в exclude. Читается
+        начало индекса (group_id, published, score), без сортировки таблицы.
+        """
+        query = '''SELECT * FROM posts
+                   WHERE group_id = ? AND published = 0 AND prepared_path IS NULL
+                     AND (retry_at IS NULL OR retry_at <= ?)'''
+        params = [group_key(group), int(time.time())]
+        if exclude:
+            query += f" AND id NOT IN ({', '.join('?' * len(exclude))})"
+            params.extend(exclude)
+        query += ' ORDER BY score DESC LIMIT ?'
+        params.append(limit)
+
+        with self.lock:
+            rows = self.db.execute(query, params).fetchall()
+        return [self._row_to_post(row) for row in rows]
+
+    def record_failure(self, post_id, retry_at, penalty):
+        """
+        Учет неудачной подготовки поста: пост откладывается до retry_at, а его
+        score уменьшается на penalty. Возвращает число неудач поста.
+        """
+        with self.lock, self.db:
+            self.db.execute(
+                'UPDATE posts SET failures = failures + 1, retry_at = ?, score = score - ? WHERE id = ?',
+                (int(retry_at), penalty, post_id)
+            )
+            row = self.db.execute('SELECT failures FROM posts WHERE id = ?', (post_id,)).fetchone()
+        return row['failures'] if row else 0
+
+    def recent_published_counts(self, since):
+        """Количество постов, опубликованных после since, по группам: {ключ группы: количество}"""
+        with self.lock:
+            rows = self.db.execute(
+                'SELECT group_id, COUNT(*) AS count FROM posts WHERE published_at >= ? GROUP BY group_id',
+                (int(since),)
+            ).fetchall()
+        return {row['group_id']: row['count'] for row in rows}
+
+    def fill_missing_scores(self, score_func):
+        """
+        Расчет score для постов, добавленных до появления приоритетов.
+        Возвращает количество обновленных постов.
+        """
+        with self.lock:
+            rows = self.db.execute('SELECT * FROM posts WHERE score IS NULL AND published = 0').fetchall()
+        if not rows:
+            return 0
+        updates = [(score_func(self._row_to_post(row)), row['id']) for row in rows]
+        with self.lock, self.db:
+            self.db.executemany('UPDATE posts SET score = ? WHERE id = ?', updates)
+        return len(updates)
+
+    def list_unpublished(self, groups=None, unprepared_only=False, ready_only=False):
+        """
+        Все неопубликованные посты, от старых к новым. ready_only — без постов,
+        отложенных после неудачи (retry_at еще не наступил)
+        """
+        query = 'SELECT * FROM posts WHERE published = 0'
+        params = []
+        if unprepared_only:
+            query += ' AND prepared_path IS NULL'
+        if ready_only:
+            query += ' AND (retry_at IS NULL OR retry_at <= ?)'
+            params.append(int(time.time()))
+        if groups is not None:
+            keys = [group_key(group) for group in groups]
+            query += f" AND group_id IN ({', '.join('?' * len(keys))})"
+            params.extend(keys)
+        query += ' ORDER BY date'
+
+        with self.lock:
+            rows = self.db.execute(query, params).fetchall()
+        return [self._row_to_post(row) for row in rows]
+
+    def mark_published(self, post_id):
+        """Отметка поста как опубликованного; время публикации учитывается в долях групп"""
+        with self.lock, self.db:
+            self.db.execute('UPDATE posts SET published = ?, published_at = ? WHERE id = ?',
+                            (self.PUBLISHED, int(time.time()), post_id))
+
+    def mark_skipped(self, post_id):
+        """Отметка поста как пропущенного (например, видео уже публиковалось)"""
+        self._set_state(post_id, self.SKIPPED)
+
+    def _set_state(self, post_id, state):
+        with self.lock, self.db:
+            self.db.execute('UPDATE posts SET published = ? WHERE id = ?', (state, post_id))
+
+    def set_prepared(self, post_id, media, media_keys):
+        """
+        Сохранение заранее подготовленных вложений поста: media — список
+        {'type', 'path', 'keys'} в порядке поста, путь первого вложения
+        хранится и в prepared_path. У видео, подготовленного по file_id из
+        кэша, файла нет: path None, а prepared_path — пустая строка.
+        """
+        with self.lock, self.db:
+            self.db.execute(
+                '''UPDATE posts SET prepared_path = ?, prepared_media = ?, prepared_at = ?, prepared_size = ?,
+                                    media_keys = ?
+                   WHERE id = ?''',
+                (media[0]['path'] or '', json.dumps(media, ensure_ascii=False), int(time.time()),
+                 sum(os.path.getsize(item['path']) for item in media if item['path']), json.dumps(media_keys),
+                 post_id)
+            )
+
+    def clear_prepared(self, post_id):
+        """Сброс отметки о подготовленном видео"""
+        with self.lock, self.db:
+            self.db.execute(
+                '''UPDATE posts SET prepared_path = NULL, prepared_media = '[]', prepared_at = NULL,
+                                    prepared_size = NULL
+                   WHERE id = ?''',
+                (post_id,)
+            )
+
+    def list_prepared(self):
+        """Неопубликованные посты с подготовленным видео, от самых старых"""
+        with self.lock:
+            rows = self.db.execute(
+                '''SELECT * FROM posts WHERE prepared_path IS NOT NULL AND published = 0
+                   ORDER BY prepared_at'''
+            ).fetchall()
+        return [self._row_to_post(row) for row in rows]
+
+    def prepared_paths(self):
+        """Пути ко всем файлам, отмеченным как подготовленные (у альбомов — всех вложений)"""
+        with self.lock:
+            rows = self.db.execute(
+                'SELECT prepared_path, prepared_media FROM posts WHERE prepared_path IS NOT NULL'
+            ).fetchall()
+        paths = set()
+        for row in rows:
+            paths.add(row['prepared_path'])
+            paths.update(item['path'] for item in json.loads(row['prepared_media']))
+        return paths
+
+    def count_unpublished(self):
+        """Количество неопубликованных постов в индексе"""
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM posts WHERE published = 0').fetchone()[0]
+
+    @staticmethod
+    def _row_to_post(row):
+        video_urls = json.loads(row['video_urls'])
+        video_keys = json.loads(row['video_keys'])
+        return {
+            'id': row['id'],
+            'text': row['text'],
+            'video_urls': video_urls,
+            'video_keys': video_keys,
+            # У постов, добавленных до появления колонки, известны только видео
+            'attachments': json.loads(row['attachments']) or [
+                {'type': 'video', 'url': url, 'key': key}
+                for url, key in zip(video_urls, video_keys or [None] * len(video_urls))
+            ],
+            'date': row['date'],
+            'group': group_from_key(row['group_id']),
+            'prepared_path': row['prepared_path'],
+            'prepared_media': json.loads(row['prepared_media']),
+            'prepared_at': row['prepared_at'],
+            'prepared_size': row['prepared_size'],
+            'media_keys': json.loads(row['media_keys']),
+            'duration': row['duration'],
+            'est_size': row['est_size'],
+            'score': row['score'],
+            'failures': row['failures'],
+        }
+
+
+class PublishedStore:
+    """
+    Журнал опубликованных постов: одна запись на строку, только дозапись.
+
+    При первом обращении журнал читается в множество, поэтому проверка
+    «уже опубликован» выполняется за O(1), а новая запись — это дозапись
+    одной строки с fsync, без перезаписи всего файла. Оборванная при сбое
+    последняя строка отбрасывается при следующем запуске. Чтение отложено
+    до первого обращения, чтобы большой журнал не задерживал запуск.
+    Записи, дописанные другими процессами, подхватываются вызовом refresh.
+    """
+
+    def __init__(self, path, legacy_json_path=None):
+        self.path = path
+        self.legacy_json_path = legacy_json_path
+        self.lock = threading.Lock()
+        self._keys = None
+        self.file = None
+        self.offset = 0
+
+    @property
+    def keys(self):
+        if self._keys is None:
+            with self.lock:
+                if self._keys is None:
+                    self._open()
+        return self._keys
+
+    def _open(self):
+        keys = set()
+        if os.path.exists(self.path):
+            keys = self._load()
+        elif self.legacy_json_path and os.path.exists(self.legacy_json_path):
+            keys = self._import_legacy(self.legacy_json_path)
+
+        self.file = open(self.path, 'a', encoding='utf-8')
+        self.offset = os.path.getsize(self.path)
+        self._keys = keys
+
+    def _load(self):
+        with open(self.path, 'rb') as f:
+            data = f.read()
+
+        complete = data.rfind(b'\n') + 1
+        if complete < len(data):
+            logger.warning(f"Журнал {self.path} оборван на последней записи, она будет отброшена")
+            with open(self.path, 'r+b') as f:
+                f.truncate(complete)
+
+        keys = set(data[:complete].decode('utf-8').split('\n'))
+        keys.discard('')
+        return keys
+
+    def _import_legacy(self, legacy_json_path):
+        """Перенос ключей из старого списка published_posts.json"""
+        try:
+            with open(legacy_json_path, 'r', encoding='utf-8') as f:
+                keys = [str(key) for key in json.load(f)]
+        except (OSError, json.JSONDecodeError) as e:
+            logger.warning(f"Не удалось прочитать {legacy_json_path}: {e}")
+            return set()
+
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.writelines(f"{key}\n" for key in keys)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        logger.info(f"Перенесено {len(keys)} записей из {legacy_json_path} в {self.path}")
+        return set(keys)
+
+    def refresh(self):
+        """Дочитывание записей, дописанных в журнал после его чтения (в том числе другими процессами)"""
+        keys = self.keys
+        with self.lock:
+            with open(self.path, 'rb') as f:
+                f.seek(self.offset)
+                data = f.read()
+            # Строку, которую другой процесс еще дописывает, дочитаем в следующий раз
+            complete = data.rfind(b'\n') + 1
+            if complete:
+                keys.update(data[:complete].decode('utf-8').split('\n'))
+                keys.discard('')
+                self.offset += complete
+
+    def __contains__(self, key):
+        return key in self.keys
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, key):
+        """Добавление ключа в журнал (повторное добавление игнорируется)"""
+        keys = self.keys
+        with self.lock:
+            if key in keys:
+                return
+            self.file.write(f"{key}\n")
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            keys.add(key)
+
+    def close(self):
+        with self.lock:
+            if self.file:
+                self.file.close()
+
+
+class FileIdCache:
+    """
+    Кэш file_id видео, уже загруженных в Telegram.
+
+    Одно видео хранится под несколькими ключами (ID видео ВК, хэш
+    содержимого), поэтому повторная отправка находит file_id и до
+    скачивания, и по готовому файлу. Записи старше max_age_seconds и
+    давно не использованные сверх max_entries вытесняются.
+    """
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS file_ids (
+            key TEXT PRIMARY KEY,
+            file_id TEXT NOT NULL,
+            file_size INTEGER,
+            duration INTEGER,
+            created_at INTEGER NOT NULL,
+            used_at INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_file_ids_used ON file_ids (used_at);
+        CREATE INDEX IF NOT EXISTS idx_file_ids_file_id ON file_ids (file_id);
+    '''
+
+    def __init__(self, path, max_age_seconds, max_entries):
+        self.path = path
+        self.max_age_seconds = max_age_seconds
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript(self.SCHEMA)
+
+    def get(self, keys):
+        """Запись по первому найденному ключу (file_id, file_size, duration) либо None"""
+        keys = list(keys)
+        if not keys:
+            return None
+        now = int(time.time())
+        with self.lock, self.db:
+            row = self.db.execute(
+                f'''SELECT * FROM file_ids WHERE key IN ({', '.join('?' * len(keys))}) AND created_at >= ?
+                    ORDER BY created_at DESC LIMIT 1''',
+                [*keys, now - self.max_age_seconds]
+            ).fetchone()
+            if row is None:
+                return None
+            self.db.execute('UPDATE file_ids SET used_at = ? WHERE file_id = ?', (now, row['file_id']))
+        return {'file_id': row['file_id'], 'file_size': row['file_size'], 'duration': row['duration']}
+
+    def put(self, keys, file_id, file_size=None, duration=None):
+        """Сохранение file_id под всеми ключами видео с вытеснением старых записей"""
+        now = int(time.time())
+        with self.lock, self.db:
+            self.db.executemany(
+                '''INSERT OR REPLACE INTO file_ids (key, file_id, file_size, duration, created_at, used_at)
+                   VALUES (?, ?, ?, ?, ?, ?)''',
+                [(key, file_id, file_size, duration, now, now) for key in keys]
+            )
+            self.db.execute('DELETE FROM file_ids WHERE created_at < ?', (now - self.max_age_seconds,))
+            self.db.execute(
+                '''DELETE FROM file_ids WHERE key IN
+                   (SELECT key FROM file_ids ORDER BY used_at DESC LIMIT -1 OFFSET ?)''',
+                (self.max_entries,)
+            )
+
+    def discard(self, file_id):
+        """Удаление file_id, который Telegram больше не принимает"""
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM file_ids WHERE file_id = ?', (file_id,))
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM file_ids').fetchone()[0]
+
+
+class Outbox:
+    """
+    Очередь отправки постов в Telegram, сохраняемая на диске.
+
+    Пост попадает сюда уже подготовленным (видео скачано и сжато) и
+    остается в очереди, пока не доставлен во все каналы или пока ошибки
+    не окажутся окончательными. Поэтому flood-wait, таймаут загрузки или
+    перезапуск процесса не заставляют готовить видео заново.
+    """
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS outbox (
+            post_id TEXT PRIMARY KEY,
+            post TEXT NOT NULL,
+            channels TEXT NOT NULL,
+            delivered TEXT NOT NULL DEFAULT '[]',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL,
+            last_error TEXT,
+            created_at INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_outbox_next ON outbox (next_attempt_at);
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript(self.SCHEMA)
+
+    def add(self, post, channels):
+        """Постановка поста в очередь на отправку в каналы channels"""
+        now = time.time()
+        with self.lock, self.db:
+            self.db.execute(
+                '''INSERT OR IGNORE INTO outbox (post_id, post, channels, next_attempt_at, created_at)
+                   VALUES (?, ?, ?, ?, ?)''',
+                (post['id'], json.dumps(post, ensure_ascii=False), json.dumps(channels), now, int(now))
+            )
+
+    def due(self, now=None):
+        """Посты, время отправки которых наступило, в порядке очереди"""
+        now = time.time() if now is None else now
+        with self.lock:
+            rows = self.db.execute(
+                'SELECT * FROM outbox WHERE next_attempt_at <= ? ORDER BY next_attempt_at', (now,)
+            ).fetchall()
+        return [self._row_to_item(row) for row in rows]
+
+    def reschedule(self, post_id, channels, delivered, attempts, next_attempt_at, error):
+        """Перенос отправки в оставшиеся каналы на next_attempt_at"""
+        with self.lock, self.db:
+            self.db.execute(
+                '''UPDATE outbox SET channels = ?, delivered = ?, attempts = ?, next_attempt_at = ?, last_error = ?
+                   WHERE post_id = ?''',
+                (json.dumps(channels), json.dumps(delivered), attempts, next_attempt_at, error, post_id)
+            )
+
+    def get(self, post_id):
+        """Текущее состояние поста в очереди или None, если его там уже нет"""
+        with self.lock:
+            row = self.db.execute('SELECT * FROM outbox WHERE post_id = ?', (post_id,)).fetchone()
+        return self._row_to_item(row) if row else None
+
+    def remove(self, post_id):
+        """Удаление поста из очереди"""
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM outbox WHERE post_id = ?', (post_id,))
+
+    def __contains__(self, post_id):
+        with self.lock:
+            return self.db.execute('SELECT 1 FROM outbox WHERE post_id = ?', (post_id,)).fetchone() is not None
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM outbox').fetchone()[0]
+
+    @staticmethod
+    def _row_to_item(row):
+        return {
+            'post': json.loads(row['post']),
+            'channels': json.loads(row['channels']),
+            'delivered': json.loads(row['delivered']),
+            'attempts': row['attempts'],
+            'next_attempt_at': row['next_attempt_at'],
+            'last_error': row['last_error'],
+        }
+
+
+class JobQueue:
+    """
+    Общая очередь задач и аренды для нескольких процессов парсера.
+
+    Задача (публикация в слот, обновление индекса, подготовка поста) имеет
+    уникальный ключ, поэтому процессы, одновременно поставившие одну и ту же
+    задачу, создают одну запись. Процесс берет задачу в аренду до lease_until
+    и продлевает ее, пока работает; если процесс остановился, аренда истекает
+    и задачу берет другой. Именованные аренды (таблица leases) служат
+    межпроцессными блокировками: резерв поста, доставка из очереди отправки,
+    обход стен групп. Взятие задачи выполняется в транзакции BEGIN IMMEDIATE,
+    поэтому две задачи не достаются одновременно двум процессам.
+    """
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS jobs (
+            key TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            payload TEXT NOT NULL DEFAULT '{}',
+            state INTEGER NOT NULL DEFAULT 0,
+            run_at REAL NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            lease_owner TEXT,
+            lease_until REAL,
+            last_error TEXT,
+            created_at INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_jobs_due ON jobs (state, run_at);
+
+        CREATE TABLE IF NOT EXISTS leases (
+            name TEXT PRIMARY KEY,
+            owner TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_leases_owner ON leases (owner);
+    '''
+
+    # Значения поля state
+    PENDING = 0
+    DONE = 1
+    FAILED = 2
+
+    def __init__(self, path, busy_timeout=30):
+        self.path = path
+        self.lock = threading.Lock()
+        # Транзакции открываются явно: взятие задачи должно сразу получить блокировку записи
+        self.db = sqlite3.connect(path, timeout=busy_timeout, isolation_level=None, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript(self.SCHEMA)
+
+    def enqueue(self, key, kind, payload=None, run_at=None):
+        """Постановка задачи; задача с тем же ключом не дублируется. Возвращает True, если задача новая"""
+        now = time.time()
+        with self.lock:
+            cursor = self.db.execute(
+                'INSERT OR IGNORE INTO jobs (key, kind, payload, run_at, created_at) VALUES (?, ?, ?, ?, ?)',
+                (key, kind, json.dumps(payload or {}, ensure_ascii=False), now if run_at is None else run_at,
+                 int(now))
+            )
+        return cursor.rowcount == 1
+
+    def claim(self, owner, lease_seconds, kinds, max_attempts):
+        """
+        Аренда самой ранней наступившей задачи одного из видов kinds: свободной
+        или с истекшей арендой (ее исполнитель остановился). Задача, аренда
+        которой истекла max_attempts раз, считается неудавшейся.
+        Возвращает задачу или None.
+        """
+        now = time.time()
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                self.db.execute(
+                    '''UPDATE jobs SET state = ?, last_error = 'аренда истекла', lease_owner = NULL, lease_until = NULL
+                       WHERE state = 0 AND lease_until < ? AND attempts >= ?''',
+                    (self.FAILED, now, max_attempts)
+                )
+                row = self.db.execute(
+                    f'''SELECT * FROM jobs
+                        WHERE state = 0 AND run_at <= ? AND (lease_until IS NULL OR lease_until < ?)
+                          AND kind IN ({', '.join('?' * len(kinds))})
+                        ORDER BY run_at LIMIT 1''',
+                    (now, now, *kinds)
+                ).fetchone()
+                if row is not None:
+                    self.db.execute(
+                        'UPDATE jobs SET lease_owner = ?, lease_until = ?, attempts = attempts + 1 WHERE key = ?',
+                        (owner, now + lease_seconds, row['key'])
+                    )
+                self.db.execute('COMMIT')
+            except BaseException:
+                self.db.execute('ROLLBACK')
+                raise
+        if row is None:
+            return None
+        return {'key': row['key'], 'kind': row['kind'], 'payload': json.loads(row['payload']),
+                'attempts': row['attempts'] + 1, 'run_at': row['run_at']}
+
+    def complete(self, key, owner):
+        """Отметка задачи выполненной. Возвращает False, если аренда уже перешла к другому процессу"""
+        return self._finish(key, owner, self.DONE, None)
+
+    def fail(self, key, owner, error):
+        """Отметка задачи неудавшейся (без повторов)"""
+        return self._finish(key, owner, self.FAILED, error)
+
+    def _finish(self, key, owner, state, error):
+        with self.lock:
+            cursor = self.db.execute(
+                '''UPDATE jobs SET state = ?, last_error = ?, lease_owner = NULL, lease_until = NULL
+                   WHERE key = ? AND lease_owner = ?''',
+                (state, error, key, owner)
+            )
+        return cursor.rowcount == 1
+
+    def pending(self, kind=None):
+        """Количество невыполненных задач (в том числе выполняемых сейчас)"""
+        query = 'SELECT COUNT(*) FROM jobs WHERE state = 0'
+        params = []
+        if kind is not None:
+            query += ' AND kind = ?'
+            params.append(kind)
+        with self.lock:
+            return self.db.execute(query, params).fetchone()[0]
+
+    def purge(self, before):
+        """Удаление выполненных и неудавшихся задач, созданных раньше before"""
+        with self.lock:
+            self.db.execute('DELETE FROM jobs WHERE state != 0 AND created_at < ?', (int(before),))
+
+    def acquire(self, name, owner, lease_seconds):
+        """
+        Взятие именованной аренды: удается, если аренда свободна, истекла или
+        уже принадлежит owner (тогда она продлевается). Возвращает True при успехе.
+        """
+        now = time.time()
+        with self.lock:
+            cursor = self.db.execute(
+                '''INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?)
+                   ON CONFLICT (name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+                   WHERE leases.owner = excluded.owner OR leases.expires_at < ?''',
+                (name, owner, now + lease_seconds, now)
+            )
+        return cursor.rowcount == 1
+
+    def release(self, name, owner):
+        """Освобождение аренды, если она все еще принадлежит owner"""
+        with self.lock:
+            self.db.execute('DELETE FROM leases WHERE name = ? AND owner = ?', (name, owner))
+
+    def held(self, prefix):
+        """Имена действующих аренд, начинающихся с prefix, без самого префикса"""
+        with self.lock:
+            rows = self.db.execute(
+                'SELECT name FROM leases WHERE substr(name, 1, ?) = ? AND expires_at >= ?',
+                (len(prefix), prefix, time.time())
+            ).fetchall()
+        return {row['name'][len(prefix):] for row in rows}
+
+    def heartbeat(self, owner, lease_seconds):
+        """Продление всех аренд и задач процесса owner: пока он работает, их не заберут"""
+        expires_at = time.time() + lease_seconds
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                self.db.execute('UPDATE leases SET expires_at = ? WHERE owner = ?', (expires_at, owner))
+                self.db.execute('UPDATE jobs SET lease_until = ? WHERE lease_owner = ? AND state = 0',
+                                (expires_at, owner))
+                self.db.execute('COMMIT')
+            except BaseException:
+                self.db.execute('ROLLBACK')
+                raise
+
+
+class MediaCache:
+    """
+    Директория подготовленных видео с ограничением объема.
+
+    Файл хранится под ключом (ID поста, у вложений альбома — с номером). Время последнего использования —
+    mtime файла: оно обновляется при каждом обращении, и при превышении
+    квоты первыми удаляются давно не использованные файлы. Состояние
+    восстанавливается по содержимому директории, отдельная база не нужна.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+    def path(self, key, extension='.mp4'):
+        return os.path.join(self.directory, f'{key}{extension}')
+
+    def put(self, key, src_path, extension='.mp4'):
+        """Перенос готового файла в кэш, возвращает путь к нему"""
+        path = self.path(key, extension)
+        with self.lock:
+            os.makedirs(self.directory, exist_ok=True)
+            os.replace(src_path, path)
+            os.utime(path)
+        return path
+
+    def touch(self, path):
+        """Отметка об использовании файла"""
+        if not path:
+            return
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def entries(self):
+        """Файлы кэша (путь, размер, время использования), от давно не использованных"""
+        entries = []
+        with self.lock:
+            files = os.listdir(self.directory) if os.path.isdir(self.directory) else []
+            for file in files:
+                path = os.path.join(self.directory, file)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((path, stat.st_size, stat.st_mtime))
+        return sorted(entries, key=lambda entry: entry[2])
+
+    def size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self, keep=()):
+        """
+        Удаление давно не использованных файлов, пока объем кэша больше
+        квоты. Файлы из keep (публикуются, ждут отправки) не удаляются.
+        Возвращает удаленные пути и итоговый объем.
+        """
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        evicted = []
+        for path, size, _ in entries:
+            if total <= self.max_bytes:
+                break
+            if path in keep:
+                continue
+            self.remove(path)
+            evicted.append(path)
+            total -= size
+        return evicted, total
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"Не удалось удалить файл кэша {path}: {e}")
@@ -0,0 +1,23 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Токены задаются до импорта config, чтобы значения из .env не использовались
+os.environ.update(VK_TOKEN='test', TELEGRAM_BOT_TOKEN='0:test', TELEGRAM_CHANNEL_ID='@test')
+
+
+@pytest.fixture(scope='session')
+def parser(tmp_path_factory):
+    """
+    Модуль парсера, импортированный во временной директории: при импорте он
+    создает базы и журналы в текущей директории, рабочие файлы проекта не затрагиваются
+    """
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp('parser'))
+    import vk_tg_parser
+    yield vk_tg_parser
+    os.chdir(cwd)
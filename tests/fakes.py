@@ -0,0 +1,104 @@
+import json
+
+from aiohttp import web
+
+
+class FakeBotApi:
+    """
+    Локальный Bot API и хостинг файлов-источников для тестов.
+
+    Запоминает каждый вызов: метод, текстовые поля и содержимое
+    загруженных файлов. Загруженный файл получает file_id, который
+    возвращается в ответе, как у настоящего sendVideo и sendMediaGroup.
+    Каналы из rejected отвечают окончательной ошибкой 400.
+    """
+
+    def __init__(self, token, rejected=()):
+        self.token = token
+        self.rejected = set(rejected)
+        self.sources = {}
+        self.source_headers = {}
+        self.calls = []
+        self.aborted = 0
+        self.runner = None
+        self.base_url = None
+
+    async def __aenter__(self):
+        app = web.Application(client_max_size=1024 ** 3)
+        app.router.add_get('/source/{name}', self.source)
+        app.router.add_post(f'/bot{self.token}/{{method}}', self.method)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, '127.0.0.1', 0).start()
+        self.base_url = f'http://127.0.0.1:{self.runner.addresses[0][1]}'
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.runner.cleanup()
+
+    def add_source(self, name, content, headers=None):
+        """
+        Файл, который отдается по адресу /source/<name>; возвращает адрес.
+        Без заголовков headers в запросе источник отвечает 403, как CDN.
+        """
+        self.sources[name] = content
+        self.source_headers[name] = headers or {}
+        return f'{self.base_url}/source/{name}'
+
+    async def source(self, request):
+        name = request.match_info['name']
+        if any(request.headers.get(key) != value for key, value in self.source_headers[name].items()):
+            return web.Response(status=403)
+        content = self.sources[name]
+        headers = {'Accept-Ranges': 'bytes'}
+        if 'Range' not in request.headers:
+            return web.Response(body=content, headers=headers, content_type='video/mp4')
+        # Как CDN, отдаем часть файла по заголовку Range: ffmpeg читает источник с перемоткой
+        start, stop, _ = request.http_range.indices(len(content))
+        headers['Content-Range'] = f'bytes {start}-{stop - 1}/{len(content)}'
+        return web.Response(status=206, body=content[start:stop], headers=headers, content_type='video/mp4')
+
+    async def method(self, request):
+        fields, files = {}, {}
+        try:
+            if request.content_type.startswith('multipart/'):
+                async for part in await request.multipart():
+                    if part.filename:
+                        files[part.name] = await part.read()
+                    else:
+                        fields[part.name] = (await part.read()).decode()
+            else:
+                fields = dict(await request.post())
+        except Exception:
+            # Клиент оборвал загрузку: сообщение не создается
+            self.aborted += 1
+            raise
+        call = {'method': request.match_info['method'], 'fields': fields, 'files': files,
+                'content_length': request.content_length}
+        self.calls.append(call)
+        if fields.get('chat_id') in self.rejected:
+            return web.json_response({'ok': False, 'error_code': 400, 'description': 'Bad Request: chat not found'})
+        return web.json_response({'ok': True, 'result': self.result(call)})
+
+    def result(self, call):
+        number = len(self.calls)
+        if call['method'] == 'sendMediaGroup':
+            messages = []
+            for item in json.loads(call['fields']['media']):
+                file_id = self.file_id(call, item['media'], number)
+                media = {'file_id': file_id, 'file_unique_id': file_id}
+                messages.append({'message_id': number, item['type']: [media] if item['type'] == 'photo' else media})
+            return messages
+        file_id = self.file_id(call, call['fields'].get('video', 'attach://video'), number)
+        return {'message_id': number, 'video': {'file_id': file_id, 'file_unique_id': file_id}}
+
+    @staticmethod
+    def file_id(call, media, number):
+        name = media[len('attach://'):] if media.startswith('attach://') else None
+        if name is None and media not in call['files']:
+            return media
+        return f'uploaded{number}_{name or media}'
+
+    def uploads(self):
+        """Вызовы, в которых передавались файлы"""
+        return [call for call in self.calls if call['files']]
@@ -0,0 +1,64 @@
+import json
+import asyncio
+
+import aiohttp
+import pytest
+
+from fakes import FakeBotApi
+from storage import FileIdCache
+
+
+@pytest.fixture(autouse=True)
+def fast_rate_limits(parser, monkeypatch, tmp_path):
+    """Лимиты частоты отправки не замедляют тесты, у каждого теста свой кэш file_id"""
+    monkeypatch.setattr(parser, 'file_id_cache', FileIdCache(str(tmp_path / 'file_ids.db'), 86400, 100))
+    monkeypatch.setattr(parser, 'channel_buckets', {})
+    monkeypatch.setattr(parser, 'TELEGRAM_CHANNEL_MESSAGES_PER_MINUTE', 6000)
+
+
+def album_media(tmp_path, count):
+    """Вложения альбома: первое — видео, остальные — фото"""
+    media = []
+    for index in range(count):
+        kind = 'video' if index == 0 else 'photo'
+        path = tmp_path / f'{kind}{index}'
+        path.write_bytes(f'{kind}{index}'.encode() * 100)
+        media.append({'type': kind, 'path': str(path), 'keys': [f'video:-1_{index}'] if kind == 'video' else []})
+    return media
+
+
+def run_album(parser, monkeypatch, media, channels):
+    """Публикация альбома через локальный Bot API; возвращает ошибки по каналам и сервер"""
+    async def scenario():
+        async with FakeBotApi(parser.TELEGRAM_BOT_TOKEN) as api, aiohttp.ClientSession() as session:
+            monkeypatch.setattr(parser, 'TELEGRAM_API_URL', api.base_url)
+            monkeypatch.setattr(parser, 'http_session', session)
+            errors = await parser.post_album_to_telegram('Текст', media, channels)
+            return errors, api
+    return asyncio.run(scenario())
+
+
+def test_album_over_limit_is_sent_as_one_message_of_first_items(parser, monkeypatch, tmp_path):
+    media = album_media(tmp_path, 13)
+
+    errors, api = run_album(parser, monkeypatch, media, ['@one', '@two'])
+
+    assert errors == {'@one': None, '@two': None}
+    assert [call['method'] for call in api.calls] == ['sendMediaGroup', 'sendMediaGroup']
+    [upload] = api.uploads()
+    assert upload['fields']['chat_id'] == '@one'
+    album = json.loads(upload['fields']['media'])
+    assert len(album) == parser.MAX_ALBUM_SIZE
+    assert album[0]['caption'] == 'Текст'
+    assert upload['files']['media9'] == open(media[9]['path'], 'rb').read()
+
+
+def test_single_attachment_is_sent_as_video(parser, monkeypatch, tmp_path):
+    media = album_media(tmp_path, 1)
+
+    errors, api = run_album(parser, monkeypatch, media, ['@one'])
+
+    assert errors == {'@one': None}
+    [call] = api.calls
+    assert call['method'] == 'sendVideo'
+    assert call['files']['video'] == open(media[0]['path'], 'rb').read()
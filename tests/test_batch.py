@@ -0,0 +1,30 @@
+import time
+import asyncio
+
+from storage import CandidateStore, Outbox, PublishedStore
+
+
+def test_batch_skips_deferred_posts_and_disabled_groups(parser, monkeypatch, tmp_path):
+    candidates = CandidateStore(str(tmp_path / 'candidates.db'))
+    monkeypatch.setattr(parser, 'candidate_store', candidates)
+    monkeypatch.setattr(parser, 'outbox', Outbox(str(tmp_path / 'outbox.db')))
+    monkeypatch.setattr(parser, 'published_store', PublishedStore(str(tmp_path / 'published.log')))
+    monkeypatch.setattr(parser, 'VK_GROUPS', ['club', 'off'])
+    monkeypatch.setattr(parser, 'GROUP_WEIGHTS', {'off': 0})
+    candidates.save_crawl({}, [
+        {'id': f'-{group}_{number}', 'group': group, 'date': number, 'text': '',
+         'video_urls': [f'https://vk.com/video-{group}_{number}']}
+        for group, number in [('club', 1), ('club', 2), ('off', 3)]
+    ])
+    candidates.record_failure('-club_1', time.time() + 3600, 1)
+
+    async def produce():
+        queue = asyncio.Queue()
+        progress = {'published_before': 0, 'in_flight': 0}
+        await parser.produce_batch_candidates(queue, progress, 10)
+        return [queue.get_nowait()['id'] for _ in range(queue.qsize())]
+
+    queued = asyncio.run(produce())
+    for post_id in queued:
+        parser.release_candidate({'id': post_id})
+    assert queued == ['-club_2']
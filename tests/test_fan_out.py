@@ -0,0 +1,67 @@
+import asyncio
+
+import aiohttp
+import pytest
+
+from fakes import FakeBotApi
+
+
+@pytest.fixture(autouse=True)
+def fast_rate_limits(parser, monkeypatch):
+    """Лимиты частоты отправки не замедляют тесты"""
+    monkeypatch.setattr(parser, 'channel_buckets', {})
+    monkeypatch.setattr(parser, 'TELEGRAM_CHANNEL_MESSAGES_PER_MINUTE', 6000)
+
+
+def run_post(parser, monkeypatch, video_path, channels, media_keys=(), rejected=()):
+    """Публикация видео через локальный Bot API; возвращает ошибки по каналам и сервер"""
+    async def scenario():
+        async with FakeBotApi(parser.TELEGRAM_BOT_TOKEN, rejected) as api, aiohttp.ClientSession() as session:
+            monkeypatch.setattr(parser, 'TELEGRAM_API_URL', api.base_url)
+            monkeypatch.setattr(parser, 'http_session', session)
+            errors = await parser.post_to_telegram('Текст', str(video_path), channels, media_keys)
+            return errors, api
+    return asyncio.run(scenario())
+
+
+def test_file_is_uploaded_once_and_other_channels_get_file_id(parser, monkeypatch, tmp_path):
+    content = b'video' * 100000
+    video = tmp_path / 'video.mp4'
+    video.write_bytes(content)
+
+    errors, api = run_post(parser, monkeypatch, video, ['@one', '@two', '@three'])
+
+    assert errors == {'@one': None, '@two': None, '@three': None}
+    [upload] = api.uploads()
+    assert upload['fields']['chat_id'] == '@one'
+    assert upload['files']['video'] == content
+    file_id = 'uploaded1_video'
+    assert [(call['fields']['chat_id'], call['fields']['video']) for call in api.calls[1:]] == [
+        ('@two', file_id), ('@three', file_id)]
+    assert all(call['content_length'] < 4096 for call in api.calls[1:])
+
+
+def test_file_is_uploaded_to_first_channel_that_accepts_it(parser, monkeypatch, tmp_path):
+    video = tmp_path / 'video.mp4'
+    video.write_bytes(b'video' * 1000)
+
+    errors, api = run_post(parser, monkeypatch, video, ['@closed', '@one', '@two'], rejected=['@closed'])
+
+    assert isinstance(errors['@closed'], parser.TelegramError)
+    assert errors['@one'] is None and errors['@two'] is None
+    assert [call['fields']['chat_id'] for call in api.uploads()] == ['@closed', '@one']
+    last = api.calls[-1]['fields']
+    assert (last['chat_id'], last['video']) == ('@two', 'uploaded2_video')
+
+
+def test_cached_file_id_is_reused_without_upload(parser, monkeypatch, tmp_path):
+    video = tmp_path / 'video.mp4'
+    video.write_bytes(b'video' * 1000)
+    media_keys = ['video:-1_77']
+
+    run_post(parser, monkeypatch, video, ['@one'], media_keys)
+    errors, api = run_post(parser, monkeypatch, video, ['@one', '@two'], media_keys)
+
+    assert errors == {'@one': None, '@two': None}
+    assert api.uploads() == []
+    assert {call['fields']['video'] for call in api.calls} == {'uploaded1_video'}
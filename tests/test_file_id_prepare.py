@@ -0,0 +1,101 @@
+import asyncio
+
+import aiohttp
+import pytest
+
+from fakes import FakeBotApi
+from storage import CandidateStore, FileIdCache, Outbox, PublishedStore
+
+
+@pytest.fixture
+def stores(parser, monkeypatch, tmp_path):
+    """Отдельные индекс, журналы, очередь отправки и кэш file_id; лимиты частоты не замедляют тест"""
+    candidates = CandidateStore(str(tmp_path / 'candidates.db'))
+    outbox = Outbox(str(tmp_path / 'outbox.db'))
+    file_ids = FileIdCache(str(tmp_path / 'file_ids.db'), 86400, 100)
+    monkeypatch.setattr(parser, 'candidate_store', candidates)
+    monkeypatch.setattr(parser, 'outbox', outbox)
+    monkeypatch.setattr(parser, 'file_id_cache', file_ids)
+    monkeypatch.setattr(parser, 'published_store', PublishedStore(str(tmp_path / 'published.log')))
+    monkeypatch.setattr(parser, 'media_store', PublishedStore(str(tmp_path / 'media.log')))
+    monkeypatch.setattr(parser, 'channel_buckets', {})
+    monkeypatch.setattr(parser, 'TELEGRAM_CHANNEL_MESSAGES_PER_MINUTE', 6000)
+    candidates.save_crawl({}, [{'id': '-1_5', 'group': 'club', 'date': 1, 'text': 'Текст',
+                                'video_urls': ['https://vk.com/video-1_5'], 'video_keys': ['-1_5']}])
+    return candidates, outbox, file_ids
+
+
+def test_cached_video_is_prepared_and_sent_without_download(parser, monkeypatch, stores):
+    candidates, outbox, file_ids = stores
+    file_ids.put(['video:-1_5'], 'cached_file_id', 1000, 10)
+
+    def no_download(attachment):
+        raise AssertionError('видео из кэша file_id не скачивается')
+
+    monkeypatch.setattr(parser, 'download_media', no_download)
+    monkeypatch.setattr(parser, 'prepare_video', no_download)
+    [post] = candidates.list_unpublished()
+
+    assert parser.prepare_post(post)
+
+    [prepared] = candidates.list_prepared()
+    assert parser.prepared_media(prepared) == [
+        {'type': 'video', 'path': None, 'keys': ['video:-1_5'], 'file_id': 'cached_file_id'}]
+    assert candidates.top_unpublished('club', 10) == []
+
+    async def deliver():
+        async with FakeBotApi(parser.TELEGRAM_BOT_TOKEN) as api, aiohttp.ClientSession() as session:
+            monkeypatch.setattr(parser, 'TELEGRAM_API_URL', api.base_url)
+            monkeypatch.setattr(parser, 'http_session', session)
+            outbox.add(prepared, ['@one', '@two'])
+            await parser.deliver_outbox_item(outbox.get('-1_5'))
+            return api
+
+    api = asyncio.run(deliver())
+    assert api.uploads() == []
+    assert [(call['fields']['chat_id'], call['fields']['video']) for call in api.calls] == [
+        ('@one', 'cached_file_id'), ('@two', 'cached_file_id')]
+    assert '-1_5' not in outbox
+    assert candidates.count_unpublished() == 0
+
+
+def test_post_with_stale_cached_file_id_is_prepared_again(parser, monkeypatch, stores):
+    candidates, outbox, file_ids = stores
+    media = [{'type': 'video', 'path': None, 'keys': ['video:-1_5'], 'file_id': 'stale_file_id'}]
+    candidates.set_prepared('-1_5', media, ['video:-1_5'])
+
+    async def stale(method, chat_id, data, **kwargs):
+        raise parser.TelegramError(400, 'Bad Request: wrong file identifier/HTTP URL specified')
+
+    monkeypatch.setattr(parser, 'send_message', stale)
+    [prepared] = candidates.list_prepared()
+    outbox.add(prepared, ['@one'])
+    asyncio.run(parser.deliver_outbox_item(outbox.get('-1_5')))
+
+    assert '-1_5' not in outbox
+    [post] = candidates.list_unpublished()
+    assert post['prepared_path'] is None
+    assert post['failures'] == 1
+
+
+def test_stream_path_sends_cached_video_through_outbox(parser, monkeypatch, stores):
+    candidates, outbox, file_ids = stores
+    file_ids.put(['video:-1_5'], 'cached_file_id', 1000, 10)
+    [post] = candidates.list_unpublished()
+    monkeypatch.setattr(parser, 'pick_candidate', lambda: post)
+    monkeypatch.setattr(parser, 'CHANNEL_ROUTES', {'club': ['@one', '@two']})
+
+    async def stream():
+        async with FakeBotApi(parser.TELEGRAM_BOT_TOKEN, rejected=['@two']) as api, \
+                aiohttp.ClientSession() as session:
+            monkeypatch.setattr(parser, 'TELEGRAM_API_URL', api.base_url)
+            monkeypatch.setattr(parser, 'http_session', session)
+            return await parser.stream_next_post(), api
+
+    published, api = asyncio.run(stream())
+    assert published
+    assert api.uploads() == []
+    assert [call['fields']['chat_id'] for call in api.calls] == ['@one', '@two']
+    # Отказ канала не считается устаревшим file_id: запись кэша сохраняется
+    assert file_ids.get(['video:-1_5'])['file_id'] == 'cached_file_id'
+    assert candidates.count_unpublished() == 0
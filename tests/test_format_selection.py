@@ -0,0 +1,59 @@
+import os
+import threading
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+from functools import partial
+
+import pytest
+import yt_dlp
+
+SMALL_SIZE = 1000
+BIG_SIZE = 5000
+
+
+@pytest.fixture
+def video_host(tmp_path):
+    """Локальный хостинг двух форматов одного видео: small укладывается в лимит, big — нет"""
+    (tmp_path / 'small.mp4').write_bytes(b's' * SMALL_SIZE)
+    (tmp_path / 'big.mp4').write_bytes(b'b' * BIG_SIZE)
+    handler = partial(SimpleHTTPRequestHandler, directory=str(tmp_path))
+    handler.log_message = lambda *args: None
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.server_address[1]}'
+    server.shutdown()
+
+
+def synthetic_info(base_url):
+    """Метаданные видео, как их вернул бы extract_info для страницы ВК"""
+    def video_format(format_id, size, height):
+        return {'format_id': format_id, 'url': f'{base_url}/{format_id}.mp4', 'ext': 'mp4', 'protocol': 'http',
+                'vcodec': 'avc1', 'acodec': 'mp4a', 'height': height, 'filesize': size}
+    return {
+        'id': 'test', 'title': 'test', 'extractor': 'generic', 'extractor_key': 'Generic',
+        'webpage_url': f'{base_url}/page', 'duration': 10,
+        'formats': [video_format('small', SMALL_SIZE, 360), video_format('big', BIG_SIZE, 1080)],
+    }
+
+
+def test_fetch_video_downloads_selected_format_and_counts_savings_once(parser, monkeypatch, tmp_path, video_host):
+    monkeypatch.setattr(parser, 'MAX_VIDEO_SIZE_MB', 2000 / (1024 * 1024))
+    monkeypatch.setattr(yt_dlp.YoutubeDL, 'extract_info', lambda self, url, download=True: synthetic_info(video_host))
+    monkeypatch.setattr(parser, 'format_savings', {'bytes': 0, 'cpu_seconds': 0.0})
+    job_dir = tmp_path / 'job'
+    job_dir.mkdir()
+
+    path = parser.fetch_video(f'{video_host}/page', str(job_dir))
+
+    assert os.path.getsize(path) == SMALL_SIZE
+    assert parser.format_savings['bytes'] == BIG_SIZE - SMALL_SIZE
+
+
+def test_select_telegram_format_has_no_side_effects(parser, monkeypatch):
+    monkeypatch.setattr(parser, 'MAX_VIDEO_SIZE_MB', 2000 / (1024 * 1024))
+    monkeypatch.setattr(parser, 'format_savings', {'bytes': 0, 'cpu_seconds': 0.0})
+
+    chosen = parser.select_telegram_format(synthetic_info('http://127.0.0.1'))
+
+    assert chosen['format_id'] == 'small'
+    assert parser.format_savings['bytes'] == 0
@@ -0,0 +1,50 @@
+import asyncio
+
+
+def test_crawl_lock_is_created_per_event_loop(parser):
+    async def locks():
+        return parser.crawl_lock(), parser.crawl_lock()
+
+    first, same = asyncio.run(locks())
+    second, _ = asyncio.run(locks())
+    assert first is same
+    assert first is not second
+
+
+def test_crawl_lock_works_across_event_loops(parser):
+    async def hold():
+        async with parser.crawl_lock():
+            await asyncio.sleep(0)
+
+    asyncio.run(hold())
+    asyncio.run(hold())
+
+
+def test_outbox_lock_is_created_per_event_loop(parser):
+    async def lock():
+        return parser.outbox_lock()
+
+    assert asyncio.run(lock()) is not asyncio.run(lock())
+
+
+def test_token_bucket_works_across_event_loops(parser):
+    bucket = parser.TokenBucket(1000, 10)
+
+    async def acquire():
+        await bucket.acquire()
+        return bucket.lock
+
+    first = asyncio.run(acquire())
+    second = asyncio.run(acquire())
+    assert first is not second
+
+
+def test_job_wakeup_is_created_per_event_loop(parser):
+    async def wake():
+        parser.job_wakeup().set()
+        await asyncio.wait_for(parser.job_wakeup().wait(), 1)
+        return parser.job_wakeup()
+
+    first = asyncio.run(wake())
+    second = asyncio.run(wake())
+    assert first is not second
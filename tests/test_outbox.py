@@ -0,0 +1,68 @@
+import asyncio
+
+import pytest
+
+from storage import CandidateStore, FileIdCache, Outbox
+
+
+@pytest.fixture
+def queued_post(parser, monkeypatch, tmp_path):
+    """Подготовленный пост в отдельных индексе и очереди отправки"""
+    candidates = CandidateStore(str(tmp_path / 'candidates.db'))
+    outbox = Outbox(str(tmp_path / 'outbox.db'))
+    monkeypatch.setattr(parser, 'candidate_store', candidates)
+    monkeypatch.setattr(parser, 'outbox', outbox)
+
+    video = tmp_path / 'video.mp4'
+    video.write_bytes(b'video')
+    candidates.save_crawl({}, [{'id': '-1_1', 'group': 'club', 'date': 1, 'text': 'Текст',
+                                'video_urls': ['https://vk.com/video-1_1'], 'video_keys': ['video:-1_1']}])
+    media = [{'type': 'video', 'path': str(video), 'keys': ['video:-1_1']}]
+    candidates.set_prepared('-1_1', media, ['video:-1_1'])
+    outbox.add(candidates.list_prepared()[0], ['@one', '@two'])
+    return candidates, outbox, video
+
+
+def deliver(parser, monkeypatch, outbox, error, attempts=0):
+    async def failing_post(text, path, channels, media_keys, file_id=None):
+        return {channel: error for channel in channels}
+
+    monkeypatch.setattr(parser, 'post_to_telegram', failing_post)
+    item = outbox.get('-1_1')
+    outbox.reschedule('-1_1', item['channels'], [], attempts, 0, None)
+    asyncio.run(parser.deliver_outbox_item(outbox.get('-1_1')))
+
+
+def test_post_rejected_by_every_channel_is_skipped(parser, monkeypatch, queued_post):
+    candidates, outbox, video = queued_post
+
+    deliver(parser, monkeypatch, outbox, parser.TelegramError(400, 'Bad Request: chat not found'))
+
+    assert '-1_1' not in outbox
+    assert not video.exists()
+    assert candidates.count_unpublished() == 0
+
+
+def test_post_failing_transiently_is_deferred_after_last_attempt(parser, monkeypatch, queued_post):
+    candidates, outbox, video = queued_post
+
+    deliver(parser, monkeypatch, outbox, asyncio.TimeoutError(), attempts=parser.OUTBOX_MAX_ATTEMPTS - 1)
+
+    assert '-1_1' not in outbox
+    assert not video.exists()
+    [post] = candidates.list_unpublished()
+    assert post['failures'] == 1
+    assert post['prepared_path'] is None
+
+
+def test_post_with_missing_prepared_file_is_prepared_again(parser, monkeypatch, queued_post, tmp_path):
+    candidates, outbox, video = queued_post
+    monkeypatch.setattr(parser, 'file_id_cache', FileIdCache(str(tmp_path / 'file_ids.db'), 86400, 100))
+    video.unlink()
+
+    asyncio.run(parser.deliver_outbox_item(outbox.get('-1_1')))
+
+    assert '-1_1' not in outbox
+    [post] = candidates.list_unpublished()
+    assert post['failures'] == 1
+    assert post['prepared_path'] is None
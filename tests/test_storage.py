@@ -0,0 +1,29 @@
+import sqlite3
+
+from storage import CandidateStore
+
+
+def test_legacy_pick_key_column_is_dropped(tmp_path):
+    path = str(tmp_path / 'candidates.db')
+    db = sqlite3.connect(path)
+    db.executescript('''
+        CREATE TABLE posts (
+            id TEXT PRIMARY KEY, group_id TEXT NOT NULL, date INTEGER NOT NULL, text TEXT NOT NULL,
+            video_urls TEXT NOT NULL, published INTEGER NOT NULL DEFAULT 0, pick_key REAL NOT NULL,
+            added_at INTEGER NOT NULL
+        );
+        CREATE INDEX idx_posts_pick ON posts (group_id, published, pick_key);
+        INSERT INTO posts (id, group_id, date, text, video_urls, pick_key, added_at)
+        VALUES ('-1_1', 'club', 1, '', '["https://vk.com/video-1_1"]', 0.5, 1);
+    ''')
+    db.close()
+
+    store = CandidateStore(path)
+    store.save_crawl({}, [{'id': '-1_2', 'group': 'club', 'date': 2, 'text': '',
+                           'video_urls': ['https://vk.com/video-1_2']}])
+
+    columns = {row['name'] for row in store.db.execute('PRAGMA table_info(posts)')}
+    assert 'pick_key' not in columns
+    old, new = store.list_unpublished()
+    assert old['attachments'] == [{'type': 'video', 'url': 'https://vk.com/video-1_1', 'key': None}]
+    assert new['id'] == '-1_2'
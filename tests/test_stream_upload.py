@@ -0,0 +1,135 @@
+import os
+import shutil
+import asyncio
+
+import aiohttp
+import pytest
+
+from fakes import FakeBotApi
+from storage import Outbox
+from transcode import run_ffmpeg
+
+
+@pytest.fixture(autouse=True)
+def fast_rate_limits(parser, monkeypatch):
+    """Лимиты частоты отправки не замедляют тесты"""
+    monkeypatch.setattr(parser, 'channel_buckets', {})
+    monkeypatch.setattr(parser, 'TELEGRAM_CHANNEL_MESSAGES_PER_MINUTE', 6000)
+
+
+def run_stream(parser, monkeypatch, content, channels, filesize=None, published=()):
+    """Потоковая публикация content через локальный Bot API; возвращает результат и сервер"""
+    async def scenario():
+        async with FakeBotApi(parser.TELEGRAM_BOT_TOKEN) as api, aiohttp.ClientSession() as session:
+            monkeypatch.setattr(parser, 'TELEGRAM_API_URL', api.base_url)
+            monkeypatch.setattr(parser, 'http_session', session)
+            for key in published:
+                parser.media_store.add(key)
+            source = {'url': api.add_source('video.mp4', content), 'headers': {}, 'filesize': filesize}
+            try:
+                result = await parser.stream_video_to_telegram('Текст', source, channels, ['video:1_1'])
+            except parser.DuplicateMediaError as e:
+                result = e
+            return result, api
+    return asyncio.run(scenario())
+
+
+def test_stream_upload_sends_source_bytes_with_exact_content_length(parser, monkeypatch):
+    content = bytes(range(256)) * 4096
+
+    result, api = run_stream(parser, monkeypatch, content, ['@one'])
+
+    [call] = api.calls
+    assert call['method'] == 'sendVideo'
+    assert call['files']['video'] == content
+    assert call['fields']['chat_id'] == '@one'
+    assert result == {'sha256': parser.hashlib.sha256(content).hexdigest(), 'file_id': 'uploaded1_video',
+                      'errors': {'@one': None}}
+
+
+def test_stream_upload_ignores_wrong_size_from_metadata(parser, monkeypatch):
+    content = b'v' * 300000
+
+    result, api = run_stream(parser, monkeypatch, content, ['@one'], filesize=123)
+
+    assert result is not None
+    assert api.calls[0]['files']['video'] == content
+
+
+def test_stream_upload_aborts_duplicate_before_message_is_created(parser, monkeypatch):
+    content = b'duplicate' * 50000
+    published = [f"sha256:{parser.hashlib.sha256(content).hexdigest()}"]
+
+    result, api = run_stream(parser, monkeypatch, content, ['@one'], published=published)
+
+    assert isinstance(result, parser.DuplicateMediaError)
+    assert api.calls == []
+
+
+@pytest.mark.skipif(not shutil.which(os.environ.get('FFMPEG_BINARY', 'ffmpeg')), reason='нужен ffmpeg')
+def test_stream_fingerprint_matches_downloaded_file(parser, tmp_path):
+    clip = tmp_path / 'clip.mp4'
+    run_ffmpeg(['-f', 'lavfi', '-i', 'testsrc2=duration=3:size=320x240:rate=25',
+               '-c:v', 'libx264', '-pix_fmt', 'yuv420p', str(clip)])
+    headers = {'Referer': 'https://vk.com/', 'X-Token': 'secret'}
+
+    async def scenario():
+        async with FakeBotApi(parser.TELEGRAM_BOT_TOKEN) as api:
+            url = api.add_source('clip.mp4', clip.read_bytes(), headers=headers)
+            loop = asyncio.get_running_loop()
+            with_headers = await loop.run_in_executor(None, parser.stream_fingerprint,
+                                                      {'url': url, 'headers': headers})
+            without_headers = await loop.run_in_executor(None, parser.stream_fingerprint, {'url': url})
+            return with_headers, without_headers
+
+    assert asyncio.run(scenario()) == (f"frames:{parser.video_fingerprint(str(clip))}", None)
+
+
+def test_host_slot_is_released_when_task_is_cancelled(parser):
+    url = 'http://slot.test/video.mp4'
+    slot = parser.host_slot(url)
+
+    async def hold():
+        async with parser.hold_host_slot(url):
+            await asyncio.sleep(10)
+
+    async def cancel(task):
+        await asyncio.sleep(0.1)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    async def scenario():
+        # Отмена во время загрузки
+        await cancel(asyncio.create_task(hold()))
+        # Отмена, пока поток ждет места: место освобождается, когда поток его получит
+        taken = [slot.acquire(blocking=False) for _ in range(parser.DOWNLOAD_PER_HOST_LIMIT)]
+        assert all(taken)
+        await cancel(asyncio.create_task(hold()))
+        slot.release()
+        await asyncio.sleep(0.1)
+        for _ in taken[1:]:
+            slot.release()
+
+    asyncio.run(scenario())
+    taken = [slot.acquire(blocking=False) for _ in range(parser.DOWNLOAD_PER_HOST_LIMIT)]
+    for _ in filter(None, taken):
+        slot.release()
+    assert all(taken)
+
+
+def test_channels_failing_transiently_after_stream_upload_are_queued(parser, monkeypatch, tmp_path):
+    outbox = Outbox(str(tmp_path / 'outbox.db'))
+    monkeypatch.setattr(parser, 'outbox', outbox)
+    post = {'id': '-1_9', 'group': 'club', 'text': 'Текст'}
+    media = [{'type': 'video', 'path': None, 'keys': ['video:-1_9'], 'file_id': 'streamed'}]
+    errors = {'@one': None, '@flood': parser.TelegramError(429, 'Too Many Requests', retry_after=30),
+              '@closed': parser.TelegramError(400, 'Bad Request: chat not found')}
+
+    parser.enqueue_undelivered(parser.outbox_post(post, media), errors)
+
+    item = outbox.get('-1_9')
+    assert item['channels'] == ['@flood']
+    assert item['delivered'] == ['@one']
+    assert item['next_attempt_at'] > parser.time.time() + 20
+    assert parser.prepared_media(item['post']) == media
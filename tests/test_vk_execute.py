@@ -0,0 +1,109 @@
+import re
+import json
+import asyncio
+
+
+class FakeVkApi:
+    """
+    Метод execute VK API: выполняет вызовы wall.get из кода VKScript по
+    заранее заданным стенам и запоминает запросы. Закрытые группы
+    возвращают false с ошибкой в execute_errors, как настоящий API.
+    """
+
+    def __init__(self, walls, private=(), truncate_to=None):
+        self.walls = walls
+        self.private = set(private)
+        self.truncate_to = truncate_to
+        self.requests = []
+
+    async def execute(self, code):
+        self.requests.append(code)
+        response, errors = [], []
+        for match in re.finditer(r'API\.wall\.get\((.*?)\)\);', code):
+            params = json.loads(match.group(1))
+            owner = params.get('domain', params.get('owner_id'))
+            if owner in self.private:
+                response.append(False)
+                errors.append({'method': 'wall.get', 'error_code': 30, 'error_msg': 'This profile is private'})
+                continue
+            items = self.walls.get(owner, [])
+            offset, count = params['offset'], params['count']
+            response.append({'count': len(items), 'items': items[offset:offset + count]})
+        if self.truncate_to is not None:
+            response = response[:self.truncate_to]
+        result = {'response': response}
+        if errors:
+            result['execute_errors'] = errors
+        return result
+
+
+def test_build_wall_get_script_resolves_domains_and_numeric_ids(parser):
+    code = parser.build_wall_get_script([parser.wall_get_params('box_tea', 10),
+                                         parser.wall_get_params(219956325, 10, 20)])
+
+    calls = [json.loads(params) for params in re.findall(r'API\.wall\.get\((.*?)\)\);', code)]
+    assert calls == [
+        {'count': 10, 'offset': 0, 'filter': 'owner', 'domain': 'box_tea'},
+        {'count': 10, 'offset': 20, 'filter': 'owner', 'owner_id': -219956325},
+    ]
+    assert code.endswith('return result;')
+
+
+def test_split_execute_response_maps_errors_in_call_order(parser):
+    response = {
+        'response': [{'items': [1]}, False, {'items': [2]}, False],
+        'execute_errors': [{'error_code': 30, 'error_msg': 'This profile is private'},
+                           {'error_code': 15, 'error_msg': 'Access denied'}],
+    }
+
+    results = parser.split_execute_response(response, 4)
+
+    assert results[0] == {'items': [1]} and results[2] == {'items': [2]}
+    assert isinstance(results[1], parser.VkExecuteError) and results[1].code == 30
+    assert isinstance(results[3], parser.VkExecuteError) and results[3].code == 15
+
+
+def test_split_execute_response_pads_short_response(parser):
+    results = parser.split_execute_response({'response': [{'items': []}]}, 3)
+
+    assert len(results) == 3
+    assert results[0] == {'items': []}
+    assert all(isinstance(result, parser.VkExecuteError) for result in results[1:])
+
+
+def test_wall_get_batch_packs_calls_into_execute_requests(parser, monkeypatch):
+    groups = [f'group{index}' for index in range(parser.VK_EXECUTE_BATCH_SIZE + 5)]
+    walls = {group: [{'id': index}] for index, group in enumerate(groups)}
+    api = FakeVkApi(walls, private={'group3'})
+    monkeypatch.setattr(parser, 'vk_execute', api.execute)
+
+    results = asyncio.run(parser.vk_wall_get_batch([parser.wall_get_params(group) for group in groups]))
+
+    assert len(api.requests) == 2
+    assert len(results) == len(groups)
+    for index, (group, result) in enumerate(zip(groups, results)):
+        if group == 'group3':
+            assert isinstance(result, parser.VkExecuteError) and result.code == 30
+        else:
+            assert result['items'] == [{'id': index}]
+
+
+def test_wall_get_batch_truncated_response_does_not_shift_groups(parser, monkeypatch):
+    api = FakeVkApi({'a': [{'id': 1}], 'b': [{'id': 2}], 'c': [{'id': 3}]}, truncate_to=1)
+    monkeypatch.setattr(parser, 'vk_execute', api.execute)
+
+    results = asyncio.run(parser.vk_wall_get_batch([parser.wall_get_params(group) for group in 'abc']))
+
+    assert results[0]['items'] == [{'id': 1}]
+    assert all(isinstance(result, parser.VkExecuteError) for result in results[1:])
+
+
+def test_wall_get_batch_request_error_applies_to_whole_batch(parser, monkeypatch):
+    async def failing_execute(code):
+        raise parser.VkExecuteError(5, 'User authorization failed')
+
+    monkeypatch.setattr(parser, 'vk_execute', failing_execute)
+
+    results = asyncio.run(parser.vk_wall_get_batch([parser.wall_get_params(group) for group in 'ab']))
+
+    assert [result.code for result in results] == [5, 5]
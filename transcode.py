@@ -0,0 +1,181 @@
+import os
+import re
+import logging
+import subprocess
+from config import FFMPEG_BINARY, TRANSCODE_PRESET
+
+logger = logging.getLogger(__name__)
+
+# Доля лимита размера, на которую рассчитывается битрейт (запас на контейнер и неточность ABR)
+SIZE_MARGIN = 0.92
+
+# Битрейт звука (кбит/с) и верхняя граница битрейта видео
+AUDIO_BITRATE_K = 128
+LOW_AUDIO_BITRATE_K = 64
+MAX_VIDEO_BITRATE_K = 4000
+
+# Качество при перекодировании файлов, которые уже укладываются в лимит
+CRF = 23
+
+# Ограничение высоты кадра при низком битрейте: (битрейт видео до, кбит/с; высота)
+SCALE_STEPS = ((600, 360), (1000, 480), (2000, 720))
+
+
+class TranscodeError(Exception):
+    """Ошибка запуска или работы ffmpeg"""
+
+
+def run_ffmpeg(args):
+    """Запуск ffmpeg с проверкой кода возврата"""
+    command = [FFMPEG_BINARY, '-hide_banner', '-loglevel', 'error', '-y'] + args
+    result = subprocess.run(command, capture_output=True)
+    if result.returncode != 0:
+        raise TranscodeError(result.stderr.decode('utf-8', 'replace').strip()[-500:])
+    return result.stdout
+
+
+def input_args(path, headers=None):
+    """Аргументы входа ffmpeg: HTTP-заголовки источника по ссылке передаются через -headers"""
+    if not headers:
+        return ['-i', path]
+    return ['-headers', ''.join(f'{name}: {value}\r\n' for name, value in headers.items()), '-i', path]
+
+
+def probe(path, headers=None):
+    """
+    Параметры видео по выводу `ffmpeg -i`: длительность, кодеки, размер кадра,
+    битрейт звука и формат контейнера
+    """
+    result = subprocess.run([FFMPEG_BINARY, '-hide_banner', *input_args(path, headers)], capture_output=True)
+    output = result.stderr.decode('utf-8', 'replace')
+
+    duration = re.search(r'Duration: (\d+):(\d+):(\d+(?:\.\d+)?)', output)
+    video = re.search(r'Stream #.*?: Video: (\w+).*?, (\d{2,5})x(\d{2,5})', output)
+    audio = re.search(r'Stream #.*?: Audio: (\w+)(?:.*?, (\d+) kb/s)?', output)
+    container = re.search(r'Input #0, ([\w,]+), from', output)
+
+    if not video:
+        raise TranscodeError(f"ffmpeg не нашел видеопоток в {path}")
+
+    return {
+        'duration': (int(duration.group(1)) * 3600 + int(duration.group(2)) * 60 + float(duration.group(3)))
+                    if duration else None,
+        'video_codec': video.group(1),
+        'width': int(video.group(2)),
+        'height': int(video.group(3)),
+        'audio_codec': audio.group(1) if audio else None,
+        'audio_bitrate_k': int(audio.group(2)) if audio and audio.group(2) else None,
+        'container': container.group(1).split(',') if container else [],
+    }
+
+
+def is_telegram_compatible(info):
+    """H.264 + AAC (или без звука) — Telegram воспроизводит такой MP4 без перекодирования"""
+    return info['video_codec'] == 'h264' and info['audio_codec'] in ('aac', None)
+
+
+def remux(src, dst):
+    """Перепаковка в MP4 без перекодирования (moov в начале файла для потокового просмотра)"""
+    run_ffmpeg(['-i', src, '-map', '0:v:0', '-map', '0:a:0?', '-c', 'copy', '-movflags', '+faststart', dst])
+    return dst
+
+
+def target_bitrates(info, max_bytes):
+    """
+    Битрейты видео и звука (кбит/с), при которых файл длительностью
+    info['duration'] уложится в max_bytes за один проход
+    """
+    total_k = max_bytes * 8 * SIZE_MARGIN / info['duration'] / 1000
+    audio_k = AUDIO_BITRATE_K if total_k > 800 else LOW_AUDIO_BITRATE_K
+    if not info['audio_codec']:
+        audio_k = 0
+    video_k = int(min(total_k - audio_k, MAX_VIDEO_BITRATE_K))
+    if video_k < 100:
+        raise TranscodeError(f"Видео слишком длинное для лимита {max_bytes} байт ({info['duration']:.0f} с)")
+    return video_k, audio_k
+
+
+def encode(src, dst, video_k, audio_k, height=None, crf=None):
+    """
+    Один проход libx264/AAC на всех ядрах: средний битрейт video_k либо,
+    если задан crf, постоянное качество с потолком битрейта video_k
+    """
+    args = ['-i', src, '-map', '0:v:0', '-map', '0:a:0?',
+            '-c:v', 'libx264', '-preset', TRANSCODE_PRESET, '-pix_fmt', 'yuv420p']
+    if crf is not None:
+        args += ['-crf', str(crf)]
+    else:
+        args += ['-b:v', f'{video_k}k']
+    args += ['-maxrate', f'{video_k}k', '-bufsize', f'{video_k * 2}k']
+    if height:
+        args += ['-vf', f'scale=-2:min(ih\\,{height})']
+    if audio_k:
+        args += ['-c:a', 'aac', '-b:a', f'{audio_k}k']
+    args += ['-threads', '0', '-movflags', '+faststart', dst]
+    run_ffmpeg(args)
+    return dst
+
+
+def scaled_height(video_k):
+    """Высота кадра для низкого битрейта (None — оставить исходную)"""
+    for max_bitrate, height in SCALE_STEPS:
+        if video_k < max_bitrate:
+            return height
+    return None
+
+
+def transcode_for_telegram(src, dst, max_bytes):
+    """
+    Приведение видео к MP4 (H.264/AAC) не больше max_bytes.
+
+    Подходящий по кодекам и размеру MP4 возвращается как есть, подходящий
+    по кодекам файл в другом контейнере перепаковывается без перекодирования.
+    Иначе битрейт рассчитывается из длительности и лимита, и видео
+    кодируется за один проход. Возвращает путь к итоговому файлу.
+    """
+    info = probe(src)
+    size = os.path.getsize(src)
+
+    if is_telegram_compatible(info) and size <= max_bytes:
+        if 'mp4' in info['container'] and src.lower().endswith('.mp4'):
+            return src
+        logger.info("Кодеки уже подходят для Telegram, перепаковываем в MP4 без перекодирования")
+        return remux(src, dst)
+
+    if not info['duration']:
+        raise TranscodeError(f"Не удалось определить длительность {src}")
+
+    video_k, audio_k = target_bitrates(info, max_bytes)
+    logger.info(f"Кодируем видео ({info['video_codec']}/{info['audio_codec']}, {size / (1024 * 1024):.1f} МБ, "
+                f"{info['duration']:.0f} с) с битрейтом до {video_k}k + {audio_k}k")
+    if size <= max_bytes:
+        # Размер и так в пределах лимита, меняем только кодек: не раздуваем маленькие файлы
+        encode(src, dst, video_k, audio_k, crf=CRF)
+    else:
+        encode(src, dst, video_k, audio_k, scaled_height(video_k))
+
+    # ABR может немного промахнуться — тогда один раз уменьшаем битрейт пропорционально
+    result_size = os.path.getsize(dst)
+    if result_size > max_bytes:
+        video_k = int(video_k * max_bytes / result_size * SIZE_MARGIN)
+        logger.warning(f"Файл превысил лимит ({result_size / (1024 * 1024):.1f} МБ), повторяем с битрейтом {video_k}k")
+        encode(src, dst, video_k, audio_k, scaled_height(video_k))
+
+    return dst
+
+
+def frame_fingerprint(path, duration, samples=(0.1, 0.3, 0.5, 0.7), headers=None):
+    """
+    Average hash 8x8 нескольких кадров: ffmpeg сразу отдает кадр,
+    уменьшенный до 8x8 в оттенках серого (64 байта)
+    """
+    bits = []
+    for position in samples:
+        pixels = run_ffmpeg(['-ss', f'{duration * position:.2f}', *input_args(path, headers), '-frames:v', '1',
+                             '-vf', 'scale=8:8,format=gray', '-f', 'rawvideo', '-'])
+        if len(pixels) != 64:
+            raise TranscodeError(f"Не удалось получить кадр {path} на {position:.0%}")
+        mean = sum(pixels) / 64
+        bits.extend(pixel > mean for pixel in pixels)
+    value = int(''.join('1' if bit else '0' for bit in bits), 2)
+    return f"{value:0{len(bits) // 4}x}"
@@ -1,25 +1,40 @@
 import os
+import math
 import random
 import time
 import json
+import hashlib
 import logging
 import datetime
 import pytz
-import schedule
-import subprocess
 import shutil
-import vk_api
-import requests
 import argparse
 import threading
-from telegram import Bot
-from telegram.error import TelegramError
-from moviepy.editor import VideoFileClip
-import yt_dlp
+import uuid
+import socket
+import asyncio
+import importlib.util
+from contextlib import asynccontextmanager, ExitStack
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+import aiohttp
 from config import (
-    VK_TOKEN, TELEGRAM_BOT_TOKEN, TELEGRAM_CHANNEL_ID,
-    VK_GROUPS, POSTING_TIMES, START_DATE, TEMP_DIR, MAX_CACHED_POSTS
+    VK_TOKEN, TELEGRAM_BOT_TOKEN, TELEGRAM_CHANNEL_ID, CHANNEL_ROUTES,
+    VK_GROUPS, POSTING_TIMES, START_DATE, TEMP_DIR,
+    VK_EXECUTE_BATCH_SIZE, VK_PAGE_SIZE, VK_MAX_NEW_PAGES, BACKFILL_INTERVAL_MINUTES,
+    CRAWL_INTERVAL_MINUTES, PREFETCH_COUNT, PREFETCH_DISK_BUDGET_MB, PREFETCH_MAX_AGE_HOURS,
+    DOWNLOAD_WORKERS, ALBUM_WORKERS, DOWNLOAD_PER_HOST_LIMIT, DOWNLOAD_RETRIES, DOWNLOAD_RETRY_DELAY_SECONDS,
+    DOWNLOAD_RATE_LIMIT_KB, FFMPEG_BINARY, TELEGRAM_API_URL, STREAM_UPLOADS,
+    TELEGRAM_UPLOAD_TIMEOUT_SECONDS, VK_API_VERSION, TRANSCODE_WORKERS, HTTP_POOL_SIZE,
+    FILE_ID_CACHE_MAX_AGE_DAYS, FILE_ID_CACHE_MAX_ENTRIES, TELEGRAM_MESSAGES_PER_SECOND,
+    TELEGRAM_CHANNEL_MESSAGES_PER_MINUTE, OUTBOX_MAX_SIZE, OUTBOX_MAX_ATTEMPTS, OUTBOX_RETRY_DELAY_SECONDS,
+    BATCH_QUEUE_SIZE, BATCH_PROGRESS_INTERVAL_SECONDS, METRICS_HOST, METRICS_PORT,
+    FRESHNESS_HALF_LIFE_DAYS, GROUP_WEIGHTS, GROUP_QUOTA_WINDOW_DAYS, CANDIDATE_RETRY_HOURS, CANDIDATE_MAX_FAILURES,
+    WORKER_ID, WORKER_LEASE_SECONDS, JOB_MAX_ATTEMPTS
 )
+from storage import CandidateStore, PublishedStore, FileIdCache, Outbox, JobQueue, MediaCache, group_key
+from transcode import TranscodeError, transcode_for_telegram, probe, frame_fingerprint
+from metrics import StageMetrics
 
 # Настройка логирования
 logging.basicConfig(
@@ -32,491 +47,2577 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Создаем директорию для временных файлов, если она не существует
-os.makedirs(TEMP_DIR, exist_ok=True)
+# Журнал опубликованных постов (только дозапись)
+PUBLISHED_POSTS_LOG = 'published_posts.log'
 
-# Путь к файлу с кэшем опубликованных постов
+# Прежний формат списка опубликованных постов, переносится в журнал при первом запуске
 PUBLISHED_POSTS_FILE = 'published_posts.json'
 
+# Путь к базе с найденными постами и состоянием обхода стен групп
+CANDIDATES_DB_FILE = 'candidates.db'
+
+# Локальный индекс постов-кандидатов
+candidate_store = CandidateStore(CANDIDATES_DB_FILE)
+
+# Опубликованные посты
+published_store = PublishedStore(PUBLISHED_POSTS_LOG, legacy_json_path=PUBLISHED_POSTS_FILE)
+
+# Журнал опубликованных видео: ID видео ВК, хэш содержимого и отпечаток кадров
+PUBLISHED_MEDIA_LOG = 'published_media.log'
+media_store = PublishedStore(PUBLISHED_MEDIA_LOG)
+
+# Кэш file_id загруженных в Telegram видео: повторная отправка без скачивания и загрузки
+FILE_ID_CACHE_FILE = 'file_ids.db'
+file_id_cache = FileIdCache(FILE_ID_CACHE_FILE, FILE_ID_CACHE_MAX_AGE_DAYS * 86400, FILE_ID_CACHE_MAX_ENTRIES)
+
+# Очередь отправки подготовленных постов (переживает перезапуск)
+OUTBOX_FILE = 'outbox.db'
+outbox = Outbox(OUTBOX_FILE)
+
+# Интервал проверки очереди отправки в секундах
+OUTBOX_INTERVAL_SECONDS = 5
+
+# Общая очередь задач и аренды, через которые несколько процессов парсера делят работу
+JOBS_DB_FILE = 'jobs.db'
+job_queue = JobQueue(JOBS_DB_FILE)
+
+# Имя этого процесса в очереди задач
+worker_id = WORKER_ID or f"{socket.gethostname()}-{os.getpid()}"
+
+# Сколько задач каждого вида процесс выполняет одновременно
+JOB_LIMITS = {'publish': 2, 'crawl': 1, 'backfill': 1, 'prepare': DOWNLOAD_WORKERS}
+
+# Интервал опроса очереди задач в секундах (задачи этого процесса берутся сразу)
+JOB_POLL_INTERVAL_SECONDS = 2
+
+# Сколько дней хранятся выполненные задачи
+JOB_HISTORY_DAYS = 7
+
+# Ключи видео, под которыми хранится file_id: только точные (отпечаток кадров совпадает и у другой копии)
+FILE_ID_KEY_PREFIXES = ('video:', 'sha256:')
+
+# Количество постов, которые можно перебрать за одну подготовку (дубликаты, ошибки скачивания)
+MAX_CANDIDATE_ATTEMPTS = 5
+
+# Из скольких лучших по score постов группы выбирается пост для подготовки
+SELECTION_TOP_K = 5
+
+# Оценка битрейта видео ВК по высоте кадра (кбит/с) для оценки размера до скачивания
+ESTIMATED_BITRATES_K = ((360, 700), (480, 1200), (720, 2500), (1080, 4500))
+
+# Длительность и высота кадра, которые приписываются видео без метаданных
+DEFAULT_VIDEO_DURATION = 60
+DEFAULT_VIDEO_HEIGHT = 720
+
+# Во сколько раз подготовка с перекодированием дороже простого скачивания того же объема
+TRANSCODE_COST_FACTOR = 4
+
+# Снижение score за каждую неудачную подготовку (вес поста при выборе уменьшается вчетверо)
+FAILURE_SCORE_PENALTY = math.log(4)
+
+# Директория с заранее подготовленными видео
+PREFETCH_DIR = os.path.join(TEMP_DIR, 'prefetch')
+
+# Кэш подготовленных видео: при превышении PREFETCH_DISK_BUDGET_MB удаляются давно не использованные
+media_cache = MediaCache(PREFETCH_DIR, PREFETCH_DISK_BUDGET_MB * 1024 * 1024)
+
+# Рабочие директории задач скачивания и обработки: у каждой задачи своя
+JOBS_DIR = os.path.join(TEMP_DIR, 'jobs')
+
+# Интервал проверки запаса подготовленных постов в секундах
+PREFETCH_INTERVAL_SECONDS = 60
+
+# Блокировка кэша подготовленных видео (перенос файла с записью в индекс и очистка)
+prefetch_lock = threading.Lock()
+
+# Посты, которые сейчас готовятся, и посты, видео которых загружается в Telegram
+preparing_posts = set()
+publishing_posts = set()
+preparing_lock = threading.Lock()
+
+# Пул потоков для параллельной подготовки постов (скачивание и обработка видео)
+download_executor = ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS, thread_name_prefix='download')
+
+# Пул для вложений одного поста: видео и фото альбома скачиваются и обрабатываются параллельно.
+# Задачи этого пула сами не ждут задач пула, поэтому вложенные вызовы из download_executor безопасны
+album_executor = ThreadPoolExecutor(max_workers=ALBUM_WORKERS, thread_name_prefix='album')
+
+# Пул для перекодирования ffmpeg: параллельные скачивания не запускают больше TRANSCODE_WORKERS кодировщиков
+transcode_executor = ThreadPoolExecutor(max_workers=TRANSCODE_WORKERS, thread_name_prefix='transcode')
+
+# Ограничение одновременных скачиваний с одного хоста
+host_slots = {}
+host_slots_lock = threading.Lock()
+
+# Сколько байт скачивания и секунд процессора сэкономил выбор формата под лимит Telegram
+format_savings = {'bytes': 0, 'cpu_seconds': 0.0}
+
+# Затраты процессора на сжатие видео ffmpeg (для оценки экономии)
+transcode_stats = {'cpu_seconds': 0.0, 'megabytes': 0.0}
+stats_lock = threading.Lock()
+
+# Оценка процессорного времени на сжатие 1 МБ видео, пока нет собственных замеров
+DEFAULT_TRANSCODE_CPU_SECONDS_PER_MB = 2.0
+
+# Признаки временных ошибок скачивания, после которых имеет смысл повторить попытку
+TRANSIENT_ERROR_MARKERS = (
+    'timed out', 'timeout', 'temporarily', 'connection', 'http error 5',
+    'http error 429', 'unable to download webpage',
+)
+
+# Примитивы asyncio текущего цикла событий: на Python 3.8/3.9 они привязываются
+# к циклу, существующему в момент создания, поэтому создаются внутри работающего цикла
+loop_locals = {}
+
+
+def loop_local(name, factory):
+    """Примитив asyncio текущего цикла событий (создается при первом обращении)"""
+    loop = asyncio.get_running_loop()
+    entry = loop_locals.get(name)
+    if entry is None or entry[0] is not loop:
+        entry = loop_locals[name] = (loop, factory())
+    return entry[1]
+
+
+def crawl_lock():
+    """Блокировка состояния обхода (обновление и фоновая догрузка)"""
+    return loop_local('crawl_lock', asyncio.Lock)
+
+
+def outbox_lock():
+    """Блокировка очереди отправки: очередь обрабатывается одной задачей за раз"""
+    return loop_local('outbox_lock', asyncio.Lock)
+
+
+def job_wakeup():
+    """Сигнал циклу задач: в очереди появилась задача или освободилось место"""
+    return loop_local('job_wakeup', asyncio.Event)
+
+
+# Запущенные фоновые задачи (ссылки на них не дают сборщику мусора удалить задачи)
+background_tasks = set()
+
+# Задачи, без которых парсер не работает: их остановка делает /health неуспешным
+core_task_names = set()
+
+# Замеры этапов конвейера для /metrics
+metrics = StageMetrics('vk_tg')
+
+# Время последней успешной публикации и задержка последнего слота (для /metrics и /health)
+last_publish = {'timestamp': None, 'slot_lateness_seconds': None}
+
 # Максимальный размер видео для Telegram (в МБ)
 MAX_VIDEO_SIZE_MB = 45  # Оставляем запас от лимита в 50 МБ
 
-# Инициализация API ВКонтакте
-vk_session = vk_api.VkApi(token=VK_TOKEN)
-vk = vk_session.get_api()
+# Лимит Telegram на размер загружаемого фото (в МБ)
+MAX_PHOTO_SIZE_MB = 10
+
+# Лимит Telegram на число вложений в альбоме (sendMediaGroup принимает от 2 до 10)
+MAX_ALBUM_SIZE = 10
+
+# Типы копий фото ВК от меньшей к большей
+PHOTO_SIZE_TYPES = 'smopqrxyzw'
+
+# Адрес методов API ВКонтакте
+VK_API_URL = 'https://api.vk.com/method'
+
+# Общая HTTP-сессия с пулом соединений для VK и Bot API (создается при запуске)
+http_session = None
+
+# Таймаут запросов к VK и Bot API, кроме загрузки видео (в секундах)
+HTTP_TIMEOUT_SECONDS = 60
+
+# Размер части при потоковой передаче видео (в байтах)
+STREAM_CHUNK_SIZE = 256 * 1024
+
+# Московский часовой пояс
+moscow_tz = pytz.timezone('Europe/Moscow')
+
+# URL вашего сервиса на Render (заполните после деплоя)
+SERVICE_URL = "https://vk-tg-parser.onrender.com"  # Замените на ваш URL
+
+async def keep_alive():
+    """
+    Функция для предотвращения засыпания сервиса на Render.com: запрос
+    к собственному /health заодно проверяет, что парсер работает
+    """
+    while True:
+        try:
+            async with http_session.get(f"{SERVICE_URL}/health") as response:
+                body = await response.text()
+            if response.status == 200:
+                logger.info("Keeping service alive...")
+            else:
+                logger.warning(f"Health check failed ({response.status}): {body}")
+        except Exception as e:
+            logger.error(f"Error in keep_alive: {e}")
+        await asyncio.sleep(600)  # Запрос каждые 10 минут
+
+
+def health_status():
+    """Состояние парсера: работают ли основные задачи и когда была последняя публикация"""
+    running = {task.get_name() for task in background_tasks if not task.done()}
+    stopped = sorted(core_task_names - running)
+    return {
+        'status': 'ok' if not stopped and http_session is not None and not http_session.closed else 'fail',
+        'stopped_tasks': stopped,
+        'outbox': len(outbox),
+        'last_publish': last_publish['timestamp'],
+        'worker': worker_id,
+        'jobs': job_queue.pending(),
+    }
+
+
+async def handle_metrics(request):
+    """GET /metrics: замеры этапов и показатели состояния в текстовом формате Prometheus"""
+    from aiohttp import web
+    return web.Response(text=metrics.render(), content_type='text/plain', charset='utf-8',
+                        headers={'X-Content-Type-Options': 'nosniff'})
+
+
+async def handle_health(request):
+    """GET /health: 200, если основные задачи работают и HTTP-сессия открыта, иначе 503 с остановленными задачами"""
+    from aiohttp import web
+    status = health_status()
+    return web.json_response(status, status=200 if status['status'] == 'ok' else 503)
+
+
+def register_gauges():
+    """Показатели состояния, которые вычисляются в момент запроса /metrics"""
+    metrics.gauge('outbox_size', lambda: len(outbox), 'Постов в очереди отправки')
+    metrics.gauge('jobs_pending', job_queue.pending, 'Невыполненных задач в общей очереди')
+    metrics.gauge('prepared_posts', lambda: len(candidate_store.list_prepared()), 'Подготовленных постов')
+    metrics.gauge('unpublished_candidates', candidate_store.count_unpublished, 'Неопубликованных постов в индексе')
+    metrics.gauge('published_posts', lambda: len(published_store), 'Опубликованных постов в журнале')
+    metrics.gauge('file_id_cache_entries', lambda: len(file_id_cache), 'Записей в кэше file_id')
+    metrics.gauge('last_publish_timestamp_seconds', lambda: last_publish['timestamp'],
+                  'Время последней успешной публикации (Unix)')
+    metrics.gauge('slot_lateness_seconds', lambda: last_publish['slot_lateness_seconds'],
+                  'Задержка запуска последнего слота публикации')
+    metrics.gauge('format_saved_bytes', lambda: format_savings['bytes'],
+                  'Байт скачивания, сэкономленных выбором формата под лимит Telegram')
+
+
+async def start_metrics_server():
+    """Запуск HTTP-сервера /metrics и /health. Возвращает AppRunner или None, если сервер отключен"""
+    if not METRICS_PORT:
+        return None
+    # Серверная часть aiohttp нужна только здесь, поэтому импортируется при запуске сервера
+    from aiohttp import web
+    register_gauges()
+    app = web.Application()
+    app.router.add_get('/metrics', handle_metrics)
+    app.router.add_get('/health', handle_health)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    except OSError as e:
+        # Например, порт занят другим процессом парсера на этой машине
+        logger.error(f"Не удалось запустить сервер замеров на {METRICS_HOST}:{METRICS_PORT}: {e}")
+        await runner.cleanup()
+        return None
+    logger.info(f"Замеры доступны на http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    return runner
+
+
+class VkExecuteError(Exception):
+    """Ошибка отдельного вызова API внутри метода execute"""
+
+    def __init__(self, code, message):
+        self.code = code
+        self.message = message
+        super().__init__(f"[{code}] {message}")
+
+
+def wall_get_params(group_id, count=100, offset=0):
+    """Параметры wall.get для короткого имени или числового ID группы"""
+    params = {'count': count, 'offset': offset, 'filter': 'owner'}
+    if isinstance(group_id, int):
+        params['owner_id'] = -group_id
+    else:
+        params['domain'] = group_id
+    return params
+
+
+def build_wall_get_script(calls):
+    """Формирует код VKScript, выполняющий несколько вызовов wall.get за один запрос"""
+    lines = ['var result = [];']
+    for params in calls:
+        lines.append(f"result.push(API.wall.get({json.dumps(params, ensure_ascii=False)}));")
+    lines.append('return result;')
+    return '\n'.join(lines)
+
+
+def split_execute_response(response, count):
+    """
+    Разбирает ответ execute на результаты отдельных вызовов.
+
+    Неудавшийся вызов возвращает в response значение false, а описание
+    ошибки попадает в execute_errors в том же порядке, что и сами вызовы.
+    Если результатов меньше, чем вызовов (execute прервался), недостающие
+    тоже считаются ошибками, чтобы результаты не сдвигались относительно групп.
+    """
+    items = response.get('response')
+    if not isinstance(items, list):
+        items = []
+    items = items[:count] + [None] * (count - len(items))
+    errors = iter(response.get('execute_errors', []))
+
+    results = []
+    for item in items:
+        if item is False or item is None:
+            error = next(errors, {})
+            results.append(VkExecuteError(error.get('error_code', 0),
+                                          error.get('error_msg', 'Unknown error')))
+        else:
+            results.append(item)
+    return results
+
+
+async def vk_execute(code):
+    """Вызов метода execute через общую HTTP-сессию, возвращает ответ целиком"""
+    with metrics.stage('vk_api') as record:
+        async with http_session.post(
+            f"{VK_API_URL}/execute",
+            data={'code': code, 'access_token': VK_TOKEN, 'v': VK_API_VERSION}
+        ) as response:
+            response.raise_for_status()
+            body = await response.read()
+        record['bytes_in'] = len(body)
+        result = json.loads(body)
+        if 'error' in result:
+            error = result['error']
+            raise VkExecuteError(error.get('error_code', 0), error.get('error_msg', 'Unknown error'))
+    return result
+
+
+async def vk_wall_get_batch(calls):
+    """Выполнение списка вызовов wall.get пачками через метод execute"""
+    results = []
+    for i in range(0, len(calls), VK_EXECUTE_BATCH_SIZE):
+        chunk = calls[i:i + VK_EXECUTE_BATCH_SIZE]
+        try:
+            response = await vk_execute(build_wall_get_script(chunk))
+            results.extend(split_execute_response(response, len(chunk)))
+        except Exception as e:
+            # Ошибка всего запроса (токен, сеть) относится ко всем вызовам пачки
+            results.extend([e] * len(chunk))
+    return results
+
+
+def start_timestamp():
+    """Дата START_DATE в виде timestamp"""
+    return int(datetime.datetime.strptime(START_DATE, '%Y-%m-%d').timestamp())
+
+
+def extract_video_posts(group_id, items, start_date):
+    """Отбор постов с видео и текстом из ответа wall.get"""
+    posts_with_videos = []
+
+    for post in items:
+        # Проверяем, что пост после указанной даты
+        if post['date'] < start_date:
+            continue
+
+        # Ищем видео в посте
+        video_urls = []
+        video_keys = []
+        attachments = []
+        duration = height = None
+
+        # Проверяем вложения
+        for attachment in post.get('attachments', []):
+            if attachment['type'] == 'video':
+                video = attachment['video']
+
+                # Формируем URL видео
+                owner_id = video['owner_id']
+                video_id = video['id']
+                access_key = video.get('access_key', '')
+
+                video_url = f"https://vk.com/video{owner_id}_{video_id}"
+                if access_key:
+                    video_url += f"_{access_key}"
+
+                video_urls.append(video_url)
+                video_keys.append(f"{owner_id}_{video_id}")
+                attachments.append({'type': 'video', 'url': video_url, 'key': f"{owner_id}_{video_id}"})
+                
+                # Метаданные первого видео — по ним оценивается стоимость подготовки
+                if duration is None:
+                    duration = video.get('duration')
+                    height = video.get('height')
+            
+            elif attachment['type'] == 'photo':
+                # Фото публикуются вместе с видео одним альбомом
+                photo_url = largest_photo_url(attachment['photo'])
+                if photo_url:
+                    attachments.append({'type': 'photo', 'url': photo_url})
+
+        # Если в посте есть видео и текст, добавляем его в список
+        if video_urls and post.get('text', '').strip():
+            candidate = {
+                'id': f"{group_id}_{post['id']}",
+                'text': post['text'],
+                'video_urls': video_urls,
+                'video_keys': video_keys,
+                'attachments': attachments,
+                'date': post['date'],
+                'group': group_id,
+                'duration': duration,
+                'est_size': estimate_video_size(duration, height)
+            }
+            candidate['score'] = candidate_score(candidate)
+            posts_with_videos.append(candidate)
+
+    return posts_with_videos
+
+
+def largest_photo_url(photo):
+    """Ссылка на самую большую копию фото из вложения ВК (у старых фото размеры бывают нулевыми)"""
+    sizes = [size for size in photo.get('sizes', []) if size.get('url')]
+    if not sizes:
+        return None
+    return max(sizes, key=lambda size: (size.get('width', 0) * size.get('height', 0),
+                                        PHOTO_SIZE_TYPES.find(size.get('type', ''))))['url']
+
+
+def estimate_video_size(duration, height=None):
+    """Оценка размера видео в байтах по длительности и высоте кадра из метаданных ВК"""
+    if not duration:
+        return None
+    height = height or DEFAULT_VIDEO_HEIGHT
+    bitrate_k = next((bitrate for max_height, bitrate in ESTIMATED_BITRATES_K if height <= max_height),
+                     ESTIMATED_BITRATES_K[-1][1])
+    return int(duration * bitrate_k * 1000 / 8)
+
+
+def candidate_score(post):
+    """
+    Приоритет поста при выборе: логарифм веса, который растет вдвое за каждые
+    FRESHNESS_HALF_LIFE_DAYS дней свежести и падает пропорционально стоимости
+    подготовки — объему скачивания, а для видео больше лимита Telegram еще и
+    перекодированию. Score зависит только от даты и метаданных поста, поэтому
+    считается один раз при добавлении и хранится в индексе.
+    """
+    size = post.get('est_size') or estimate_video_size(post.get('duration') or DEFAULT_VIDEO_DURATION)
+    cost_mb = max(size / (1024 * 1024), 1)
+    if cost_mb > MAX_VIDEO_SIZE_MB:
+        cost_mb *= 1 + TRANSCODE_COST_FACTOR
+    freshness = post['date'] * math.log(2) / (FRESHNESS_HALF_LIFE_DAYS * 86400)
+    return freshness - math.log(cost_mb)
+
+
+def get_group_state(state, group_id):
+    """
+    Состояние обхода группы:
+    last_id/last_date — самый новый уже просмотренный пост,
+    total — количество постов на стене при последнем обходе,
+    backfill_offset — смещение, с которого продолжается догрузка старых постов,
+    backfill_until — дата, до которой нужно догружать (START_DATE).
+    """
+    group_state = state['groups'].setdefault(group_key(group_id), {
+        'last_id': 0,
+        'last_date': 0,
+        'total': 0,
+        'backfill_offset': 0,
+        'backfill_done': False,
+        'backfill_until': 0,
+    })
+    # При изменении START_DATE догрузку нужно пройти заново
+    if group_state['backfill_until'] != start_timestamp():
+        group_state['backfill_until'] = start_timestamp()
+        group_state['backfill_offset'] = 0
+        group_state['backfill_done'] = False
+    return group_state
+
+
+async def crawl_new_posts(groups):
+    """
+    Получение только новых постов из групп.
+
+    Для каждой группы запрашивается первая страница стены, и листание
+    продолжается только пока не встретится уже просмотренный пост
+    (last_id), пост старше START_DATE или конец стены.
+    """
+    start_date = start_timestamp()
+
+    async with crawl_lock(), shared_lock('crawl'):
+        state = {'groups': candidate_store.load_crawl_state(), 'posts': []}
+        offsets = {group: 0 for group in groups}
+        top_posts = {}
+
+        for _ in range(VK_MAX_NEW_PAGES):
+            if not offsets:
+                break
+
+            batch = list(offsets)
+            responses = await vk_wall_get_batch(
+                [wall_get_params(group, VK_PAGE_SIZE, offsets[group]) for group in batch]
+            )
+
+            for group_id, response in zip(batch, responses):
+                offset = offsets.pop(group_id)
+                if isinstance(response, Exception):
+                    logger.error(f"Ошибка при получении постов из ВК (группа {group_id}): {response}")
+                    continue
+
+                group_state = get_group_state(state, group_id)
+                items = response['items']
+
+                if offset == 0:
+                    # Новые посты сдвигают стену, сдвигаем и курсор догрузки
+                    if group_state['total']:
+                        group_state['backfill_offset'] += max(response['count'] - group_state['total'], 0)
+                    group_state['total'] = response['count']
+
+                # Закрепленный пост может быть старым, он не влияет на условие остановки
+                new_items = [post for post in items if post['id'] > group_state['last_id']]
+                reached_known = any(not post.get('is_pinned') and
+                                    (post['id'] <= group_state['last_id'] or post['date'] < start_date)
+                                    for post in items)
+
+                for post in items:
+                    if post['id'] > top_posts.get(group_id, {}).get('id', 0):
+                        top_posts[group_id] = post
+
+                state['posts'].extend(extract_video_posts(group_id, new_items, start_date))
+
+                if group_state['last_id'] == 0:
+                    # Первый обход: старые страницы пройдет фоновая догрузка
+                    group_state['backfill_offset'] = max(group_state['backfill_offset'], len(items))
+                    if reached_known or len(items) < VK_PAGE_SIZE:
+                        group_state['backfill_done'] = True
+                elif not reached_known and len(items) == VK_PAGE_SIZE:
+                    offsets[group_id] = offset + VK_PAGE_SIZE
+
+        if offsets:
+            logger.warning(f"Новые посты просмотрены не полностью, достигнут лимит в {VK_MAX_NEW_PAGES} страниц")
+
+        # Обновляем отметки самых новых просмотренных постов
+        for group_id, post in top_posts.items():
+            group_state = get_group_state(state, group_id)
+            if post['id'] <= group_state['last_id']:
+                continue
+            group_state['last_id'] = post['id']
+            group_state['last_date'] = post['date']
+
+        added = candidate_store.save_crawl(state['groups'], state['posts'])
+
+    logger.info(f"Найдено {added} новых постов с видео")
+    return added
+
+
+async def backfill_step(groups=None):
+    """
+    Догрузка одной страницы старых постов для каждой группы.
+
+    Вызывается в фоне по расписанию и постепенно проходит стену
+    от backfill_offset вниз до START_DATE.
+    """
+    start_date = start_timestamp()
+    groups = VK_GROUPS if groups is None else groups
+
+    async with crawl_lock(), shared_lock('crawl'):
+        state = {'groups': candidate_store.load_crawl_state(), 'posts': []}
+        pending = []
+        for group in groups:
+            group_state = get_group_state(state, group)
+            if group_state['last_id'] and not group_state['backfill_done']:
+                pending.append(group)
+        if not pending:
+            return 0
+
+        responses = await vk_wall_get_batch(
+            [wall_get_params(group, VK_PAGE_SIZE, get_group_state(state, group)['backfill_offset'])
+             for group in pending]
+        )
+
+        for group_id, response in zip(pending, responses):
+            if isinstance(response, Exception):
+                logger.error(f"Ошибка при догрузке постов из ВК (группа {group_id}): {response}")
+                continue
+
+            group_state = get_group_state(state, group_id)
+            items = [post for post in response['items'] if not post.get('is_pinned')]
+            state['posts'].extend(extract_video_posts(group_id, items, start_date))
+            group_state['backfill_offset'] += len(response['items'])
+
+            if len(response['items']) < VK_PAGE_SIZE or any(post['date'] < start_date for post in items):
+                group_state['backfill_done'] = True
+                logger.info(f"Догрузка старых постов группы {group_id} завершена")
+
+        added = candidate_store.save_crawl(state['groups'], state['posts'])
+
+    if added:
+        logger.info(f"Догружено {added} старых постов с видео")
+    return added
+
+
+def host_slot(video_url):
+    """Семафор, ограничивающий число одновременных скачиваний с одного хоста"""
+    host = urlparse(video_url).hostname or ''
+    with host_slots_lock:
+        if host not in host_slots:
+            host_slots[host] = threading.BoundedSemaphore(DOWNLOAD_PER_HOST_LIMIT)
+        return host_slots[host]
+
+
+@asynccontextmanager
+async def hold_host_slot(video_url):
+    """
+    Место в лимите скачиваний с хоста для корутины. Если задачу отменили,
+    пока поток ждал места, место освобождается, как только поток его получит.
+    """
+    slot = host_slot(video_url)
+    acquired = asyncio.get_running_loop().run_in_executor(None, slot.acquire)
+    try:
+        await asyncio.shield(acquired)
+    except asyncio.CancelledError:
+        acquired.add_done_callback(lambda _: slot.release())
+        raise
+    try:
+        yield
+    finally:
+        slot.release()
+
+
+def is_transient_error(error):
+    """Проверка, что ошибку скачивания имеет смысл повторить (сеть, таймаут, 5xx)"""
+    message = str(error).lower()
+    return any(marker in message for marker in TRANSIENT_ERROR_MARKERS)
+
+
+def cpu_seconds():
+    """Процессорное время процесса и завершившихся дочерних процессов (ffmpeg)"""
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+def format_size(video_format, duration=None):
+    """Размер формата в байтах: точный, примерный или оценка по битрейту"""
+    size = video_format.get('filesize') or video_format.get('filesize_approx')
+    if not size and video_format.get('tbr') and duration:
+        size = video_format['tbr'] * 1000 / 8 * duration
+    return size
+
+
+def format_quality(video_format):
+    """Ключ сравнения форматов: MP4, затем высота кадра и битрейт"""
+    return (video_format.get('ext') == 'mp4', video_format.get('height') or 0, video_format.get('tbr') or 0)
+
+
+def combined_formats(info):
+    """Форматы со звуком и видео в одном файле"""
+    return [video_format for video_format in info.get('formats') or []
+            if video_format.get('vcodec') != 'none' and video_format.get('acodec') != 'none']
+
+
+def select_telegram_format(info):
+    """
+    Выбор формата наилучшего качества, размер которого укладывается в лимит
+    Telegram, чтобы не скачивать «best» и не пережимать его потом.
+    Возвращает None, если размеры форматов неизвестны.
+    """
+    duration = info.get('duration')
+    max_bytes = MAX_VIDEO_SIZE_MB * 1024 * 1024
+    fitting = [video_format for video_format in combined_formats(info)
+               if format_size(video_format, duration) and format_size(video_format, duration) <= max_bytes]
+    if not fitting:
+        return None
+    return max(fitting, key=format_quality)
+
+
+def count_format_savings(info, chosen_format):
+    """
+    Учет экономии от выбора формата под лимит Telegram вместо лучшего.
+    Вызывается, только когда выбранный формат действительно получен.
+    """
+    duration = info.get('duration')
+    max_bytes = MAX_VIDEO_SIZE_MB * 1024 * 1024
+    best_format = max(combined_formats(info), key=format_quality)
+    best_size = format_size(best_format, duration)
+    chosen_size = format_size(chosen_format, duration)
+
+    if chosen_format['format_id'] != best_format['format_id'] and best_size:
+        saved_bytes = max(best_size - chosen_size, 0)
+        saved_cpu = 0.0
+        if best_size > max_bytes:
+            # Лучший формат пришлось бы сжимать: оцениваем по замерам прошлых сжатий
+            with stats_lock:
+                if transcode_stats['megabytes']:
+                    seconds_per_mb = transcode_stats['cpu_seconds'] / transcode_stats['megabytes']
+                else:
+                    seconds_per_mb = DEFAULT_TRANSCODE_CPU_SECONDS_PER_MB
+            saved_cpu = best_size / (1024 * 1024) * seconds_per_mb
+        with stats_lock:
+            format_savings['bytes'] += saved_bytes
+            format_savings['cpu_seconds'] += saved_cpu
+            total_bytes, total_cpu = format_savings['bytes'], format_savings['cpu_seconds']
+        logger.info(
+            f"Выбран формат {chosen_format['format_id']} ({chosen_size / (1024 * 1024):.1f} МБ) "
+            f"вместо {best_format['format_id']} ({best_size / (1024 * 1024):.1f} МБ): "
+            f"сэкономлено {saved_bytes / (1024 * 1024):.1f} МБ и ~{saved_cpu:.0f} с процессора "
+            f"(всего {total_bytes / (1024 * 1024):.1f} МБ и ~{total_cpu:.0f} с)"
+        )
+
+
+def fetch_video(video_url, job_dir):
+    """Одна попытка скачивания видео в рабочую директорию задачи с помощью yt-dlp как Python-модуля"""
+    import yt_dlp
+    
+    output_path = os.path.join(job_dir, 'source.mp4')
+    
+    logger.info(f"Начинаем скачивание видео: {video_url}")
+    
+    # Опции для yt-dlp
+    ydl_opts = {
+        'format': 'best[ext=mp4]/best',
+        'merge_output_format': 'mp4',
+        'outtmpl': output_path,
+        'quiet': False,
+        'no_warnings': False,
+        'retries': 3,
+    }
+    if DOWNLOAD_RATE_LIMIT_KB:
+        ydl_opts['ratelimit'] = DOWNLOAD_RATE_LIMIT_KB * 1024
+    
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        # Сначала только метаданные: выбираем формат, который сразу пройдет в Telegram
+        info = ydl.extract_info(video_url, download=False)
+    
+    chosen_format = select_telegram_format(info)
+    if chosen_format:
+        # Селектор формата строится при создании YoutubeDL, поэтому для выбранного формата — отдельный экземпляр
+        ydl_opts['format'] = chosen_format['format_id']
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        result = ydl.process_ie_result(info, download=True)
+    
+    if chosen_format and result.get('format_id') == chosen_format['format_id']:
+        count_format_savings(info, chosen_format)
+    
+    if os.path.exists(output_path):
+        logger.info(f"Видео успешно скачано: {output_path}")
+        return output_path
+    
+    # Проверяем, был ли файл скачан с другим расширением: в директории задачи нет чужих файлов
+    for file in os.listdir(job_dir):
+        file_path = os.path.join(job_dir, file)
+        if os.path.isfile(file_path) and not file.endswith(('.part', '.ytdl')):
+            # Конвертация в MP4 выполняется при подготовке видео
+            logger.info(f"Видео скачано в формате, отличном от mp4: {file_path}")
+            return file_path
+    
+    raise RuntimeError(f"yt-dlp не создал файл для {video_url}")
+
+
+def fetch_photo(photo_url, job_dir):
+    """Одна попытка скачивания фото в рабочую директорию задачи"""
+    from urllib.request import urlopen
+    
+    output_path = os.path.join(job_dir, 'photo.jpg')
+    with urlopen(photo_url, timeout=HTTP_TIMEOUT_SECONDS) as response, open(output_path, 'wb') as f:
+        shutil.copyfileobj(response, f, STREAM_CHUNK_SIZE)
+    return output_path
+
+
+def download_media(attachment):
+    """
+    Скачивание видео или фото в отдельную рабочую директорию с ограничением
+    числа загрузок на хост и повтором временных ошибок с экспоненциальной задержкой
+    """
+    url = attachment['url']
+    fetch = fetch_photo if attachment['type'] == 'photo' else fetch_video
+    # Повторные попытки идут в той же директории: yt-dlp продолжает недокачанный файл
+    job_dir = create_job_workspace()
+    for attempt in range(1, DOWNLOAD_RETRIES + 1):
+        try:
+            with host_slot(url), metrics.stage('download') as record:
+                path = fetch(url, job_dir)
+                record['bytes_in'] = os.path.getsize(path)
+                return path
+        except Exception as e:
+            if attempt == DOWNLOAD_RETRIES or not is_transient_error(e):
+                logger.error(f"Ошибка при скачивании {url}: {e}")
+                remove_job_workspace(job_dir)
+                return None
+            delay = DOWNLOAD_RETRY_DELAY_SECONDS * 2 ** (attempt - 1) * random.uniform(0.8, 1.2)
+            logger.warning(f"Временная ошибка при скачивании ({e}), повтор через {delay:.0f} с")
+            time.sleep(delay)
+
+
+def map_parallel(func, items):
+    """
+    Вызов func для каждого элемента в пуле album_executor, результаты в
+    порядке items. Единственный элемент обрабатывается в текущем потоке.
+    """
+    if len(items) <= 1:
+        return [func(item) for item in items]
+    return list(album_executor.map(func, items))
+
+
+def fetch_attachment(attachment):
+    """
+    Скачивание одного вложения поста. У видео вычисляются ключи для поиска
+    дубликатов (ID видео ВК, содержимое, отпечаток кадров). Видео, которое
+    уже загружалось в Telegram, не скачивается: вложение получает file_id
+    из кэша, а path у него None.
+    Возвращает {'type', 'path', 'keys'} (и 'file_id') либо None.
+    """
+    if attachment['type'] == 'video' and attachment.get('key'):
+        key = f"video:{attachment['key']}"
+        cached = file_id_cache.get([key])
+        if cached:
+            logger.info(f"Видео {attachment['url']} уже загружено в Telegram, используем file_id из кэша")
+            return {'type': 'video', 'path': None, 'keys': [key], 'file_id': cached['file_id']}
+    
+    path = download_media(attachment)
+    if not path:
+        return None
+    
+    keys = []
+    if attachment['type'] == 'video':
+        try:
+            keys = media_dedup_keys(path)
+        except Exception as e:
+            logger.error(f"Ошибка при проверке скачанного видео {attachment['url']}: {e}")
+            remove_job_workspace(os.path.dirname(path))
+            return None
+        if attachment.get('key'):
+            keys.insert(0, f"video:{attachment['key']}")
+    return {'type': attachment['type'], 'path': path, 'keys': keys}
+
+
+def prepare_attachment(item):
+    """Приведение скачанного вложения к требованиям Telegram, возвращает путь к готовому файлу либо None"""
+    if item['path'] is None:
+        # Видео уже загружено в Telegram (file_id из кэша): готовить нечего
+        return None
+    if item['type'] == 'video':
+        return prepare_video(item['path'])
+    
+    file_size_mb = os.path.getsize(item['path']) / (1024 * 1024)
+    if file_size_mb > MAX_PHOTO_SIZE_MB:
+        logger.warning(f"Фото слишком большое ({file_size_mb:.2f} МБ), Telegram ограничивает размер до "
+                       f"{MAX_PHOTO_SIZE_MB} МБ")
+        return None
+    return item['path']
+
+
+def transcode_video(video_path):
+    """
+    Приведение видео к MP4 (H.264/AAC) не больше MAX_VIDEO_SIZE_MB одним
+    вызовом ffmpeg: без перекодирования, если кодеки уже подходят
+    """
+    try:
+        if not os.path.exists(video_path):
+            logger.error(f"Файл не существует: {video_path}")
+            return None
+        
+        file_size = os.path.getsize(video_path) / (1024 * 1024)
+        output_path = os.path.splitext(video_path)[0] + "_telegram.mp4"
+        
+        cpu_start = cpu_seconds()
+        with metrics.stage('transcode') as record:
+            record['bytes_in'] = os.path.getsize(video_path)
+            result_path = transcode_for_telegram(video_path, output_path, MAX_VIDEO_SIZE_MB * 1024 * 1024)
+            record['bytes_out'] = os.path.getsize(result_path)
+        
+        if result_path == video_path:
+            logger.info("Видео уже подходит для Telegram, обработка не требуется")
+            return video_path
+        
+        metrics.observe_ratio(record['bytes_out'] / max(record['bytes_in'], 1))
+        logger.info(f"Размер файла после обработки: {os.path.getsize(result_path) / (1024 * 1024):.2f} МБ "
+                    f"(исходный: {file_size:.2f} МБ)")
+        
+        if file_size > MAX_VIDEO_SIZE_MB:
+            # Запоминаем затраты на сжатие для оценки экономии от выбора формата
+            with stats_lock:
+                transcode_stats['cpu_seconds'] += cpu_seconds() - cpu_start
+                transcode_stats['megabytes'] += file_size
+        
+        return result_path
+    except Exception as e:
+        logger.error(f"Ошибка при обработке видео ffmpeg: {e}")
+        return None
+
+
+def file_content_hash(video_path, chunk_size=1024 * 1024):
+    """SHA-256 содержимого файла, читается потоково по частям"""
+    sha256 = hashlib.sha256()
+    with open(video_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def video_fingerprint(video_path, headers=None):
+    """
+    Дешевый перцептивный отпечаток видео: длительность в секундах и
+    average hash 8x8 нескольких кадров. Совпадает у одного и того же
+    ролика, перезалитого в другую группу с перекодированием. Для ссылки
+    на источник headers — HTTP-заголовки запроса.
+    """
+    duration = probe(video_path, headers)['duration']
+    if not duration:
+        raise TranscodeError(f"Не удалось определить длительность {video_path}")
+    return f"{int(round(duration))}:{frame_fingerprint(video_path, duration, headers=headers)}"
+
+
+def media_dedup_keys(video_path):
+    """Ключи для поиска дубликатов скачанного видео"""
+    with metrics.stage('dedup') as record:
+        record['bytes_in'] = os.path.getsize(video_path)
+        keys = [f"sha256:{file_content_hash(video_path)}"]
+        try:
+            keys.append(f"frames:{video_fingerprint(video_path)}")
+        except Exception as e:
+            logger.warning(f"Не удалось вычислить отпечаток кадров видео: {e}")
+            record['error'] = type(e).__name__
+    return keys
+
+
+def prepare_video(video_path):
+    """Приведение скачанного видео к требованиям Telegram: MP4, кодеки и размер"""
+    video_path = transcode_executor.submit(transcode_video, video_path).result()
+    if not video_path:
+        return None
+    
+    # Проверяем размер еще раз после обработки
+    file_size_mb = os.path.getsize(video_path) / (1024 * 1024)
+    if file_size_mb > 50:  # Telegram ограничивает размер до 50 МБ
+        logger.warning(f"Видео всё еще слишком большое ({file_size_mb:.2f} МБ), Telegram ограничивает размер до 50 МБ")
+        return None
+    
+    return video_path
+
+
+class TelegramError(Exception):
+    """Ошибка, которую вернул Bot API (ok = false)"""
+
+    def __init__(self, code, description, retry_after=None):
+        self.code = code
+        self.description = description
+        self.retry_after = retry_after
+        super().__init__(f"[{code}] {description}")
+
+
+class DuplicateMediaError(Exception):
+    """Передаваемое потоком видео совпадает с уже опубликованным"""
+
+
+class TokenBucket:
+    """
+    Ограничитель частоты запросов: в среднем rate запросов в секунду,
+    всплеск до capacity. Ответ 429 приостанавливает все запросы на retry_after.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = None
+        self.lock_loop = None
+
+    def _lock(self):
+        """Блокировка текущего цикла событий (ограничитель создается при импорте, вне цикла)"""
+        loop = asyncio.get_running_loop()
+        if self.lock_loop is not loop:
+            self.lock, self.lock_loop = asyncio.Lock(), loop
+        return self.lock
+
+    async def acquire(self):
+        async with self._lock():
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+# Лимиты Telegram: общий на бота и на каждый канал
+telegram_bucket = TokenBucket(TELEGRAM_MESSAGES_PER_SECOND, TELEGRAM_MESSAGES_PER_SECOND)
+channel_buckets = {}
+
+
+async def telegram_request(method, data, timeout=HTTP_TIMEOUT_SECONDS, headers=None):
+    """Вызов метода Bot API через общую HTTP-сессию, возвращает поле result ответа"""
+    async with http_session.post(
+        f"{TELEGRAM_API_URL}/bot{TELEGRAM_BOT_TOKEN}/{method}",
+        data=data,
+        headers=headers,
+        timeout=aiohttp.ClientTimeout(total=timeout)
+    ) as response:
+        try:
+            result = await response.json(content_type=None)
+        except ValueError:
+            # Например, HTML-страница 502 от прокси вместо ответа Bot API
+            raise TelegramError(response.status, response.reason or 'Invalid response')
+    if not result.get('ok'):
+        retry_after = (result.get('parameters') or {}).get('retry_after')
+        if retry_after:
+            logger.warning(f"Telegram ограничил частоту запросов, пауза {retry_after} с")
+            telegram_bucket.pause(retry_after)
+        raise TelegramError(result.get('error_code', response.status), result.get('description', ''), retry_after)
+    return result['result']
+
+
+async def send_message(method, chat_id, data, **kwargs):
+    """Вызов метода отправки в канал с соблюдением лимитов частоты: общего и для канала"""
+    if chat_id not in channel_buckets:
+        channel_buckets[chat_id] = TokenBucket(TELEGRAM_CHANNEL_MESSAGES_PER_MINUTE / 60, 1)
+    await channel_buckets[chat_id].acquire()
+    await telegram_bucket.acquire()
+    return await telegram_request(method, data, **kwargs)
+
+
+async def send_video(chat_id, data, **kwargs):
+    """Вызов sendVideo с соблюдением лимитов частоты"""
+    return await send_message('sendVideo', chat_id, data, **kwargs)
+
+
+async def send_media_group(chat_id, data, **kwargs):
+    """Вызов sendMediaGroup (альбом — один запрос) с соблюдением лимитов частоты"""
+    return await send_message('sendMediaGroup', chat_id, data, **kwargs)
+
+
+def is_file_id_error(error):
+    """Telegram не принимает сохраненный file_id (файл удален или id устарел)"""
+    return isinstance(error, TelegramError) and 'file' in error.description.lower() and error.code == 400
+
+
+def is_missing_file_error(error):
+    """Подготовленный файл не открывается: вытеснен из кэша или удален после перезапуска"""
+    return isinstance(error, OSError) and not isinstance(error, (aiohttp.ClientError, asyncio.TimeoutError))
+
+
+def send_retry_delay(error, attempt):
+    """
+    Задержка перед повторной отправкой в секундах: retry_after для flood-wait,
+    экспоненциальная для таймаутов, сетевых ошибок и 5xx.
+    None — повтор бессмысленен (неверная подпись, нет прав в канале и т. п.).
+    """
+    if isinstance(error, TelegramError):
+        if error.retry_after:
+            return error.retry_after
+        if error.code < 500:
+            return None
+    elif not isinstance(error, (asyncio.TimeoutError, aiohttp.ClientError)):
+        return None
+    return OUTBOX_RETRY_DELAY_SECONDS * 2 ** (attempt - 1) * random.uniform(0.8, 1.2)
+
+
+def channels_for_group(group_id):
+    """Каналы, в которые публикуются посты группы: по CHANNEL_ROUTES, иначе TELEGRAM_CHANNEL_ID"""
+    channels = CHANNEL_ROUTES.get(group_id) or [TELEGRAM_CHANNEL_ID]
+    return [channel for channel in dict.fromkeys(channels) if channel]
+
+
+def video_fields(chat_id, text):
+    """Поля запроса sendVideo, кроме самого видео"""
+    return {
+        'chat_id': str(chat_id),
+        'caption': text[:1024],  # Ограничение Telegram на длину подписи
+        'parse_mode': 'HTML',
+        'supports_streaming': 'true',
+    }
+
+
+def sent_media(message):
+    """
+    Видео из ответа sendVideo (Telegram может сохранить ролик как анимацию
+    или документ) либо самая большая копия фото из ответа sendMediaGroup
+    """
+    if message.get('photo'):
+        return message['photo'][-1]
+    return message.get('video') or message.get('animation') or message.get('document') or {}
+
+
+def remember_file_id(message, media_keys):
+    """Сохранение file_id загруженного видео в кэш под точными ключами видео"""
+    media = sent_media(message)
+    keys = [key for key in media_keys if key.startswith(FILE_ID_KEY_PREFIXES)]
+    if media.get('file_id') and keys:
+        file_id_cache.put(keys, media['file_id'], media.get('file_size'), media.get('duration'))
+
+
+async def fan_out_video(file_id, text, channels):
+    """
+    Публикация уже загруженного видео в каналы по file_id: файл
+    повторно не передается. Возвращает словарь {канал: ошибка или None}.
+    """
+    if not channels:
+        return {}
+    
+    if not file_id:
+        logger.error(f"В ответе Telegram нет file_id, пост не отправлен в каналы {', '.join(map(str, channels))}")
+        return {channel: TelegramError(0, 'No file_id in sendVideo response') for channel in channels}
+    
+    async def send_by_file_id(channel):
+        with metrics.stage('fan_out'):
+            return await send_video(channel, {**video_fields(channel, text), 'video': file_id})
+    
+    results = await asyncio.gather(*(send_by_file_id(channel) for channel in channels), return_exceptions=True)
+    errors = {}
+    for channel, result in zip(channels, results):
+        if isinstance(result, Exception):
+            logger.error(f"Ошибка при публикации в канал {channel}: {result or type(result).__name__}")
+            errors[channel] = result
+        else:
+            logger.info(f"Пост успешно опубликован в канале {channel} (по file_id)")
+            errors[channel] = None
+    return errors
+
+
+async def post_to_telegram(text, video_path, channels, media_keys=(), file_id=None):
+    """
+    Публикация поста в Телеграм-каналы: видео загружается в первый канал,
+    который его принял, а в остальные отправляется по file_id. Если видео
+    с такими media_keys уже загружалось, файл не передается совсем.
+    Пост, подготовленный по file_id из кэша, не имеет файла (video_path
+    None): тогда используется file_id, сохраненный при подготовке.
+    Возвращает словарь {канал: ошибка или None}.
+    """
+    errors = {}
+    cached = file_id_cache.get(key for key in media_keys if key.startswith(FILE_ID_KEY_PREFIXES))
+    file_id = cached['file_id'] if cached else file_id
+    if file_id:
+        logger.info("Видео уже загружено в Telegram, отправляем по file_id из кэша")
+        errors = await fan_out_video(file_id, text, channels)
+        stale = [channel for channel, error in errors.items() if is_file_id_error(error)]
+        if not stale:
+            return errors
+        # file_id устарел — удаляем его и загружаем видео заново
+        file_id_cache.discard(file_id)
+        if video_path is None:
+            logger.warning("Сохраненный file_id устарел, а файла нет: пост будет подготовлен заново")
+            return errors
+        channels = stale
+    
+    for index, channel in enumerate(channels):
+        try:
+            # Отправляем видео с текстом в Телеграм, файл читается и передается по частям
+            with metrics.stage('upload') as record, open(video_path, 'rb') as video_file:
+                form = aiohttp.FormData(video_fields(channel, text))
+                form.add_field('video', video_file, filename=os.path.basename(video_path), content_type='video/mp4')
+                message = await send_video(channel, form, timeout=TELEGRAM_UPLOAD_TIMEOUT_SECONDS)
+                record['bytes_out'] = os.path.getsize(video_path)
+        
+        except Exception as e:
+            logger.error(f"Ошибка при публикации в канал {channel}: {e or type(e).__name__}")
+            errors[channel] = e
+            if send_retry_delay(e, 1) is not None:
+                # Таймаут или flood-wait повторятся и для остальных каналов — отправим их позже вместе
+                errors.update({other: e for other in channels[index + 1:]})
+                return errors
+            continue
+        
+        logger.info(f"Пост успешно опубликован в канале {channel}")
+        errors[channel] = None
+        remember_file_id(message, media_keys)
+        errors.update(await fan_out_video(sent_media(message).get('file_id'), text, channels[index + 1:]))
+        return errors
+    
+    return errors
+
+
+def album_fields(chat_id, text, media, file_ids):
+    """
+    Поля запроса sendMediaGroup, кроме самих файлов. Подпись ставится у
+    первого вложения — Telegram показывает ее как подпись альбома.
+    Вложение с file_id отправляется без загрузки, остальные передаются в
+    запросе частями media0, media1 и т. д.
+    """
+    album = []
+    for index, (item, file_id) in enumerate(zip(media, file_ids)):
+        entry = {'type': item['type'], 'media': file_id or f"attach://media{index}"}
+        if item['type'] == 'video':
+            entry['supports_streaming'] = True
+        if index == 0:
+            entry.update(caption=text[:1024], parse_mode='HTML')
+        album.append(entry)
+    return {'chat_id': str(chat_id), 'media': json.dumps(album, ensure_ascii=False)}
+
+
+async def fan_out_album(file_ids, text, media, channels):
+    """
+    Публикация уже загруженного альбома в каналы по file_id вложений.
+    Возвращает словарь {канал: ошибка или None}.
+    """
+    if not channels:
+        return {}
+    
+    if not all(file_ids):
+        logger.error(f"В ответе Telegram нет file_id, альбом не отправлен в каналы {', '.join(map(str, channels))}")
+        return {channel: TelegramError(0, 'No file_id in sendMediaGroup response') for channel in channels}
+    
+    async def send_by_file_ids(channel):
+        with metrics.stage('fan_out'):
+            return await send_media_group(channel, album_fields(channel, text, media, file_ids))
+    
+    results = await asyncio.gather(*(send_by_file_ids(channel) for channel in channels), return_exceptions=True)
+    errors = {}
+    for channel, result in zip(channels, results):
+        if isinstance(result, Exception):
+            logger.error(f"Ошибка при публикации в канал {channel}: {result or type(result).__name__}")
+            errors[channel] = result
+        else:
+            logger.info(f"Альбом успешно опубликован в канале {channel} (по file_id)")
+            errors[channel] = None
+    return errors
+
+
+async def post_album_to_telegram(text, media, channels):
+    """
+    Публикация поста с несколькими вложениями одним альбомом sendMediaGroup
+    вместо отдельного сообщения на каждое видео. Файлы загружаются в первый
+    канал, который принял альбом, в остальные альбом отправляется по file_id.
+    Видео, уже загруженные раньше, не передаются повторно (кэш file_id).
+    Единственное вложение отправляется обычным сообщением. Из альбома
+    больше MAX_ALBUM_SIZE отправляются только первые MAX_ALBUM_SIZE
+    вложений: пост остается одним сообщением, и повтор из очереди отправки
+    не дублирует уже доставленные части.
+    Возвращает словарь {канал: ошибка или None}.
+    """
+    if len(media) == 1:
+        return await post_to_telegram(text, media[0]['path'], channels, media[0]['keys'],
+                                      file_id=media[0].get('file_id'))
+    if len(media) > MAX_ALBUM_SIZE:
+        logger.warning(f"В альбоме {len(media)} вложений, Telegram принимает не больше {MAX_ALBUM_SIZE}: "
+                       f"отправляем первые {MAX_ALBUM_SIZE}")
+        media = media[:MAX_ALBUM_SIZE]
+    
+    errors = {}
+    cached = [file_id_cache.get(key for key in item['keys'] if key.startswith(FILE_ID_KEY_PREFIXES))
+              for item in media]
+    file_ids = [entry['file_id'] if entry else item.get('file_id') for entry, item in zip(cached, media)]
+    
+    index = 0
+    while index < len(channels):
+        channel = channels[index]
+        try:
+            with metrics.stage('upload') as record, ExitStack() as files:
+                form = aiohttp.FormData(album_fields(channel, text, media, file_ids))
+                for number, (item, file_id) in enumerate(zip(media, file_ids)):
+                    if file_id is None:
+                        form.add_field(f'media{number}', files.enter_context(open(item['path'], 'rb')),
+                                       filename=os.path.basename(item['path']),
+                                       content_type='image/jpeg' if item['type'] == 'photo' else 'video/mp4')
+                messages = await send_media_group(channel, form, timeout=TELEGRAM_UPLOAD_TIMEOUT_SECONDS)
+                record['bytes_out'] = sum(os.path.getsize(item['path'])
+                                          for item, file_id in zip(media, file_ids) if file_id is None)
+        
+        except Exception as e:
+            if is_file_id_error(e) and any(file_ids):
+                # Сохраненный file_id устарел — удаляем его и загружаем все файлы альбома заново
+                logger.warning(f"Telegram не принял сохраненные file_id альбома ({e}), загружаем файлы заново")
+                for file_id in filter(None, file_ids):
+                    file_id_cache.discard(file_id)
+                if not all(item['path'] for item in media):
+                    logger.warning("Файлов альбома, подготовленного по file_id, нет: пост будет подготовлен заново")
+                    errors.update({other: e for other in channels[index:]})
+                    return errors
+                file_ids = [None] * len(media)
+                continue
+            logger.error(f"Ошибка при публикации в канал {channel}: {e or type(e).__name__}")
+            errors[channel] = e
+            if send_retry_delay(e, 1) is not None:
+                # Таймаут или flood-wait повторятся и для остальных каналов — отправим их позже вместе
+                errors.update({other: e for other in channels[index + 1:]})
+                return errors
+            index += 1
+            continue
+        
+        logger.info(f"Альбом из {len(media)} вложений успешно опубликован в канале {channel}")
+        errors[channel] = None
+        for item, message in zip(media, messages):
+            remember_file_id(message, item['keys'])
+        file_ids = [sent_media(message).get('file_id') for message in messages]
+        errors.update(await fan_out_album(file_ids, text, media, channels[index + 1:]))
+        return errors
+    
+    return errors
+
+
+async def deliver_outbox_item(item):
+    """
+    Попытка доставить пост из очереди во все оставшиеся каналы. Каналы с
+    временными ошибками (flood-wait, таймаут, 5xx) переносятся на потом,
+    с окончательными — отбрасываются. Подготовленное видео удаляется,
+    только когда пост покидает очередь. Пост, не опубликованный ни в одном
+    канале, откладывается (временные ошибки, устаревший file_id или
+    удаленный подготовленный файл — пост будет подготовлен заново) или
+    пропускается (окончательные ошибки).
+    """
+    post = item['post']
+    media = prepared_media(post)
+    for media_item in media:
+        media_cache.touch(media_item['path'])
+    if len(media) > 1:
+        errors = await post_album_to_telegram(post['text'], media, item['channels'])
+    else:
+        errors = await post_to_telegram(post['text'], media[0]['path'], item['channels'], post['media_keys'],
+                                        file_id=media[0].get('file_id'))
+    delivered = item['delivered'] + [channel for channel, error in errors.items() if error is None]
+    attempts = item['attempts'] + 1
+    
+    if delivered and not item['delivered']:
+        mark_post_published(post, post['media_keys'])
+    
+    retry = {channel: error for channel, error in errors.items()
+             if error is not None and send_retry_delay(error, attempts) is not None}
+    if retry and attempts < OUTBOX_MAX_ATTEMPTS:
+        delay = max(send_retry_delay(error, attempts) for error in retry.values())
+        outbox.reschedule(post['id'], list(retry), delivered, attempts, time.time() + delay,
+                          repr(next(iter(retry.values()))))
+        logger.warning(f"Пост {post['id']} не доставлен в каналы {', '.join(map(str, retry))}, "
+                       f"повтор через {delay:.0f} с (попытка {attempts} из {OUTBOX_MAX_ATTEMPTS})")
+        return
+    
+    if retry:
+        logger.error(f"Пост {post['id']} не доставлен в каналы {', '.join(map(str, retry))} "
+                     f"за {attempts} попыток, удаляем его из очереди")
+    outbox.remove(post['id'])
+    remove_prepared(post)
+    if not delivered:
+        logger.error(f"Пост {post['id']} не опубликован ни в одном канале")
+        if retry:
+            defer_candidate(post, f"не доставлен за {attempts} попыток: {next(iter(retry.values()))!r}")
+        elif any(is_file_id_error(error) for error in errors.values()):
+            defer_candidate(post, "сохраненный file_id устарел")
+        elif any(is_missing_file_error(error) for error in errors.values()):
+            defer_candidate(post, "подготовленный файл удален")
+        else:
+            candidate_store.mark_skipped(post['id'])
+
+
+async def process_outbox():
+    """
+    Отправка постов из очереди, время отправки которых наступило. Пост
+    доставляет тот процесс, который взял его в аренду, поэтому несколько
+    процессов не отправляют один пост дважды.
+    """
+    async with outbox_lock():
+        for item in outbox.due():
+            post_id = item['post']['id']
+            if not job_queue.acquire(f"outbox:{post_id}", worker_id, WORKER_LEASE_SECONDS):
+                continue
+            try:
+                # Пока очередь читалась, пост мог доставить другой процесс
+                item = outbox.get(post_id)
+                if item is not None and item['next_attempt_at'] <= time.time():
+                    await deliver_outbox_item(item)
+            except Exception as e:
+                logger.error(f"Ошибка при отправке поста {post_id} из очереди: {e}")
+            finally:
+                job_queue.release(f"outbox:{post_id}", worker_id)
+
+
+async def outbox_loop():
+    """Фоновая отправка постов из очереди: повторы после ошибок и после перезапуска"""
+    while True:
+        try:
+            await process_outbox()
+        except Exception as e:
+            logger.error(f"Ошибка при обработке очереди отправки: {e}")
+        await asyncio.sleep(OUTBOX_INTERVAL_SECONDS)
+
+
+def resolve_stream_source(video_url):
+    """
+    Прямая ссылка на MP4 (H.264/AAC), который уже укладывается в лимит
+    Telegram и может быть передан в загрузку без сохранения на диск.
+    Возвращает None, если видео нужно скачать и обработать обычным путем.
+    """
+    import yt_dlp
+    
+    with yt_dlp.YoutubeDL({'quiet': True, 'no_warnings': True}) as ydl:
+        info = ydl.extract_info(video_url, download=False)
+    
+    chosen_format = select_telegram_format(info)
+    if not chosen_format:
+        return None
+    
+    vcodec = chosen_format.get('vcodec') or 'avc1'
+    acodec = chosen_format.get('acodec') or 'mp4a'
+    if (chosen_format.get('ext') != 'mp4'
+            or chosen_format.get('protocol') not in ('http', 'https')
+            or not vcodec.startswith(('avc1', 'h264'))
+            or not acodec.startswith(('mp4a', 'aac'))):
+        return None
+    
+    return {
+        'url': chosen_format['url'],
+        'headers': chosen_format.get('http_headers') or {},
+        'filesize': chosen_format.get('filesize'),
+        'info': info,
+        'format': chosen_format,
+    }
+
+
+def stream_fingerprint(source):
+    """
+    Ключ отпечатка кадров видео по прямой ссылке источника, как у скачанного
+    файла в media_dedup_keys. None, если ffmpeg не смог прочитать источник.
+    """
+    try:
+        return f"frames:{video_fingerprint(source['url'], source.get('headers'))}"
+    except Exception as e:
+        logger.warning(f"Не удалось вычислить отпечаток кадров видео по ссылке: {e}")
+        return None
+
+
+def multipart_envelope(fields, file_field, filename, boundary):
+    """Начало и конец тела multipart/form-data, между которыми передается содержимое файла"""
+    head = ''.join(
+        f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'
+        for name, value in fields.items()
+    )
+    head += (f'--{boundary}\r\nContent-Disposition: form-data; name="{file_field}"; filename="{filename}"\r\n'
+             f'Content-Type: video/mp4\r\n\r\n')
+    return head.encode('utf-8'), f'\r\n--{boundary}--\r\n'.encode('utf-8')
+
+
+async def stream_video_to_telegram(text, source, channels, media_keys=()):
+    """
+    Публикация видео без временного файла: ответ источника по частям
+    передается прямо в запрос sendVideo первого канала, в остальные каналы
+    видео отправляется по file_id. При успехе возвращает SHA-256 переданного
+    содержимого, file_id видео и ошибки по каналам {'sha256', 'file_id',
+    'errors'}, иначе None. Если хэш содержимого совпал с уже
+    опубликованным видео, загрузка обрывается до последней части запроса
+    (Telegram не создает сообщение) и выбрасывается DuplicateMediaError.
+    """
+    sha256 = hashlib.sha256()
+    boundary = uuid.uuid4().hex
+    head, tail = multipart_envelope(video_fields(channels[0], text), 'video', 'video.mp4', boundary)
+    
+    streamed = {'bytes': 0, 'duplicate': False}
+    started = time.perf_counter()
+    try:
+        # Лимит скачиваний с хоста общий с потоками пула download_executor
+        async with hold_host_slot(source['url']), http_session.get(
+            source['url'],
+            headers=source['headers'],
+            timeout=aiohttp.ClientTimeout(total=None, sock_read=HTTP_TIMEOUT_SECONDS)
+        ) as response:
+            response.raise_for_status()
+            
+            # Размер берется из ответа источника: в метаданных он бывает приблизительным,
+            # а при сжатии ответа Content-Length не равен числу переданных байт
+            file_size = None if response.headers.get('Content-Encoding') else response.content_length
+            if file_size and source['filesize'] and file_size != source['filesize']:
+                logger.warning(f"Размер видео в метаданных ({source['filesize']} байт) не совпадает с ответом "
+                               f"источника ({file_size} байт), передаем по ответу источника")
+            if file_size and file_size > MAX_VIDEO_SIZE_MB * 1024 * 1024:
+                raise ValueError(f"Видео больше лимита: {file_size / (1024 * 1024):.1f} МБ")
+            
+            async def body():
+                yield head
+                async for chunk in response.content.iter_chunked(STREAM_CHUNK_SIZE):
+                    sha256.update(chunk)
+                    streamed['bytes'] += len(chunk)
+                    yield chunk
+                # Последняя часть не отправляется, пока содержимое не проверено: без нее запрос неполон
+                if file_size and streamed['bytes'] != file_size:
+                    raise ValueError(f"Источник передал {streamed['bytes']} байт вместо {file_size}")
+                media_store.refresh()
+                if f"sha256:{sha256.hexdigest()}" in media_store:
+                    streamed['duplicate'] = True
+                    raise DuplicateMediaError(sha256.hexdigest())
+                yield tail
+            
+            headers = {'Content-Type': f'multipart/form-data; boundary={boundary}'}
+            if file_size:
+                # Известный размер — передаем с Content-Length, иначе chunked
+                headers['Content-Length'] = str(len(head) + file_size + len(tail))
+            
+            message = await send_video(channels[0], body(), timeout=TELEGRAM_UPLOAD_TIMEOUT_SECONDS,
+                                       headers=headers)
+    
+    except Exception as e:
+        metrics.observe('stream', time.perf_counter() - started, streamed['bytes'], streamed['bytes'],
+                        error=type(e).__name__)
+        if streamed['duplicate']:
+            logger.info("Видео совпадает с уже опубликованным, потоковая загрузка прервана")
+            raise DuplicateMediaError(sha256.hexdigest()) from e
+        if isinstance(e, TelegramError):
+            logger.error(f"Ошибка при публикации в канал {channels[0]}: {e}")
+        else:
+            logger.error(f"Ошибка при потоковой публикации видео: {e}")
+        return None
+    
+    metrics.observe('stream', time.perf_counter() - started, streamed['bytes'], streamed['bytes'])
+    logger.info(f"Пост успешно опубликован в канале {channels[0]} (потоковая загрузка)")
+    remember_file_id(message, [*media_keys, f"sha256:{sha256.hexdigest()}"])
+    file_id = sent_media(message).get('file_id')
+    errors = {channels[0]: None, **await fan_out_video(file_id, text, channels[1:])}
+    return {'sha256': sha256.hexdigest(), 'file_id': file_id, 'errors': errors}
+
+
+def enqueue_undelivered(post, errors):
+    """
+    Постановка в очередь отправки каналов, в которые пост, опубликованный в
+    обход очереди, не доставлен из-за временной ошибки (flood-wait, таймаут,
+    5xx): очередь повторит отправку по file_id вложений поста
+    """
+    delivered = [channel for channel, error in errors.items() if error is None]
+    retry = {channel: error for channel, error in errors.items()
+             if error is not None and send_retry_delay(error, 1) is not None}
+    if not retry:
+        return
+    delay = max(send_retry_delay(error, 1) for error in retry.values())
+    outbox.add(post, list(retry))
+    outbox.reschedule(post['id'], list(retry), delivered, 1, time.time() + delay, repr(next(iter(retry.values()))))
+    logger.warning(f"Пост {post['id']} не доставлен в каналы {', '.join(map(str, retry))}, "
+                   f"повтор из очереди отправки через {delay:.0f} с")
+
+
+async def stream_next_post():
+    """
+    Публикация следующего поста потоком без скачивания на диск, если его видео
+    уже подходит для Telegram. Посты с несколькими вложениями публикуются
+    альбомом и потоком не передаются. Возвращает True, если пост опубликован.
+    """
+    post = pick_candidate()
+    if post is None:
+        return False
+    
+    try:
+        if len(post['attachments']) > 1:
+            logger.info(f"У поста {post['id']} несколько вложений, готовим его альбомом")
+            return False
+        
+        for video_url, video_key in zip(post['video_urls'], post['video_keys'] or [None] * len(post['video_urls'])):
+            if video_key and f"video:{video_key}" in media_store:
+                continue
+            
+            video_keys = [f"video:{video_key}"] if video_key else []
+            channels = channels_for_group(post['group'])
+            
+            loop = asyncio.get_running_loop()
+            
+            # Видео уже загружалось в Telegram (например, публикация прервалась): пост готовится
+            # по file_id из кэша без скачивания и отправляется через очередь отправки
+            if file_id_cache.get(video_keys):
+                logger.info(f"Видео поста {post['id']} уже загружено в Telegram, отправляем по file_id")
+                prepared = await loop.run_in_executor(download_executor, prepare_post, post)
+                if not prepared:
+                    return False
+                outbox.add(outbox_post(post, prepared), channels)
+                await process_outbox()
+                return True
+            
+            source = await loop.run_in_executor(download_executor, resolve_stream_source, video_url)
+            if source is None:
+                logger.info(f"Видео поста {post['id']} требует обработки, потоковая загрузка невозможна")
+                return False
+            
+            # Перезалитый ролик: отпечаток кадров снимается по ссылке источника (ffmpeg читает только
+            # нужные части), совпадение содержимого проверяется по хэшу во время передачи
+            fingerprint = await loop.run_in_executor(download_executor, stream_fingerprint, source)
+            if fingerprint is None:
+                logger.info(f"Видео поста {post['id']} не удалось проверить на дубликат без скачивания")
+                return False
+            media_store.refresh()
+            if fingerprint in media_store:
+                logger.info(f"Видео поста {post['id']} совпадает с уже опубликованным, пропускаем пост")
+                candidate_store.mark_skipped(post['id'])
+                return False
+            
+            try:
+                result = await stream_video_to_telegram(post['text'], source, channels, video_keys)
+            except DuplicateMediaError:
+                logger.info(f"Видео поста {post['id']} совпадает с уже опубликованным, пропускаем пост")
+                candidate_store.mark_skipped(post['id'])
+                return False
+            if result is None:
+                return False
+            count_format_savings(source['info'], source['format'])
+            
+            media_keys = video_keys + [f"sha256:{result['sha256']}", fingerprint]
+            mark_post_published(post, media_keys)
+            # Каналы, не принявшие видео по file_id из-за временной ошибки, получат пост из очереди отправки
+            media = [{'type': 'video', 'path': None, 'keys': media_keys, 'file_id': result['file_id']}]
+            enqueue_undelivered(outbox_post(post, media), result['errors'])
+            return True
+        return False
+    except Exception as e:
+        logger.error(f"Ошибка при потоковой публикации поста {post['id']}: {e}")
+        return False
+    finally:
+        release_candidate(post)
+
+
+def clean_temp_directory():
+    """
+    Очистка временной директории при запуске: удаляются рабочие директории
+    задач, оборванных прошлым запуском, и файлы в корне TEMP_DIR. Кэш
+    подготовленных видео сохраняется.
+    """
+    try:
+        os.makedirs(TEMP_DIR, exist_ok=True)
+        # Рабочие директории задач этого и остановившихся процессов; директории работающих не трогаем
+        alive = job_queue.held('worker:') - {worker_id}
+        if os.path.isdir(JOBS_DIR):
+            for name in os.listdir(JOBS_DIR):
+                if name not in alive:
+                    shutil.rmtree(os.path.join(JOBS_DIR, name), ignore_errors=True)
+        for file in os.listdir(TEMP_DIR):
+            file_path = os.path.join(TEMP_DIR, file)
+            if os.path.isfile(file_path):
+                os.remove(file_path)
+        logger.info("Временная директория очищена")
+    except Exception as e:
+        logger.error(f"Ошибка при очистке временной директории: {e}")
+
+
+def pick_candidate():
+    """
+    Выбор неопубликованного и еще не подготовленного поста из локального
+    индекса. Группа выбирается случайно с весом из GROUP_WEIGHTS, деленным
+    на число ее публикаций за GROUP_QUOTA_WINDOW_DAYS дней, поэтому группы,
+    отстающие от своей доли, выпадают чаще. Внутри группы берется один из
+    SELECTION_TOP_K лучших по score постов с весом exp(score): свежие и
+    дешевые в подготовке посты выбираются чаще, отложенные после неудачи —
+    не выбираются. Выбранный пост резервируется, чтобы параллельные задачи
+    подготовки не взяли его же.
+    """
+    published_store.refresh()
+    recent = candidate_store.recent_published_counts(time.time() - GROUP_QUOTA_WINDOW_DAYS * 86400)
+    group_weights = {group: GROUP_WEIGHTS.get(group, 1) / (1 + recent.get(group_key(group), 0))
+                     for group in enabled_groups()}
+    
+    while group_weights:
+        group = random.choices(list(group_weights), weights=list(group_weights.values()))[0]
+        post = pick_group_candidate(group)
+        if post is not None:
+            return post
+        # В группе не осталось доступных постов — выбираем среди остальных
+        del group_weights[group]
+    return None
+
 
-# Инициализация бота Telegram
-bot = Bot(token=TELEGRAM_BOT_TOKEN)
+def enabled_groups():
+    """Группы, из которых публикуются посты: вес 0 в GROUP_WEIGHTS отключает группу"""
+    return [group for group in VK_GROUPS if GROUP_WEIGHTS.get(group, 1) > 0]
 
-# Московский часовой пояс
-moscow_tz = pytz.timezone('Europe/Moscow')
 
-# URL вашего сервиса на Render (заполните после деплоя)
-SERVICE_URL = "https://vk-tg-parser.onrender.com"  # Замените на ваш URL
+def pick_group_candidate(group):
+    """Один из лучших по score доступных постов группы (с резервированием) либо None"""
+    for _ in range(MAX_CANDIDATE_ATTEMPTS):
+        # Посты, которые готовит этот процесс или держат другие процессы
+        busy = job_queue.held('post:')
+        with preparing_lock:
+            busy |= preparing_posts
+        posts = candidate_store.top_unpublished(group, SELECTION_TOP_K, exclude=list(busy))
+        if not posts:
+            return None
+        
+        available = []
+        for post in posts:
+            if post['id'] in published_store:
+                # Пост уже есть в журнале опубликованных — переносим отметку в индекс
+                candidate_store.mark_published(post['id'])
+            else:
+                available.append(post)
+        if not available:
+            continue
+        
+        scores = [candidate_score(post) if post['score'] is None else post['score'] for post in available]
+        best = max(scores)
+        post = random.choices(available, weights=[math.exp(score - best) for score in scores])[0]
+        with preparing_lock:
+            if post['id'] not in preparing_posts and lease_post(post['id']):
+                preparing_posts.add(post['id'])
+                return post
+    return None
 
-def keep_alive():
-    """Функция для предотвращения засыпания сервиса на Render.com"""
-    while True:
-        try:
-            requests.get(SERVICE_URL)
-            logger.info("Keeping service alive...")
-        except Exception as e:
-            logger.error(f"Error in keep_alive: {e}")
-        time.sleep(600)  # Запрос каждые 10 минут
-
-# Запускаем функцию в отдельном потоке
-if __name__ == "__main__" and SERVICE_URL != "https://vk-tg-parser.onrender.com":
-    keep_alive_thread = threading.Thread(target=keep_alive)
-    keep_alive_thread.daemon = True
-    keep_alive_thread.start()
-    logger.info("Keep-alive thread started")
-
-def load_published_posts():
-    """Загрузка списка уже опубликованных постов"""
-    if os.path.exists(PUBLISHED_POSTS_FILE):
-        try:
-            with open(PUBLISHED_POSTS_FILE, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except json.JSONDecodeError:
-            logger.warning(f"Ошибка чтения файла {PUBLISHED_POSTS_FILE}. Создаем новый.")
-            return []
-    return []
 
+def defer_candidate(post, reason):
+    """
+    Учет неудачной подготовки поста: пост откладывается на CANDIDATE_RETRY_HOURS
+    часов (вдвое дольше с каждой следующей неудачей) и теряет в приоритете, а
+    после CANDIDATE_MAX_FAILURES неудач пропускается совсем. Так слот не
+    тратится повторно на видео, которое не скачивается или не сжимается.
+    """
+    delay = CANDIDATE_RETRY_HOURS * 3600 * 2 ** (post.get('failures') or 0)
+    failures = candidate_store.record_failure(post['id'], time.time() + delay, FAILURE_SCORE_PENALTY)
+    metrics.inc('candidate_failures_total')
+    if failures >= CANDIDATE_MAX_FAILURES:
+        logger.warning(f"Пост {post['id']} не удалось подготовить {failures} раз ({reason}), пропускаем пост")
+        candidate_store.mark_skipped(post['id'])
+    else:
+        logger.info(f"Пост {post['id']} отложен на {delay / 3600:.0f} ч ({reason})")
 
-def save_published_posts(posts):
-    """Сохранение списка опубликованных постов"""
-    # Ограничиваем размер кэша
-    if len(posts) > MAX_CACHED_POSTS:
-        posts = posts[-MAX_CACHED_POSTS:]
-    
-    try:
-        with open(PUBLISHED_POSTS_FILE, 'w', encoding='utf-8') as f:
-            json.dump(posts, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        logger.error(f"Ошибка при сохранении списка опубликованных постов: {e}")
 
+def release_candidate(post):
+    """Снятие резерва, поставленного pick_candidate"""
+    with preparing_lock:
+        preparing_posts.discard(post['id'])
+    unlease_post(post['id'])
 
-def get_vk_posts_with_videos(group_id, count=100):
-    """Получение постов с видео из группы ВКонтакте"""
+
+def lease_post(post_id):
+    """
+    Межпроцессный резерв поста: пока процесс работает (аренду продлевает
+    heartbeat_loop), другие процессы не готовят и не публикуют этот пост
+    """
+    return job_queue.acquire(f"post:{post_id}", worker_id, WORKER_LEASE_SECONDS)
+
+
+def unlease_post(post_id):
+    """Снятие межпроцессного резерва поста"""
+    job_queue.release(f"post:{post_id}", worker_id)
+
+
+def create_job_workspace():
+    """Отдельная рабочая директория задачи: параллельные задачи не видят файлов друг друга"""
+    job_dir = os.path.join(JOBS_DIR, worker_id, uuid.uuid4().hex)
+    os.makedirs(job_dir)
+    return job_dir
+
+
+def remove_job_workspace(job_dir):
+    """Удаление рабочей директории задачи вместе со всеми ее файлами (исходник, результат ffmpeg)"""
     try:
-        # Преобразуем дату начала в timestamp
-        start_date = int(datetime.datetime.strptime(START_DATE, '%Y-%m-%d').timestamp())
-        
-        # Получаем посты из группы
-        response = vk.wall.get(owner_id=-group_id if isinstance(group_id, int) else None,
-                              domain=None if isinstance(group_id, int) else group_id,
-                              count=count,
-                              filter='owner')
-        
-        posts_with_videos = []
-        
-        for post in response['items']:
-            # Проверяем, что пост после указанной даты
-            if post['date'] < start_date:
-                continue
-                
-            # Ищем видео в посте
-            has_video = False
-            video_urls = []
-            
-            # Проверяем вложения
-            if 'attachments' in post:
-                for attachment in post['attachments']:
-                    if attachment['type'] == 'video':
-                        has_video = True
-                        video = attachment['video']
-                        
-                        # Формируем URL видео
-                        owner_id = video['owner_id']
-                        video_id = video['id']
-                        access_key = video.get('access_key', '')
-                        
-                        video_url = f"https://vk.com/video{owner_id}_{video_id}"
-                        if access_key:
-                            video_url += f"_{access_key}"
-                            
-                        video_urls.append(video_url)
-            
-            # Если в посте есть видео и текст, добавляем его в список
-            if has_video and 'text' in post and post['text'].strip():
-                posts_with_videos.append({
-                    'id': f"{group_id}_{post['id']}",
-                    'text': post['text'],
-                    'video_urls': video_urls,
-                    'date': post['date'],
-                    'group': group_id
-                })
-        
-        logger.info(f"Получено {len(posts_with_videos)} постов с видео из группы {group_id}")
-        return posts_with_videos
-    
+        shutil.rmtree(job_dir)
+    except FileNotFoundError:
+        pass
     except Exception as e:
-        logger.error(f"Ошибка при получении постов из ВК (группа {group_id}): {e}")
-        return []
+        logger.warning(f"Не удалось удалить рабочую директорию {job_dir}: {e}")
 
 
-def download_video(video_url):
-    """Скачивание видео с помощью yt-dlp как Python-модуля"""
-    try:
-        # Создаем временную директорию для видео, если она не существует
-        os.makedirs(TEMP_DIR, exist_ok=True)
-        
-        # Формируем имя для временного файла
-        timestamp = int(time.time())
-        output_path = os.path.join(TEMP_DIR, f'video_{timestamp}.mp4')
-        
-        logger.info(f"Начинаем скачивание видео: {video_url}")
-        
-        # Опции для yt-dlp
-        ydl_opts = {
-            'format': 'best[ext=mp4]/best',
-            'merge_output_format': 'mp4',
-            'outtmpl': output_path,
-            'quiet': False,
-            'no_warnings': False,
-            'ignoreerrors': True,
-        }
-        
-        try:
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                ydl.download([video_url])
-            
-            if os.path.exists(output_path):
-                logger.info(f"Видео успешно скачано: {output_path}")
-                return output_path
-            else:
-                # Проверяем, был ли файл скачан с другим расширением
-                for file in os.listdir(TEMP_DIR):
-                    file_path = os.path.join(TEMP_DIR, file)
-                    if os.path.isfile(file_path) and file.startswith(f'video_{timestamp}'):
-                        logger.info(f"Видео скачано в формате, отличном от mp4: {file_path}")
-                        # Конвертируем в mp4
-                        return convert_to_mp4(file_path)
-                
-                logger.error(f"Не удалось скачать видео: {video_url}")
-                return None
-        except Exception as e:
-            logger.error(f"Ошибка при скачивании видео с yt-dlp: {e}")
-            return None
+def fetch_post_media(post):
+    """
+    Первая половина подготовки поста: проверка видео на дубликат по ID,
+    параллельное скачивание всех вложений поста (видео и фото) и проверка
+    скачанных видео на дубликат. Уже публиковавшиеся видео выпадают из
+    альбома, а пост без единого нового видео пропускается.
+    Возвращает вложения {'type', 'path', 'keys'} в порядке поста либо None.
+    """
+    media_store.refresh()
+    attachments = [attachment for attachment in post['attachments']
+                   if not (attachment.get('key') and f"video:{attachment['key']}" in media_store)]
+    if not any(attachment['type'] == 'video' for attachment in attachments):
+        logger.info(f"Все видео поста {post['id']} уже публиковались, пропускаем пост")
+        candidate_store.mark_skipped(post['id'])
+        return None
+    # В альбоме Telegram не больше MAX_ALBUM_SIZE вложений: лишние не скачиваются
+    attachments = attachments[:MAX_ALBUM_SIZE]
     
-    except Exception as e:
-        logger.error(f"Ошибка при скачивании видео: {e}")
+    media = [item for item in map_parallel(fetch_attachment, attachments) if item]
+    
+    # Перезалитый ролик: совпадает содержимое или отпечаток кадров
+    media_store.refresh()
+    duplicates = [item for item in media if any(key in media_store for key in item['keys'])]
+    for item in duplicates:
+        logger.info(f"Видео поста {post['id']} совпадает с уже опубликованным, убираем его из поста")
+    remove_media_workspaces(duplicates)
+    media = [item for item in media if item not in duplicates]
+    
+    if not any(item['type'] == 'video' for item in media):
+        remove_media_workspaces(media)
+        if duplicates:
+            logger.info(f"Видео поста {post['id']} совпадают с уже опубликованными, пропускаем пост")
+            candidate_store.mark_skipped(post['id'])
+        else:
+            logger.error(f"Не удалось скачать видео для поста {post['id']}")
+            defer_candidate(post, "видео не скачивается")
         return None
+    
+    if len(media) < len(attachments):
+        logger.warning(f"Скачано {len(media)} из {len(attachments)} вложений поста {post['id']}")
+    return media
+
+
+def remove_media_workspaces(media):
+    """Удаление рабочих директорий скачанных вложений (у видео из кэша file_id файла нет)"""
+    for item in media:
+        if item['path']:
+            remove_job_workspace(os.path.dirname(item['path']))
 
 
-def convert_to_mp4(video_path):
-    """Конвертирует видео в формат MP4 с помощью moviepy"""
+def finish_post_media(post, media):
+    """
+    Вторая половина подготовки поста: параллельное сжатие и конвертация
+    скачанных видео (кодирований одновременно не больше TRANSCODE_WORKERS).
+    Готовые файлы переносятся в кэш подготовленных видео и отмечаются в
+    индексе. Видео с file_id из кэша не сжимаются и остаются без файла.
+    Возвращает подготовленные вложения либо None.
+    """
     try:
-        if not os.path.exists(video_path):
-            logger.error(f"Файл не существует: {video_path}")
+        prepared = [{**item, 'path': path} for item, path in zip(media, map_parallel(prepare_attachment, media))
+                    if path or item.get('file_id')]
+        if not any(item['type'] == 'video' for item in prepared):
+            logger.error(f"Не удалось подготовить видео для поста {post['id']}")
+            defer_candidate(post, "видео не удалось сжать")
             return None
+        if len(prepared) < len(media):
+            logger.warning(f"Подготовлено {len(prepared)} из {len(media)} вложений поста {post['id']}")
         
-        # Проверяем, является ли файл уже MP4
-        if video_path.lower().endswith('.mp4'):
-            logger.info("Файл уже в формате MP4")
-            return video_path
+        with prefetch_lock:
+            for index, item in enumerate(prepared):
+                if item['path']:
+                    extension = '.jpg' if item['type'] == 'photo' else '.mp4'
+                    item['path'] = media_cache.put(media_cache_key(post['id'], index), item['path'], extension)
+            candidate_store.set_prepared(post['id'], prepared, album_media_keys(prepared))
         
-        # Путь для конвертированного видео
-        mp4_path = os.path.splitext(video_path)[0] + ".mp4"
+        logger.info(f"Пост {post['id']} подготовлен: "
+                    f"{', '.join(item['path'] or 'file_id ' + item['file_id'] for item in prepared)}")
+        return prepared
+    finally:
+        remove_media_workspaces(media)
+
+
+def media_cache_key(post_id, index):
+    """
+    Ключ вложения в кэше подготовленных видео: первое вложение хранится под
+    ID поста, остальные — с номером после '@' (в ID поста его не бывает)
+    """
+    return post_id if index == 0 else f"{post_id}@{index}"
+
+
+def album_media_keys(media):
+    """Ключи всех видео поста: по ним после публикации отсеиваются дубликаты"""
+    return [key for item in media for key in item['keys']]
+
+
+def media_ready(item):
+    """Подготовленное вложение можно отправить: файл на месте или видео уже загружено в Telegram"""
+    return bool(item.get('file_id')) or os.path.exists(item['path'])
+
+
+def prepared_media(post):
+    """
+    Подготовленные вложения поста. Посты, подготовленные до появления
+    альбомов (в том числе в очереди отправки), состоят из одного видео.
+    """
+    return post.get('prepared_media') or [{'type': 'video', 'path': post['prepared_path'],
+                                           'keys': post.get('media_keys', [])}]
+
+
+def prepare_post(post):
+    """
+    Подготовка поста к публикации: проверка на дубликат, скачивание, сжатие
+    и конвертация всех вложений. Готовые файлы переносятся в кэш
+    подготовленных видео и отмечаются в индексе. Возвращает подготовленные
+    вложения либо None.
+    """
+    media = fetch_post_media(post)
+    if not media:
+        return None
+    return finish_post_media(post, media)
+
+
+def outbox_post(post, prepared):
+    """Пост с подготовленными вложениями в том виде, в каком он хранится в очереди отправки"""
+    return {**post, 'prepared_path': prepared[0]['path'] or '', 'prepared_media': prepared,
+            'media_keys': album_media_keys(prepared)}
+
+
+def prepare_next_post():
+    """
+    Выбор и подготовка следующего поста. Если пост не удалось подготовить
+    (дубликат, ошибка скачивания), берется следующий кандидат.
+    """
+    for _ in range(MAX_CANDIDATE_ATTEMPTS):
+        post = pick_candidate()
+        if post is None:
+            return None
         
         try:
-            # Открываем видео с помощью moviepy
-            clip = VideoFileClip(video_path)
-            
-            # Конвертируем в MP4
-            clip.write_videofile(
-                mp4_path,
-                codec='libx264',
-                audio_codec='aac',
-                preset='medium',
-                threads=2
-            )
-            
-            # Закрываем клип для освобождения ресурсов
-            clip.close()
-            
-            logger.info(f"Видео успешно конвертировано в MP4: {mp4_path}")
-            
-            # Удаляем исходный файл
-            try:
-                os.remove(video_path)
-            except Exception as e:
-                logger.warning(f"Не удалось удалить исходный файл после конвертации: {e}")
-            
-            return mp4_path
+            if prepare_post(post):
+                return post
         except Exception as e:
-            logger.error(f"Ошибка при конвертации видео в MP4 с moviepy: {e}")
-            return video_path
-    except Exception as e:
-        logger.error(f"Ошибка при конвертации видео в MP4: {e}")
-        return video_path
+            logger.error(f"Ошибка при подготовке поста {post['id']}: {e}")
+            defer_candidate(post, type(e).__name__)
+        finally:
+            release_candidate(post)
+    
+    logger.warning("Не удалось подготовить ни одного поста")
+    return None
 
 
-def compress_video(video_path):
-    """Сжимает видео с помощью moviepy для уменьшения размера"""
-    try:
-        if not os.path.exists(video_path):
-            logger.error(f"Файл не существует: {video_path}")
-            return None
-        
-        # Проверяем, нужно ли конвертировать видео в MP4
-        if not video_path.lower().endswith('.mp4'):
-            video_path = convert_to_mp4(video_path)
-            if not video_path:
-                logger.error("Не удалось конвертировать видео в MP4")
-                return None
-        
-        # Получаем размер файла в МБ
-        file_size = os.path.getsize(video_path) / (1024 * 1024)
-        logger.info(f"Размер исходного файла: {file_size:.2f} МБ")
-        
-        # Если размер меньше 50 МБ, сжатие не требуется
-        if file_size < MAX_VIDEO_SIZE_MB:
-            logger.info("Размер файла меньше максимального, сжатие не требуется")
-            return video_path
-        
-        # Путь для сжатого видео
-        compressed_path = os.path.join(os.path.dirname(video_path), "compressed_video.mp4")
-        
+def remove_prepared(post):
+    """Удаление подготовленных файлов поста"""
+    for item in prepared_media(post):
         try:
-            # Открываем видео с помощью moviepy
-            clip = VideoFileClip(video_path)
-            
-            # Определяем битрейт в зависимости от размера файла
-            if file_size > 200:
-                target_bitrate = "1000k"
-            elif file_size > 100:
-                target_bitrate = "1500k"
-            else:
-                target_bitrate = "2000k"
-            
-            # Сжимаем видео
-            clip.write_videofile(
-                compressed_path,
-                codec='libx264',
-                bitrate=target_bitrate,
-                audio_codec='aac',
-                audio_bitrate='128k',
-                preset='medium',
-                threads=2
-            )
-            
-            # Закрываем клип для освобождения ресурсов
-            clip.close()
-            
-            # Проверяем размер сжатого файла
-            compressed_size = os.path.getsize(compressed_path) / (1024 * 1024)
-            logger.info(f"Размер сжатого файла: {compressed_size:.2f} МБ")
-            
-            # Если сжатие не помогло, возвращаем исходный файл
-            if compressed_size >= file_size:
-                logger.warning("Сжатие не уменьшило размер файла, возвращаем исходный")
-                os.remove(compressed_path)
-                return video_path
-            
-            # Если размер все еще больше максимального, пробуем сжать сильнее
-            if compressed_size > MAX_VIDEO_SIZE_MB:
-                logger.warning(f"Файл все еще слишком большой ({compressed_size:.2f} МБ), пробуем сжать сильнее")
-                os.remove(compressed_path)
-                
-                # Открываем видео снова
-                clip = VideoFileClip(video_path)
-                
-                # Уменьшаем разрешение на 50%
-                clip_resized = clip.resize(0.5)
-                
-                # Сжимаем с более низким битрейтом
-                clip_resized.write_videofile(
-                    compressed_path,
-                    codec='libx264',
-                    bitrate="800k",
-                    audio_codec='aac',
-                    audio_bitrate='96k',
-                    preset='medium',
-                    threads=2
-                )
-                
-                # Закрываем клипы
-                clip.close()
-                clip_resized.close()
-                
-                compressed_size = os.path.getsize(compressed_path) / (1024 * 1024)
-                logger.info(f"Размер файла после сильного сжатия: {compressed_size:.2f} МБ")
-            
-            return compressed_path
+            if item['path'] and os.path.exists(item['path']):
+                os.remove(item['path'])
         except Exception as e:
-            logger.error(f"Ошибка при сжатии видео с moviepy: {e}")
-            return video_path
-    except Exception as e:
-        logger.error(f"Ошибка при сжатии видео: {e}")
-        return video_path
+            logger.warning(f"Не удалось удалить подготовленный файл {item['path']}: {e}")
+    candidate_store.clear_prepared(post['id'])
 
 
-def post_to_telegram(text, video_path):
-    """Публикация поста в Телеграм-канал"""
-    try:
-        # Проверяем размер файла
-        file_size_mb = os.path.getsize(video_path) / (1024 * 1024)
-        
-        # Если размер больше максимального, сжимаем видео
-        if file_size_mb > MAX_VIDEO_SIZE_MB:
-            logger.info(f"Видео слишком большое ({file_size_mb:.2f} МБ), пробуем сжать")
-            compressed_path = compress_video(video_path)
-            
-            # Если получили другой файл (сжатие успешно), используем его
-            if compressed_path != video_path:
-                video_path = compressed_path
-                file_size_mb = os.path.getsize(video_path) / (1024 * 1024)
-        
-        # Проверяем формат файла и конвертируем в mp4 при необходимости
-        if not video_path.lower().endswith('.mp4'):
-            logger.info(f"Видео не в формате MP4, конвертируем")
-            mp4_path = convert_to_mp4(video_path)
-            if mp4_path and mp4_path != video_path:
-                video_path = mp4_path
-                file_size_mb = os.path.getsize(video_path) / (1024 * 1024)
-        
-        # Проверяем размер еще раз после сжатия
-        if file_size_mb > 50:  # Telegram ограничивает размер до 50 МБ
-            logger.warning(f"Видео всё еще слишком большое ({file_size_mb:.2f} МБ), Telegram ограничивает размер до 50 МБ")
-            return False
+def take_prepared_post():
+    """
+    Самый давно подготовленный пост, видео которого все еще можно публиковать.
+    Пост резервируется за вызывающим до вызова release_prepared_post.
+    """
+    media_store.refresh()
+    for post in candidate_store.list_prepared():
+        if post['group'] not in VK_GROUPS:
+            continue
+        with preparing_lock:
+            if post['id'] in publishing_posts or post['id'] in outbox or not lease_post(post['id']):
+                continue
+            publishing_posts.add(post['id'])
+        if not all(media_ready(item) for item in prepared_media(post)):
+            # Часть файлов альбома вытеснена из кэша — пост будет подготовлен заново
+            remove_prepared(post)
+        # Пока видео ждало публикации, такое же могло выйти из другой группы
+        elif any(key in media_store for key in post['media_keys']):
+            logger.info(f"Видео подготовленного поста {post['id']} уже публиковалось, пропускаем пост")
+            candidate_store.mark_skipped(post['id'])
+            remove_prepared(post)
+        else:
+            for item in prepared_media(post):
+                media_cache.touch(item['path'])
+            return post
+        release_prepared_post(post)
+    return None
+
+
+def release_prepared_post(post):
+    """Снятие резерва с поста после публикации"""
+    with preparing_lock:
+        publishing_posts.discard(post['id'])
+    unlease_post(post['id'])
+
+
+def evict_prefetched():
+    """
+    Удаление устаревших подготовленных видео и соблюдение квоты кэша:
+    при превышении PREFETCH_DISK_BUDGET_MB первыми удаляются давно не
+    использованные файлы. Видео постов, которые публикуются, ждут в очереди
+    отправки или зарезервированы другими процессами, не удаляются.
+    Возвращает объем кэша.
+    """
+    queued = outbox.due(now=float('inf'))
+    queued_ids = {item['post']['id'] for item in queued}
+    queued_paths = {media['path'] for item in queued for media in prepared_media(item['post'])}
+    leased = job_queue.held('post:')
+    
+    for post in candidate_store.list_prepared():
+        if post['id'] in publishing_posts or post['id'] in leased or post['id'] in queued_ids:
+            continue
+        stale = time.time() - post['prepared_at'] > PREFETCH_MAX_AGE_HOURS * 3600
+        if stale or post['group'] not in VK_GROUPS:
+            logger.info(f"Удаляем подготовленное видео поста {post['id']}")
+            remove_prepared(post)
+    
+    # Пока идет очистка, пост не может быть взят на публикацию (preparing_lock)
+    with prefetch_lock, preparing_lock:
+        # Файлы, которые больше не числятся в индексе (опубликованные, пропущенные)
+        known_paths = candidate_store.prepared_paths()
+        for path, _, _ in media_cache.entries():
+            # Файл поста, который другой процесс как раз переносит в кэш, еще не отмечен в индексе
+            post_id = os.path.splitext(os.path.basename(path))[0].split('@')[0]
+            if path not in known_paths and post_id not in leased:
+                media_cache.remove(path)
         
-        # Отправляем видео с текстом в Телеграм
-        with open(video_path, 'rb') as video_file:
-            bot.send_video(
-                chat_id=TELEGRAM_CHANNEL_ID,
-                video=video_file,
-                caption=text[:1024],  # Ограничение Telegram на длину подписи
-                parse_mode='HTML'
-            )
-        logger.info(f"Пост успешно опубликован в канале {TELEGRAM_CHANNEL_ID}")
-        return True
+        posts = candidate_store.list_prepared()
+        keep = queued_paths | {item['path'] for post in posts
+                               if post['id'] in publishing_posts or post['id'] in leased
+                               for item in prepared_media(post)}
+        evicted, total_size = media_cache.evict(keep=keep)
+        post_ids = {item['path']: post['id'] for post in posts for item in prepared_media(post)}
+        for path in evicted:
+            logger.info(f"Кэш подготовленных видео переполнен, удаляем давно не использованное {path}")
+            if path in post_ids:
+                # Без одного файла альбом неполон: остальные его файлы удалятся при следующей очистке
+                candidate_store.clear_prepared(post_ids[path])
     
-    except TelegramError as e:
-        logger.error(f"Ошибка при публикации в Телеграм: {e}")
-        return False
+    return total_size
+
+
+async def prefetch_step():
+    """
+    Поддержание запаса из PREFETCH_COUNT подготовленных постов: недостающие
+    посты ставятся в общую очередь задачами prepare, которые выполняют все
+    работающие процессы. Запас считает один процесс за раз, поэтому
+    лишние задачи не ставятся.
+    """
+    total_size = evict_prefetched()
+    if total_size >= PREFETCH_DISK_BUDGET_MB * 1024 * 1024:
+        return
     
-    except Exception as e:
-        logger.error(f"Непредвиденная ошибка при публикации: {e}")
-        return False
+    async with shared_lock('prefetch'):
+        ready = [post for post in candidate_store.list_prepared()
+                 if post['group'] in VK_GROUPS and post['id'] not in outbox]
+        missing = PREFETCH_COUNT - len(ready) - job_queue.pending('prepare')
+        for _ in range(missing):
+            enqueue_job(f"prepare:{uuid.uuid4().hex}", 'prepare')
 
 
-def clean_temp_directory():
-    """Очистка временной директории"""
-    try:
-        for file in os.listdir(TEMP_DIR):
-            file_path = os.path.join(TEMP_DIR, file)
-            if os.path.isfile(file_path):
-                os.remove(file_path)
-        logger.info("Временная директория очищена")
-    except Exception as e:
-        logger.error(f"Ошибка при очистке временной директории: {e}")
+async def prefetch_loop():
+    """Фоновая подготовка следующих постов заранее, до времени публикации"""
+    while True:
+        try:
+            await prefetch_step()
+        except Exception as e:
+            logger.error(f"Ошибка при подготовке постов заранее: {e}")
+        await asyncio.sleep(PREFETCH_INTERVAL_SECONDS)
 
 
-def publish_random_post():
+def mark_post_published(post, media_keys):
+    """Запись поста и ключей его видео в журналы опубликованных"""
+    published_store.add(post['id'])
+    for key in media_keys:
+        media_store.add(key)
+    candidate_store.mark_published(post['id'])
+    last_publish['timestamp'] = int(time.time())
+    metrics.inc('posts_published_total')
+    logger.info(f"Пост {post['id']} из группы {post['group']} успешно опубликован")
+
+
+async def publish_random_post():
     """Публикация случайного поста из ВК в Телеграм"""
+    with metrics.stage('publish'):
+        await publish_next_post()
+
+
+async def publish_next_post():
+    """Выбор, подготовка (если нужно) и отправка следующего поста"""
     logger.info("Начинаем публикацию случайного поста")
     
-    # Загружаем список уже опубликованных постов
-    published_posts = load_published_posts()
-    
-    # Получаем все посты с видео из всех групп
-    all_posts = []
-    for group in VK_GROUPS:
-        posts = get_vk_posts_with_videos(group)
-        all_posts.extend(posts)
-    
-    if not all_posts:
-        logger.warning("Не удалось получить посты с видео из указанных групп")
+    if len(outbox) >= OUTBOX_MAX_SIZE:
+        # Telegram недоступен или ограничивает отправку — не копим новые посты в очереди
+        logger.warning(f"В очереди отправки уже {len(outbox)} постов, новый пост не добавляется")
+        await process_outbox()
         return
     
-    # Фильтруем посты, которые еще не были опубликованы
-    unpublished_posts = [post for post in all_posts if post['id'] not in published_posts]
+    # Обычно видео уже подготовлено заранее и остается только загрузить его
+    random_post = take_prepared_post()
+    
+    if random_post is None:
+        if not candidate_store.count_unpublished():
+            # Индекс пуст (например, при первом запуске) — заполняем его сразу
+            logger.info("В локальном индексе нет неопубликованных постов, обновляем его")
+            await crawl_new_posts(VK_GROUPS)
+        
+        # Видео, которое уже подходит для Telegram, можно передать сразу, без диска
+        if STREAM_UPLOADS and await stream_next_post():
+            return
+        
+        logger.info("Подготовленных постов нет, готовим пост сейчас")
+        await asyncio.get_running_loop().run_in_executor(download_executor, prepare_next_post)
+        random_post = take_prepared_post()
     
-    if not unpublished_posts:
+    if random_post is None:
         logger.warning("Нет неопубликованных постов с видео")
         return
     
-    # Выбираем случайный пост
-    random_post = random.choice(unpublished_posts)
+    # Ставим пост в очередь отправки: при временной ошибке он будет отправлен позже,
+    # а подготовленное видео сохранится до доставки
+    try:
+        outbox.add(random_post, channels_for_group(random_post['group']))
+    finally:
+        release_prepared_post(random_post)
+    
+    await process_outbox()
+
+
+def batch_published(progress):
+    """Количество постов, опубликованных с начала пакетного запуска"""
+    return len(published_store) - progress['published_before']
+
+
+def backfill_pending(groups):
+    """Остались ли группы, старые посты которых еще не догружены"""
+    state = candidate_store.load_crawl_state()
+    return any(not state.get(group_key(group), {}).get('backfill_done', True) for group in groups)
+
+
+async def produce_batch_candidates(download_queue, progress, target):
+    """
+    Первая стадия пакетного режима: кандидаты из индекса, от старых к новым.
+    Как и при публикации по расписанию, отключенные группы и посты,
+    отложенные после неудачи, не берутся. Когда индекс исчерпан,
+    догружаются старые страницы стен групп.
+    """
+    groups = enabled_groups()
+    attempted = set()
+    pending = []
+    while True:
+        in_work = progress['in_flight'] + len(outbox)
+        if batch_published(progress) + in_work >= target:
+            if not in_work:
+                break
+            # Цель может быть достигнута — ждем, пока посты в работе опубликуются или отпадут
+            await asyncio.sleep(0.5)
+            continue
+        
+        if not pending:
+            pending = [post for post in candidate_store.list_unpublished(groups, unprepared_only=True,
+                                                                         ready_only=True)
+                       if post['id'] not in attempted]
+            if not pending:
+                if backfill_pending(groups):
+                    await backfill_step(groups)
+                    continue
+                logger.info("Неопубликованные посты в индексе закончились")
+                break
+        
+        post = pending.pop(0)
+        attempted.add(post['id'])
+        if post['id'] in published_store:
+            candidate_store.mark_published(post['id'])
+            continue
+        with preparing_lock:
+            if post['id'] in preparing_posts or not lease_post(post['id']):
+                continue
+            preparing_posts.add(post['id'])
+        
+        progress['in_flight'] += 1
+        await download_queue.put(post)
+
+
+async def batch_download_worker(download_queue, transcode_queue, progress):
+    """Стадия скачивания: проверка на дубликаты и скачивание в пуле download_executor"""
+    loop = asyncio.get_running_loop()
+    while True:
+        post = await download_queue.get()
+        if post is None:
+            return
+        
+        media = None
+        try:
+            media = await loop.run_in_executor(download_executor, fetch_post_media, post)
+        except Exception as e:
+            logger.error(f"Ошибка при скачивании видео поста {post['id']}: {e}")
+            defer_candidate(post, type(e).__name__)
+        
+        if media:
+            progress['downloaded_bytes'] += sum(os.path.getsize(item['path']) for item in media if item['path'])
+            await transcode_queue.put((post, media))
+        else:
+            release_candidate(post)
+            progress['failed'] += 1
+            progress['in_flight'] -= 1
+
+
+async def batch_transcode_worker(transcode_queue, progress):
+    """Стадия подготовки: сжатие и конвертация, затем постановка в очередь отправки"""
+    loop = asyncio.get_running_loop()
+    while True:
+        item = await transcode_queue.get()
+        if item is None:
+            return
+        
+        post, media = item
+        prepared = None
+        try:
+            # Число одновременных кодирований ограничивает transcode_executor внутри prepare_video
+            prepared = await loop.run_in_executor(None, finish_post_media, post, media)
+        except Exception as e:
+            logger.error(f"Ошибка при подготовке видео поста {post['id']}: {e}")
+            defer_candidate(post, type(e).__name__)
+        
+        if prepared:
+            outbox.add(outbox_post(post, prepared), channels_for_group(post['group']))
+        else:
+            progress['failed'] += 1
+        release_candidate(post)
+        progress['in_flight'] -= 1
+
+
+async def batch_upload_worker(stages_done, progress):
+    """Стадия отправки: очередь отправки разбирается с соблюдением лимитов Telegram"""
+    while True:
+        await process_outbox()
+        if stages_done.is_set() and not len(outbox):
+            return
+        await asyncio.sleep(1 if len(outbox) else 0.2)
+
+
+async def report_batch_progress(progress, target):
+    """Периодический отчет о ходе пакетной публикации"""
+    while True:
+        await asyncio.sleep(BATCH_PROGRESS_INTERVAL_SECONDS)
+        elapsed = time.monotonic() - progress['started']
+        target_str = '' if target == float('inf') else f" из {target}"
+        logger.info(
+            f"Опубликовано {batch_published(progress)}{target_str}, в работе {progress['in_flight']}, "
+            f"в очереди отправки {len(outbox)}, пропущено {progress['failed']}; "
+            f"{batch_published(progress) / elapsed * 60:.1f} постов/мин, "
+            f"скачано {progress['downloaded_bytes'] / (1024 * 1024):.0f} МБ "
+            f"({progress['downloaded_bytes'] / (1024 * 1024) / elapsed:.2f} МБ/с)"
+        )
+
+
+async def run_batch(target=None):
+    """
+    Пакетная публикация накопившихся постов (--backfill N, --drain).
+
+    Обход, скачивание, подготовка и отправка работают одновременно как
+    конвейер с ограниченными очередями между стадиями, поэтому медленная
+    стадия сдерживает предыдущие, а не копит файлы на диске. Прерванный
+    запуск можно повторить: подготовленные посты и очередь отправки
+    сохраняются, опубликованные не повторяются.
+    """
+    target = float('inf') if target is None else target
+    progress = {
+        'published_before': len(published_store), 'in_flight': 0, 'failed': 0,
+        'downloaded_bytes': 0, 'started': time.monotonic(),
+    }
     
-    # Выбираем первое видео из поста (если их несколько)
-    video_url = random_post['video_urls'][0]
+    await crawl_new_posts(VK_GROUPS)
     
-    # Скачиваем видео
-    video_path = download_video(video_url)
+    # Посты, подготовленные до прерывания, сразу идут в отправку
+    for post in candidate_store.list_prepared():
+        if (post['group'] in enabled_groups() and post['id'] not in outbox
+                and all(media_ready(item) for item in prepared_media(post))):
+            outbox.add(post, channels_for_group(post['group']))
+    if len(outbox):
+        logger.info(f"Продолжаем с {len(outbox)} подготовленными постами")
     
-    if not video_path:
-        logger.error(f"Не удалось скачать видео для поста {random_post['id']}")
-        return
+    download_queue = asyncio.Queue(maxsize=BATCH_QUEUE_SIZE)
+    transcode_queue = asyncio.Queue(maxsize=BATCH_QUEUE_SIZE)
+    stages_done = asyncio.Event()
     
-    # Публикуем пост в Телеграм
-    success = post_to_telegram(random_post['text'], video_path)
+    reporter = spawn(report_batch_progress(progress, target), 'batch progress')
+    uploader = asyncio.create_task(batch_upload_worker(stages_done, progress))
+    downloaders = [asyncio.create_task(batch_download_worker(download_queue, transcode_queue, progress))
+                   for _ in range(DOWNLOAD_WORKERS)]
+    transcoders = [asyncio.create_task(batch_transcode_worker(transcode_queue, progress))
+                   for _ in range(TRANSCODE_WORKERS)]
     
-    # Очищаем временную директорию
-    clean_temp_directory()
+    try:
+        await produce_batch_candidates(download_queue, progress, target)
+        for _ in downloaders:
+            await download_queue.put(None)
+        await asyncio.gather(*downloaders)
+        for _ in transcoders:
+            await transcode_queue.put(None)
+        await asyncio.gather(*transcoders)
+        stages_done.set()
+        await uploader
+    finally:
+        reporter.cancel()
+        for task in [uploader, *downloaders, *transcoders]:
+            task.cancel()
     
-    if success:
-        # Добавляем ID поста в список опубликованных
-        published_posts.append(random_post['id'])
-        save_published_posts(published_posts)
-        logger.info(f"Пост {random_post['id']} из группы {random_post['group']} успешно опубликован")
+    elapsed = time.monotonic() - progress['started']
+    logger.info(f"Пакетная публикация завершена: опубликовано {batch_published(progress)} постов "
+                f"за {elapsed / 60:.1f} мин, пропущено {progress['failed']}")
+    log_stage_summary()
 
 
-def test_parser():
+async def test_parser():
     """Тестовый запуск парсера (публикация одного поста)"""
     logger.info("Запуск тестовой публикации")
-    publish_random_post()
+    await publish_random_post()
     logger.info("Тестовая публикация завершена")
+    log_stage_summary()
+
+
+def log_stage_summary():
+    """Итоги замеров этапов в лог: где тратилось время разового запуска"""
+    for line in metrics.summary():
+        logger.info(f"Этап {line}")
+
+
+def spawn(coro, name, core=False):
+    """
+    Запуск корутины отдельной задачей: ее ошибка пишется в лог и не затрагивает
+    остальные. Остановка задачи с core=True отражается в /health.
+    """
+    task = asyncio.create_task(coro, name=name)
+    if core:
+        core_task_names.add(name)
+    background_tasks.add(task)
+    task.add_done_callback(finish_task)
+    return task
+
+
+def finish_task(task):
+    background_tasks.discard(task)
+    if not task.cancelled() and task.exception():
+        logger.error(f"Ошибка в задаче {task.get_name()}: {task.exception()}")
+
+
+def next_slot_time(time_str, now):
+    """Ближайший после now момент time_str (ЧЧ:ММ) по московскому времени"""
+    hour, minute = map(int, time_str.split(':'))
+    day = now.astimezone(moscow_tz).date()
+    while True:
+        slot = moscow_tz.localize(datetime.datetime.combine(day, datetime.time(hour, minute)))
+        if slot > now:
+            return slot
+        day += datetime.timedelta(days=1)
+
+
+async def sleep_until(moment):
+    """
+    Ожидание момента moment. Сон разбит на отрезки не длиннее минуты,
+    поэтому перевод системных часов или сон машины не сдвигают срабатывание.
+    """
+    while True:
+        delay = (moment - datetime.datetime.now(moscow_tz)).total_seconds()
+        if delay <= 0:
+            return
+        await asyncio.sleep(min(delay, 60))
+
+
+async def run_daily(time_str, kind):
+    """
+    Ежедневная постановка задачи kind в общую очередь в time_str по Москве.
+    Ключ задачи — момент слота, поэтому все процессы ставят одну и ту же
+    задачу, а выполняет ее тот, кто первым возьмет ее в аренду.
+    """
+    while True:
+        slot = next_slot_time(time_str, datetime.datetime.now(moscow_tz))
+        await sleep_until(slot)
+        enqueue_job(f"{kind}:{slot.isoformat()}", kind, {'slot': time_str}, run_at=slot.timestamp())
+
+
+async def run_every(interval_seconds, kind):
+    """
+    Постановка задачи kind в общую очередь на границе каждого интервала
+    interval_seconds. Ключ задачи — номер интервала, поэтому несколько
+    процессов ставят одну задачу.
+    """
+    while True:
+        await asyncio.sleep(interval_seconds - time.time() % interval_seconds)
+        enqueue_job(f"{kind}:{round(time.time() / interval_seconds)}", kind)
+
+
+def enqueue_job(key, kind, payload=None, run_at=None):
+    """Постановка задачи в общую очередь и пробуждение цикла задач этого процесса"""
+    if job_queue.enqueue(key, kind, payload, run_at):
+        logger.info(f"Задача {key} поставлена в очередь")
+    job_wakeup().set()
+
+
+async def run_publish_job(job):
+    """Публикация в слот расписания"""
+    lateness = time.time() - job['run_at']
+    last_publish['slot_lateness_seconds'] = round(lateness, 3)
+    logger.info(f"Слот {job['payload']['slot']}: запуск публикации (задержка {lateness * 1000:.0f} мс)")
+    await publish_random_post()
+
+
+async def run_prepare_job(job):
+    """Подготовка одного поста в запас"""
+    await asyncio.get_running_loop().run_in_executor(download_executor, prepare_next_post)
+
+
+# Обработчики задач общей очереди по видам
+JOB_HANDLERS = {
+    'publish': run_publish_job,
+    'crawl': lambda job: crawl_new_posts(VK_GROUPS),
+    'backfill': lambda job: backfill_step(),
+    'prepare': run_prepare_job,
+}
+
+
+async def job_loop():
+    """
+    Выполнение задач из общей очереди. Процесс берет задачи в аренду, пока у
+    него есть свободные места по JOB_LIMITS, поэтому подготовку постов делят
+    все работающие процессы, а каждую задачу выполняет только один из них.
+    """
+    running = {kind: 0 for kind in JOB_LIMITS}
+    while True:
+        kinds = [kind for kind, limit in JOB_LIMITS.items() if running[kind] < limit]
+        job = None
+        try:
+            if kinds:
+                job = job_queue.claim(worker_id, WORKER_LEASE_SECONDS, kinds, JOB_MAX_ATTEMPTS)
+        except Exception as e:
+            logger.error(f"Ошибка при получении задачи из очереди: {e}")
+        if job is None:
+            job_wakeup().clear()
+            try:
+                await asyncio.wait_for(job_wakeup().wait(), JOB_POLL_INTERVAL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            continue
+        
+        if job['attempts'] > 1:
+            logger.warning(f"Задача {job['key']} осталась от остановившегося процесса, попытка {job['attempts']}")
+        running[job['kind']] += 1
+        spawn(run_job(job, running), f"job {job['key']}")
+
+
+async def run_job(job, running):
+    """Выполнение задачи и отметка результата в очереди"""
+    try:
+        await JOB_HANDLERS[job['kind']](job)
+    except Exception as e:
+        logger.error(f"Ошибка в задаче {job['key']}: {e}")
+        job_queue.fail(job['key'], worker_id, repr(e))
+    else:
+        if not job_queue.complete(job['key'], worker_id):
+            logger.warning(f"Аренда задачи {job['key']} истекла до ее завершения")
+    finally:
+        running[job['kind']] -= 1
+        job_wakeup().set()
+
+
+async def heartbeat_loop():
+    """
+    Продление аренд процесса (задачи, резервы постов, отметка worker:), пока
+    он работает, и очистка истории выполненных задач
+    """
+    while True:
+        try:
+            job_queue.acquire(f"worker:{worker_id}", worker_id, WORKER_LEASE_SECONDS)
+            job_queue.heartbeat(worker_id, WORKER_LEASE_SECONDS)
+            job_queue.purge(time.time() - JOB_HISTORY_DAYS * 86400)
+        except Exception as e:
+            logger.error(f"Ошибка при продлении аренды задач: {e}")
+        await asyncio.sleep(WORKER_LEASE_SECONDS / 4)
+
+
+@asynccontextmanager
+async def shared_lock(name):
+    """
+    Блокировка между процессами через аренду name в общей очереди: пока ее
+    держит другой процесс, ожидание. Внутри процесса блокировку дополняют
+    обычные asyncio.Lock
+    """
+    while not job_queue.acquire(name, worker_id, WORKER_LEASE_SECONDS):
+        await asyncio.sleep(1)
+    try:
+        yield
+    finally:
+        job_queue.release(name, worker_id)
 
 
 def schedule_posts():
     """Настройка расписания публикаций"""
     for time_str in POSTING_TIMES:
-        schedule.every().day.at(time_str).do(publish_random_post)
-        logger.info(f"Запланирована публикация на {time_str}")
+        spawn(run_daily(time_str, 'publish'), f"daily {time_str}", core=True)
+        logger.info(f"Запланирована публикация на {time_str} по Москве")
+
+    # Новые посты попадают в локальный индекс заранее, а не в момент публикации
+    spawn(run_every(CRAWL_INTERVAL_MINUTES * 60, 'crawl'), 'crawl', core=True)
+    logger.info(f"Обновление индекса постов запланировано каждые {CRAWL_INTERVAL_MINUTES} минут")
+
+    # Старые посты догружаются постепенно между публикациями
+    spawn(run_every(BACKFILL_INTERVAL_MINUTES * 60, 'backfill'), 'backfill', core=True)
+    logger.info(f"Догрузка старых постов запланирована каждые {BACKFILL_INTERVAL_MINUTES} минут")
+
+
+async def run(args):
+    """Асинхронное ядро: общая HTTP-сессия, расписание и фоновые задачи"""
+    global http_session
+    
+    connector = aiohttp.TCPConnector(limit=HTTP_POOL_SIZE)
+    timeout = aiohttp.ClientTimeout(total=HTTP_TIMEOUT_SECONDS)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        http_session = session
+        
+        # Аренды процесса продлеваются во всех режимах, пока он работает
+        spawn(heartbeat_loop(), 'heartbeat', core=True)
+        
+        # Посты, добавленные в индекс до появления приоритетов, получают score
+        rescored = candidate_store.fill_missing_scores(candidate_score)
+        if rescored:
+            logger.info(f"Рассчитан приоритет для {rescored} постов индекса")
+        
+        # Если указан тестовый режим, публикуем один пост и выходим
+        if args.test:
+            await test_parser()
+            return
+        
+        # Пакетный режим: публикуем накопившиеся посты и выходим (--backfill 0 только
+        # обновляет индекс и отправляет уже подготовленные посты)
+        if args.backfill is not None or args.drain:
+            await run_batch(None if args.drain else args.backfill)
+            return
+        
+        # /metrics и /health доступны с самого запуска
+        await start_metrics_server()
+        
+        # Заполняем локальный индекс постов до первой публикации
+        await crawl_new_posts(VK_GROUPS)
+        
+        # Настраиваем расписание публикаций
+        schedule_posts()
+        
+        # Выполнение задач из общей очереди (слоты, обновление индекса, подготовка постов)
+        spawn(job_loop(), 'jobs', core=True)
+        logger.info(f"Процесс {worker_id} выполняет задачи из общей очереди {JOBS_DB_FILE}")
+        
+        # Отправка постов, оставшихся в очереди, и повторы после ошибок
+        spawn(outbox_loop(), 'outbox', core=True)
+        
+        # Запускаем подготовку следующих постов в фоне
+        spawn(prefetch_loop(), 'prefetch', core=True)
+        logger.info(f"Фоновая подготовка постов запущена (запас: {PREFETCH_COUNT})")
+        
+        if SERVICE_URL != "https://vk-tg-parser.onrender.com":
+            spawn(keep_alive(), 'keep-alive')
+            logger.info("Keep-alive task started")
+        
+        logger.info("Парсер запущен и ожидает времени публикации")
+        await asyncio.Event().wait()
 
 
 def main():
     """Основная функция"""
     parser = argparse.ArgumentParser(description='Парсер ВК -> Телеграм')
     parser.add_argument('--test', action='store_true', help='Тестовый запуск (публикация одного поста)')
+    parser.add_argument('--backfill', type=int, metavar='N', help='Опубликовать N накопившихся постов и выйти')
+    parser.add_argument('--drain', action='store_true', help='Опубликовать все накопившиеся посты и выйти')
     args = parser.parse_args()
+    if args.backfill is not None and args.backfill < 0:
+        parser.error('--backfill: число постов не может быть отрицательным')
     
     logger.info("Запуск парсера ВК -> Телеграм")
     
     # Проверяем наличие токенов
-    if not VK_TOKEN or not TELEGRAM_BOT_TOKEN or not TELEGRAM_CHANNEL_ID:
+    if not VK_TOKEN or not TELEGRAM_BOT_TOKEN:
         logger.error("Отсутствуют необходимые токены. Проверьте файл .env")
         return
     
+    # Проверяем, что для каждой группы известен канал публикации
+    unrouted = [str(group) for group in VK_GROUPS if not channels_for_group(group)]
+    if unrouted:
+        logger.error(f"Не указан канал Телеграм для групп {', '.join(unrouted)}. "
+                     f"Задайте TELEGRAM_CHANNEL_ID в .env или CHANNEL_ROUTES в config.py")
+        return
+    
     # Проверяем наличие групп для парсинга
     if not VK_GROUPS:
         logger.error("Не указаны группы ВК для парсинга. Проверьте config.py")
         return
     
-    # Проверяем наличие yt-dlp
-    try:
-        subprocess.run(['yt-dlp', '--version'], capture_output=True, text=True)
-    except FileNotFoundError:
+    # Проверяем наличие yt-dlp (используется как модуль и импортируется при первом скачивании)
+    if importlib.util.find_spec('yt_dlp') is None:
         logger.error("yt-dlp не установлен. Установите его с помощью 'pip install yt-dlp'")
         return
     
-    # Если указан тестовый режим, публикуем один пост и выходим
-    if args.test:
-        test_parser()
+    # Проверяем наличие ffmpeg без запуска отдельного процесса
+    if shutil.which(FFMPEG_BINARY) is None:
+        logger.error(f"ffmpeg не найден ({FFMPEG_BINARY}). Установите ffmpeg или укажите путь в FFMPEG_BINARY")
         return
     
-    # Настраиваем расписание публикаций
-    schedule_posts()
+    # Процесс отмечается в очереди задач до очистки: директории работающих процессов не удаляются
+    job_queue.acquire(f"worker:{worker_id}", worker_id, WORKER_LEASE_SECONDS)
     
-    logger.info("Парсер запущен и ожидает времени публикации")
+    # Удаляем временные файлы, оставшиеся от прошлого запуска
+    clean_temp_directory()
     
     try:
-        # Запускаем бесконечный цикл для выполнения запланированных задач
-        while True:
-            schedule.run_pending()
-            time.sleep(60)
+        asyncio.run(run(args))
     except KeyboardInterrupt:
         logger.info("Парсер остановлен пользователем")
     except Exception as e: